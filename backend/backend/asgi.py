@@ -3,6 +3,14 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Set CHAT_ASYNC_STREAMING=true to serve /chat/ with the async view, e.g.
+
+    CHAT_ASYNC_STREAMING=true uvicorn backend.asgi:application --workers 4
+
+With several workers also set PROMETHEUS_MULTIPROC_DIR to an empty
+directory so /metrics reports every worker, not just the one that
+answered the scrape.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
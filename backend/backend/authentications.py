@@ -1,11 +1,101 @@
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
+from backend.caches import TTLCache
+from chatai.metrics import PRINCIPAL_CACHE_LOOKUPS, stage
 from user.models import User
 
 import logging
+import threading
 LOGGER = logging.getLogger(__name__)
 
+class PrincipalCache:
+    """
+    User principals keyed by user id: a small in-process LRU in front of
+    Redis, both with short TTLs. User changes are invalidated explicitly
+    through user.signals and UserQuerySet.update; other processes see them
+    after at most LOCAL_TTL.
+
+    Only the fields the request path reads are cached, never the password
+    hash. A cached principal may be stale, so it cannot be saved; load the
+    user with User.objects.get before changing it.
+    """
+    KEY = 'principal:v2:{}'
+    FIELDS = ('id', 'email', 'nickname', 'is_active', 'is_admin', 'answer_cache_enabled')
+
+    def __init__(self) -> None:
+        config = settings.PRINCIPAL_CACHE
+        self._local = TTLCache(config['LOCAL_MAX_ENTRIES'], config['LOCAL_TTL'])
+        self._redis_ttl = config['REDIS_TTL']
+        self._lock = threading.Lock()
+        self.redis_hits = 0
+        self.db_loads = 0
+
+    @classmethod
+    def _dump(cls, user: User) -> dict:
+        return {name: getattr(user, name) for name in cls.FIELDS}
+
+    @staticmethod
+    def _read_only(*args, **kwargs):
+        raise TypeError('Cached principals are read-only, load the user with User.objects.get to save it')
+
+    @staticmethod
+    def _load(fields: dict) -> User:
+        # 未缓存的字段 (密码等) 标记为延迟加载, 访问时才查库
+        names = [field.attname for field in User._meta.concrete_fields if field.attname in fields]
+        user = User.from_db('default', names, [fields[name] for name in names])
+        user.save = user.delete = PrincipalCache._read_only
+        return user
+
+    def get(self, user_id) -> User:
+        fields = self._local.get(user_id)
+        if fields is not None:
+            PRINCIPAL_CACHE_LOOKUPS.labels('local').inc()
+        else:
+            try:
+                fields = cache.get(self.KEY.format(user_id))
+            except Exception as e:
+                LOGGER.warning(f'Principal cache unavailable: {e}')
+                fields = None
+            if fields is not None:
+                with self._lock:
+                    self.redis_hits += 1
+                PRINCIPAL_CACHE_LOOKUPS.labels('redis').inc()
+            else:
+                # raises User.DoesNotExist
+                fields = self._dump(User.objects.only(*self.FIELDS).get(**{'id': user_id}))
+                with self._lock:
+                    self.db_loads += 1
+                PRINCIPAL_CACHE_LOOKUPS.labels('db').inc()
+                try:
+                    cache.set(self.KEY.format(user_id), fields, self._redis_ttl)
+                except Exception as e:
+                    LOGGER.warning(f'Principal cache unavailable: {e}')
+            self._local.set(user_id, fields)
+        return self._load(fields)
+
+    def invalidate(self, user_id) -> None:
+        self._local.pop(user_id)
+        try:
+            cache.delete(self.KEY.format(user_id))
+        except Exception as e:
+            # Redis 中的旧身份最多保留 REDIS_TTL
+            LOGGER.warning(f'Principal cache unavailable: {e}')
+
+    def stats(self) -> dict:
+        local_hits = self._local.hits
+        total = local_hits + self.redis_hits + self.db_loads
+        return {
+            'local_hits': local_hits,
+            'redis_hits': self.redis_hits,
+            'db_loads': self.db_loads,
+            'hit_ratio': (local_hits + self.redis_hits) / total if total else 0.0,
+        }
+
+principal_cache = PrincipalCache()
+
 # 从请求的 Cookie 中提取 Token
 class CookieJWTAuthentication(JWTAuthentication):
     def get_user(self, validate_token):
@@ -14,9 +104,11 @@ class CookieJWTAuthentication(JWTAuthentication):
         except KeyError:
             raise AuthenticationFailed('Token is invalid or expired')
         try:
-            user = User.objects.get(**{'id': user_id})
+            user = principal_cache.get(user_id)
         except User.DoesNotExist:
             raise AuthenticationFailed('Token is invalid or expired')
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive')
         return user
 
     def authenticate(self, request):
@@ -25,8 +117,9 @@ class CookieJWTAuthentication(JWTAuthentication):
             return None
 
         try:
-            validated_token = self.get_validated_token(token)
-            user = self.get_user(validated_token)
+            with stage('auth'):
+                validated_token = self.get_validated_token(token)
+                user = self.get_user(validated_token)
             return (user, validated_token)
         except Exception as e:
             LOGGER.error(str(e))
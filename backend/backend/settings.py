@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chatai.middleware.StageTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -217,4 +218,159 @@ REST_FRAMEWORK = {
 }
 
 # token
-TOKEN_EXPIRATION = 600 # min
\ No newline at end of file
+TOKEN_EXPIRATION = 600 # min
+
+# 允许不登录抓取 /metrics 的地址 (Prometheus); 其他地址需要管理员登录. 经反向代理时这里是代理的地址
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1', '::1'])
+
+# 认证时的用户缓存, 本地 LRU + Redis
+PRINCIPAL_CACHE = {
+    'LOCAL_MAX_ENTRIES': 1024,
+    'LOCAL_TTL': 10,  # s
+    'REDIS_TTL': 300,  # s
+}
+
+# 会话/消息列表的分页大小
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# chat
+# 模型回复在流结束时写入, 经缓冲后批量插入
+MESSAGE_WRITE_BUFFER = {
+    'MAX_BATCH': 200,
+    'FLUSH_INTERVAL': 0.2,  # s
+    'RETRIES': 3,  # 批量写入失败后的重试次数, 之后逐条写入
+    'RETRY_DELAY': 0.5,  # s, 每次重试翻倍
+}
+# 开启后 /chat/ 使用异步视图, 需通过 backend/asgi.py 部署 (uvicorn backend.asgi:application)
+CHAT_ASYNC_STREAMING = env.bool('CHAT_ASYNC_STREAMING', default=False)
+
+# llm / vector store
+OLLAMA_BASE_URL = env('OLLAMA_BASE_URL', default='http://localhost:11434')
+# KEEP_ALIVE: 空闲多久后卸载模型 ('30m', -1 表示常驻); NUM_CTX 固定上下文长度, 避免请求间参数不同导致模型重新加载
+OLLAMA_MODELS = {
+    'llama3.3': {'KIND': 'llm', 'KEEP_ALIVE': env('OLLAMA_KEEP_ALIVE', default='30m'), 'NUM_CTX': 8192},
+    'nomic-embed-text': {'KIND': 'embedding', 'KEEP_ALIVE': env('OLLAMA_EMBED_KEEP_ALIVE', default='30m')},
+}
+# 进程启动时预加载模型并预计算 RAG 提示词的固定前缀
+OLLAMA_WARMUP = env.bool('OLLAMA_WARMUP', default=True)
+# 对话使用的模型后端: ollama 单机, ollama_pool 在 OLLAMA_ENDPOINTS 的多台 Ollama 间负载均衡,
+# openai 为 OpenAI 兼容接口 (OpenAI, vLLM, llama.cpp server 等)
+LLM_BACKEND = env('LLM_BACKEND', default='ollama')
+OLLAMA_ENDPOINTS = env.list('OLLAMA_ENDPOINTS', default=[OLLAMA_BASE_URL])
+OLLAMA_ROUTING = {
+    'PROBE_INTERVAL': 5,  # s, 通过 /api/ps 探测存活和已加载的模型
+    'PROBE_TIMEOUT': 2,  # s
+    'SLOW_PROBE': 1,  # s, 探测超过这个时间视为过载, 暂时摘除
+    'EJECT_SECONDS': 15,  # 首次摘除时长, 连续失败翻倍
+    'MAX_EJECT_SECONDS': 120,
+    'COLD_PENALTY': 4,  # 模型未加载的节点按多这么多个进行中的请求计算
+}
+OPENAI = {
+    'BASE_URL': env('OPENAI_BASE_URL', default='https://api.openai.com/v1'),
+    'API_KEY': env('OPENAI_API_KEY', default=''),  # 本地服务通常不校验, 留空即可
+    'MODEL': env('OPENAI_MODEL', default='gpt-3.5-turbo'),
+    'CONNECT_TIMEOUT': env.float('OPENAI_CONNECT_TIMEOUT', default=5),  # s
+    'READ_TIMEOUT': env.float('OPENAI_READ_TIMEOUT', default=120),  # s, 两个 token 之间的最长等待
+    'MAX_CONNECTIONS': env.int('OPENAI_MAX_CONNECTIONS', default=100),
+    'MAX_RETRIES': env.int('OPENAI_MAX_RETRIES', default=1),
+}
+# 知识库向量存储: elasticsearch, chroma 或 numpy (无需外部服务, 适合中小知识库和测试)
+VECTOR_BACKEND = env('VECTOR_BACKEND', default='elasticsearch')
+# numpy 后端的检索方式: exact 全量扫描, hnsw 近似最近邻 (知识库较大时使用)
+VECTOR_INDEX = {
+    'MODE': env('VECTOR_INDEX', default='exact'),
+    'M': env.int('HNSW_M', default=16),  # 每个节点的邻居数, 越大召回越高、索引越大
+    'EF_CONSTRUCTION': env.int('HNSW_EF_CONSTRUCTION', default=200),
+    'EF_SEARCH': env.int('HNSW_EF_SEARCH', default=64),  # 查询时的候选数, 越大召回越高、越慢
+    'SAVE_ROWS': env.int('HNSW_SAVE_ROWS', default=1024),  # 写入时累计多少新行 (且不少于图的 1/4) 才落盘一次
+}
+ELASTICSEARCH = {
+    'URL': env('ES_URL', default='https://localhost:9200/'),
+    'USER': env('ES_USER', default='elastic'),
+    'PASSWORD': env('ES_PASSWORD', default='e4nkJk6FHIFUKfIukRhn'),
+    'CONNECTIONS': env.int('ES_CONNECTIONS', default=10),  # 每个节点的 keep-alive 连接数
+}
+
+# knowledge ingestion (python manage.py ingest_worker)
+INGEST_WORKERS = env.int('INGEST_WORKERS', default=2)
+INGEST_BATCH_SIZE = env.int('INGEST_BATCH_SIZE', default=64)  # 每批向量化的文档块数
+INGEST_QUEUE_SIZE = env.int('INGEST_QUEUE_SIZE', default=4)  # 解析与向量化之间最多缓存的批次数
+INGEST_MAX_ATTEMPTS = 3
+# 重新上传同名文件时按文档块哈希增量更新向量
+INGEST_INCREMENTAL = env.bool('INGEST_INCREMENTAL', default=True)
+# 大 PDF 按页段多进程抽取文本, WORKERS 为 0 时使用 CPU 核数
+PDF_PARALLEL_EXTRACT = {
+    'ENABLED': env.bool('PDF_PARALLEL_EXTRACT', default=True),
+    'WORKERS': env.int('PDF_EXTRACT_WORKERS', default=0),
+    'PAGES_PER_TASK': 16,
+    'MIN_PAGES': 64,  # 页数少于此值时单进程抽取
+}
+INGEST_JOB_TTL = 7 * 24 * 3600  # s
+# worker 心跳过期后, 它处理中的任务由其他 worker 放回队列
+INGEST_WORKER_TTL = env.int('INGEST_WORKER_TTL', default=30)  # s
+
+# 文档块向量缓存, BACKEND 为 disk 或 redis
+EMBEDDING_CACHE = {
+    'BACKEND': env('EMBEDDING_CACHE_BACKEND', default='disk'),
+    'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+    'MAX_ENTRIES': env.int('EMBEDDING_CACHE_MAX_ENTRIES', default=500000),
+    'BATCH_SIZE': 32,  # 每次请求 embedding 模型的文本数
+    'TOUCH_INTERVAL': 60,  # s, 磁盘缓存的访问时间最多这么久更新一次
+}
+
+# ElasticSearchRAG 的问题向量/检索结果缓存
+RAG_QUERY_CACHE = {
+    'MAX_ENTRIES': 2048,
+    'TTL': 600,  # s
+}
+
+# RAG (Chroma) 并行检索
+RAG_SEARCH = {
+    'WORKERS': 8,
+    'MAX_OPEN_STORES': 256,
+    'STORE_TTL': 3600,  # s
+}
+# RAG 提示词上下文: 合并重叠的相邻文档块、去掉近似重复后按相关度填满 token 预算
+RAG_CONTEXT = {
+    'TOKEN_BUDGET': env.int('RAG_CONTEXT_TOKENS', default=2000),
+    'MIN_OVERLAP': 20,  # 字符, 不超过 BaseParser 的 chunk_overlap
+    'DUPLICATE_THRESHOLD': 0.85,  # 5-gram Jaccard 相似度
+}
+
+# 语义答案缓存: 同一用户、同一知识库版本下相似度达到 THRESHOLD 的问题直接重放已有回答
+ANSWER_CACHE = {
+    'ENABLED': env.bool('ANSWER_CACHE', default=True),
+    'THRESHOLD': env.float('ANSWER_CACHE_THRESHOLD', default=0.95),  # 问题向量余弦相似度
+    'MAX_ENTRIES': 256,  # 每个用户
+    'TTL': 24 * 3600,  # s
+    'REPLAY_CHARS_PER_SECOND': env.int('ANSWER_REPLAY_SPEED', default=200),  # 0 表示一次发完
+    'REPLAY_CHUNK_CHARS': 4,
+}
+
+# 相同 (用户, 会话, 消息) 的并发请求合并为一次生成, 通过 Redis stream 分发给所有连接
+SINGLE_FLIGHT = {
+    'ENABLED': env.bool('SINGLE_FLIGHT', default=True),
+    'LOCK_TTL': 10,  # s, 生成期间由心跳续期; 发起者进程挂掉后最多这么久相同请求不再跟随它
+    'LINGER': 3,  # s, 生成结束后仍可跟随的时间
+    'IDLE_TIMEOUT': 120,  # s, 跟随者等不到新帧时放弃
+}
+
+# 生成并发控制: 超出上限的请求按用户轮转排队, 队列满时返回 429.
+# GLOBAL 时 MAX_ACTIVE / MAX_ACTIVE_PER_USER 经 Redis 在所有进程间共享, 否则按进程计算; 排队长度总是按进程计算
+ADMISSION = {
+    'MAX_ACTIVE': env.int('CHAT_MAX_ACTIVE', default=8),
+    'MAX_ACTIVE_PER_USER': env.int('CHAT_MAX_ACTIVE_PER_USER', default=2),
+    'MAX_QUEUE': env.int('CHAT_MAX_QUEUE', default=64),
+    'MAX_QUEUED_PER_USER': 8,
+    'POSITION_INTERVAL': 2,  # s, 排队时推送位置的间隔
+    'GLOBAL': env.bool('CHAT_ADMISSION_GLOBAL', default=True),
+    'LEASE_TTL': 30,  # s, 进程崩溃后它占用的名额最多这么久后收回
+    'POLL_INTERVAL': 0.2,  # s, 检查其他进程释放的名额的间隔
+}
+
+# SSE 输出: 多个 token 合并为一帧, 达到字符数或距上一帧超过 MAX_DELAY 时发送
+SSE_WRITER = {
+    'MAX_CHARS': env.int('SSE_MAX_CHARS', default=64),
+    'MAX_DELAY': env.float('SSE_MAX_DELAY', default=0.05),  # s, 0 表示每个 token 一帧
+}
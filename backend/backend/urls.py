@@ -14,13 +14,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 from rest_framework.permissions import AllowAny
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
-from chatai.views import ChatView
+from chatai.views import AsyncChatView, ChatView, MetricsView
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -37,6 +38,7 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0), name="swagger"),
     path('admin/', admin.site.urls),
-    path('chat/', ChatView.as_view(), name='chat_with_llm'),
+    path('chat/', (AsyncChatView if settings.CHAT_ASYNC_STREAMING else ChatView).as_view(), name='chat_with_llm'),
     path('user/', include('user.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f'Admission queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        # 在 RedisSlots 里占用的名额
+        self.lease = uuid.uuid4().hex
+        self._event = threading.Event()
+        self._waker = None
+
+    @property
+    def granted(self) -> bool:
+        return self.granted_at is not None
+
+    def _grant(self) -> None:
+        self.granted_at = time.monotonic()
+        self._event.set()
+        if self._waker is not None:
+            loop, future = self._waker
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+
+class RedisSlots:
+    """
+    Generation slots shared by every process through Redis.
+
+    Each granted ticket holds a lease in a global sorted set and in one per
+    user, scored by its expiry time. A lease is acquired only while fewer
+    than `max_active` (and `max_per_user` for the user) unexpired leases
+    exist; holders renew them, so the slots of a crashed process come back
+    after `lease_ttl` seconds.
+    """
+    ACTIVE_KEY = 'admission:active'
+    USER_KEY = 'admission:active:{}'
+    GRANTED, FULL, USER_FULL = 1, 0, -1
+
+    ACQUIRE = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+    if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then return 0 end
+    if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[5]) then return -1 end
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[6])
+    return 1
+    """
+
+    def __init__(self, max_active: int, max_per_user: int, lease_ttl: int) -> None:
+        self._max_active = max_active
+        self._max_per_user = max_per_user
+        self._lease_ttl = lease_ttl
+        self._script = None
+
+    @staticmethod
+    def _redis():
+        return get_redis_connection('default')
+
+    def acquire(self, lease: str, user_id: int) -> int:
+        if self._script is None:
+            self._script = self._redis().register_script(self.ACQUIRE)
+        now = time.time()
+        return int(self._script(keys=[self.ACTIVE_KEY, self.USER_KEY.format(user_id)],
+                                args=[now, now + self._lease_ttl, lease, self._max_active, self._max_per_user,
+                                      self._lease_ttl * 2]))
+
+    def renew(self, leases: Dict[str, int]) -> None:
+        expires_at = time.time() + self._lease_ttl
+        with self._redis().pipeline(transaction=False) as pipe:
+            for lease, user_id in leases.items():
+                pipe.zadd(self.ACTIVE_KEY, {lease: expires_at}, xx=True)
+                pipe.zadd(self.USER_KEY.format(user_id), {lease: expires_at}, xx=True)
+                pipe.expire(self.USER_KEY.format(user_id), self._lease_ttl * 2)
+            pipe.execute()
+
+    def release(self, leases: List[Tuple[str, int]]) -> None:
+        with self._redis().pipeline(transaction=False) as pipe:
+            for lease, user_id in leases:
+                pipe.zrem(self.ACTIVE_KEY, lease)
+                pipe.zrem(self.USER_KEY.format(user_id), lease)
+            pipe.execute()
+
+
+class AdmissionController:
+    """
+    Limits how many chat generations run at once.
+
+    At most `max_active` generations run in total and `max_per_user` per
+    user; everything else waits in a per-user FIFO. Free slots are handed out
+    round-robin over the users with waiting requests, so one user sending a
+    burst cannot starve the others. Requests beyond `max_queue` waiting (or
+    `max_queued_per_user` for one user) are rejected with a Retry-After
+    estimated from recent generation times.
+
+    With `slots` the limits are global: a ticket is granted only once it
+    also holds a RedisSlots lease, so every process together stays within
+    `max_active` and each user within `max_per_user`, while the queue and
+    its round-robin order stay per process. Redis is then only touched from
+    a background thread, which also picks up slots freed by other processes
+    every `poll_interval` seconds. If Redis is unreachable the process falls
+    back to its own limits.
+
+    Works for threads (wait) and coroutines (await_grant) alike; a ticket must
+    always be released, whether it was granted or not. Releasing it again
+    is a no-op.
+    """
+    def __init__(self, max_active: int, max_per_user: int, max_queue: int, max_queued_per_user: int,
+                 slots: Optional[RedisSlots] = None, poll_interval: float = 0.2, lease_ttl: float = 30) -> None:
+        self._max_active = max_active
+        self._max_per_user = max_per_user
+        self._max_queue = max_queue
+        self._max_queued_per_user = max_queued_per_user
+        self._lock = threading.Lock()
+        self._active: Counter = Counter()
+        self._active_total = 0
+        # 有排队请求的用户, 按轮转顺序排列
+        self._queues: 'OrderedDict[int, Deque[Ticket]]' = OrderedDict()
+        self._waiting = 0
+        self._average_seconds = 10.0
+        self._slots = slots
+        self._poll_interval = poll_interval
+        self._lease_ttl = lease_ttl
+        # 已授予的租约, 以及等后台线程去 Redis 归还的租约
+        self._leases: Dict[str, int] = {}
+        self._to_release: List[Tuple[str, int]] = []
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _retry_after(self) -> int:
+        rounds = (self._waiting + 1) / max(self._max_active, 1)
+        return max(1, math.ceil(rounds * self._average_seconds))
+
+    def _update_gauges(self) -> None:
+        metrics.ADMISSION_ACTIVE.set(self._active_total)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self._waiting)
+
+    def _next(self, skipped: Set[int] = frozenset()) -> Optional[Ticket]:
+        # 轮转顺序里第一个本进程限额允许的排队请求
+        if self._active_total >= self._max_active:
+            return None
+        for user_id, queue in self._queues.items():
+            if self._active[user_id] < self._max_per_user and user_id not in skipped:
+                return queue[0]
+        return None
+
+    def _grant(self, ticket: Ticket) -> None:
+        queue = self._queues.pop(ticket.user_id)
+        queue.remove(ticket)
+        if queue:
+            # 排到队尾, 下一个空位先给其他用户
+            self._queues[ticket.user_id] = queue
+        self._waiting -= 1
+        self._active[ticket.user_id] += 1
+        self._active_total += 1
+        if self._slots is not None:
+            self._leases[ticket.lease] = ticket.user_id
+        ticket._grant()
+        metrics.ADMISSION_WAIT_SECONDS.observe(ticket.granted_at - ticket.enqueued_at)
+
+    def _dispatch(self) -> None:
+        if self._slots is not None:
+            # 全局名额要问 Redis, 交给后台线程, 不在调用方 (可能是事件循环) 里做网络请求
+            self._wake.set()
+            return
+        while (ticket := self._next()) is not None:
+            self._grant(ticket)
+
+    def _acquire_slot(self, ticket: Ticket) -> int:
+        try:
+            return self._slots.acquire(ticket.lease, ticket.user_id)
+        except Exception as e:
+            LOGGER.warning(f'Global admission unavailable, using per-process limits: {e}')
+            return RedisSlots.GRANTED
+
+    def _dispatch_global(self) -> None:
+        skipped = set()
+        while True:
+            with self._lock:
+                ticket = self._next(skipped)
+            if ticket is None:
+                return
+            result = self._acquire_slot(ticket)
+            if result == RedisSlots.FULL:
+                return
+            if result == RedisSlots.USER_FULL:
+                # 这个用户在其他进程里已经用满, 先让别的用户
+                skipped.add(ticket.user_id)
+                continue
+            with self._lock:
+                if ticket.released:
+                    self._to_release.append((ticket.lease, ticket.user_id))
+                else:
+                    self._grant(ticket)
+                    self._update_gauges()
+
+    def _run(self) -> None:
+        renewed_at = time.monotonic()
+        while True:
+            self._wake.wait(self._poll_interval)
+            self._wake.clear()
+            try:
+                with self._lock:
+                    to_release, self._to_release = self._to_release, []
+                    leases = dict(self._leases)
+                if to_release:
+                    self._slots.release(to_release)
+                if time.monotonic() - renewed_at >= self._lease_ttl / 3:
+                    if leases:
+                        self._slots.renew(leases)
+                    renewed_at = time.monotonic()
+                self._dispatch_global()
+            except Exception as e:
+                LOGGER.warning(f'Global admission unavailable: {e}')
+
+    def _start(self) -> None:
+        if self._slots is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='admission', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, user_id: int) -> Ticket:
+        with self._lock:
+            self._start()
+            if self._waiting >= self._max_queue or len(self._queues.get(user_id, ())) >= self._max_queued_per_user:
+                metrics.ADMISSION_REJECTED.inc()
+                raise QueueFull(self._retry_after())
+            ticket = Ticket(user_id)
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            self._waiting += 1
+            self._dispatch()
+            self._update_gauges()
+            return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        1-based place of a waiting ticket in round-robin order, 0 once granted
+        """
+        with self._lock:
+            queue = self._queues.get(ticket.user_id)
+            if ticket.granted or queue is None or ticket not in queue:
+                return 0
+            index = queue.index(ticket)
+            ahead, before = index, True
+            for user_id, other in self._queues.items():
+                if user_id == ticket.user_id:
+                    before = False
+                    continue
+                ahead += min(len(other), index + 1 if before else index)
+            return ahead + 1
+
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self._active[ticket.user_id] -= 1
+                if not self._active[ticket.user_id]:
+                    del self._active[ticket.user_id]
+                self._active_total -= 1
+                if self._leases.pop(ticket.lease, None) is not None:
+                    self._to_release.append((ticket.lease, ticket.user_id))
+                self._average_seconds = 0.9 * self._average_seconds + 0.1 * (time.monotonic() - ticket.granted_at)
+            else:
+                # 排队时客户端断开
+                queue = self._queues.get(ticket.user_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    self._waiting -= 1
+                    if not queue:
+                        del self._queues[ticket.user_id]
+            self._dispatch()
+            self._update_gauges()
+
+    def wait(self, ticket: Ticket, timeout: float) -> bool:
+        return ticket._event.wait(timeout)
+
+    async def await_grant(self, ticket: Ticket, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if ticket.granted:
+                return True
+            ticket._waker = (loop, future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return ticket.granted
+
+
+admission = AdmissionController(
+    max_active=settings.ADMISSION['MAX_ACTIVE'],
+    max_per_user=settings.ADMISSION['MAX_ACTIVE_PER_USER'],
+    max_queue=settings.ADMISSION['MAX_QUEUE'],
+    max_queued_per_user=settings.ADMISSION['MAX_QUEUED_PER_USER'],
+    slots=RedisSlots(settings.ADMISSION['MAX_ACTIVE'], settings.ADMISSION['MAX_ACTIVE_PER_USER'],
+                     settings.ADMISSION['LEASE_TTL']) if settings.ADMISSION['GLOBAL'] else None,
+    poll_interval=settings.ADMISSION['POLL_INTERVAL'],
+    lease_ttl=settings.ADMISSION['LEASE_TTL'],
+)
@@ -0,0 +1,92 @@
+import logging
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .chat_models.knowledge_version import get_version
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """
+    Finished RAG answers per user, looked up by query embedding.
+
+    Entries live in a Redis list per (user, knowledge-base version), so
+    uploading or deleting a knowledge file makes every cached answer of that
+    user unreachable; the old list just expires. Each entry is the
+    normalised float32 query vector followed by the UTF-8 answer, and a
+    lookup is a hit when the best cosine similarity reaches `threshold`.
+    """
+    KEY = 'answers:{}:{}'
+
+    def __init__(self, threshold: float, max_entries: int, ttl: int) -> None:
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._ttl = ttl
+
+    @staticmethod
+    def enabled_for(user) -> bool:
+        return settings.ANSWER_CACHE['ENABLED'] and user.answer_cache_enabled
+
+    def key(self, user) -> str:
+        """
+        Read the key before retrieval and pass it to store, so an answer
+        generated while the knowledge base changed is filed under the old
+        version and never served
+        """
+        return self.KEY.format(user.email, get_version(user.email))
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def lookup(self, key: str, embedding: List[float]) -> Optional[str]:
+        entries = get_redis_connection('default').lrange(key, 0, -1)
+        if not entries:
+            return None
+        query = self._normalize(embedding)
+        size = query.nbytes
+        matrix = np.frombuffer(b''.join(entry[:size] for entry in entries), dtype=np.float32).reshape(len(entries), -1)
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self._threshold:
+            return None
+        LOGGER.info(f'Answer cache hit for {key} (similarity {scores[best]:.3f})')
+        return entries[best][size:].decode('utf-8')
+
+    def store(self, key: str, embedding: List[float], answer: str) -> None:
+        """
+        Call only once generation finished normally; a failed or interrupted
+        answer must not be replayed to later questions
+        """
+        # 空回复 (模型没有输出) 不缓存, 否则相似的问题都会拿到空答案
+        if not answer.strip():
+            return
+        with get_redis_connection('default').pipeline() as pipe:
+            pipe.lpush(key, self._normalize(embedding).tobytes() + answer.encode('utf-8'))
+            pipe.ltrim(key, 0, self._max_entries - 1)
+            pipe.expire(key, self._ttl)
+            pipe.execute()
+
+
+def replay_chunks(answer: str) -> Iterator[Tuple[str, float]]:
+    """
+    Split a cached answer into (chunk, delay before the next chunk) at the
+    configured replay speed; a speed of 0 sends it without pauses
+    """
+    size = settings.ANSWER_CACHE['REPLAY_CHUNK_CHARS']
+    speed = settings.ANSWER_CACHE['REPLAY_CHARS_PER_SECOND']
+    for start in range(0, len(answer), size):
+        chunk = answer[start:start + size]
+        yield chunk, len(chunk) / speed if speed else 0
+
+
+answer_cache = AnswerCache(
+    threshold=settings.ANSWER_CACHE['THRESHOLD'],
+    max_entries=settings.ANSWER_CACHE['MAX_ENTRIES'],
+    ttl=settings.ANSWER_CACHE['TTL'],
+)
@@ -1,6 +1,17 @@
+import sys
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChataiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatai'
+
+    def ready(self):
+        # 只在提供服务的进程里预热, migrate 等管理命令不需要
+        if not settings.OLLAMA_WARMUP or (sys.argv[0].endswith('manage.py') and sys.argv[1:2] != ['runserver']):
+            return
+        from .chat_models.ollama_model import warm_up_models
+        threading.Thread(target=warm_up_models, name='ollama-warmup', daemon=True).start()
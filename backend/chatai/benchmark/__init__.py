@@ -0,0 +1,3 @@
+from .fake_ollama import FakeOllama
+from .loadgen import TurnResult, open_stream, summarize
+from .stub_store import seed_stub_knowledge
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+
+def fake_embedding(text: str, dim: int) -> list:
+    # 同一文本总得到同一个向量, 检索结果可复现
+    seed = int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], 16)
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeOllama:
+    """
+    Stand-in for the parts of the Ollama HTTP API the backend uses, plus
+    the OpenAI-compatible /v1/models and /v1/chat/completions.
+
+    Generation streams `reply_tokens` tokens after `ttft` seconds at
+    `tokens_per_second`; embeddings are deterministic unit vectors derived
+    from the text. The server speaks just enough HTTP/1.1 (keep-alive,
+    chunked NDJSON / SSE streaming) for the ollama and openai Python clients.
+    """
+    def __init__(self, tokens_per_second: float = 50, ttft: float = 0.2, reply_tokens: int = 100,
+                 dim: int = 768, models: Iterable[str] = ('llama3.3', 'nomic-embed-text')) -> None:
+        self.tokens_per_second = tokens_per_second
+        self.ttft = ttft
+        self.reply_tokens = reply_tokens
+        self.dim = dim
+        self.models = list(models)
+        self.active_streams = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 11434) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port, limit=2 ** 20)
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                payload = json.loads(body) if body else {}
+
+                await self._route(method, path.split('?')[0], payload, writer)
+                if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send_json(writer: asyncio.StreamWriter, data, status: str = '200 OK') -> None:
+        body = json.dumps(data).encode('utf-8')
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+
+    async def _route(self, method: str, path: str, payload: dict, writer: asyncio.StreamWriter) -> None:
+        models = [{'name': model, 'model': model} for model in self.models]
+        if path == '/api/version':
+            await self._send_json(writer, {'version': '0.0.0-fake'})
+        elif path in ('/api/tags', '/api/ps'):
+            await self._send_json(writer, {'models': models})
+        elif path == '/api/embed':
+            inputs = payload.get('input', '')
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            await self._send_json(writer, {'model': payload.get('model'),
+                                           'embeddings': [fake_embedding(text, self.dim) for text in inputs]})
+        elif path == '/api/embeddings':
+            await self._send_json(writer, {'embedding': fake_embedding(payload.get('prompt', ''), self.dim)})
+        elif path in ('/api/generate', '/api/chat') and method == 'POST':
+            await self._generate(path == '/api/chat', payload, writer)
+        elif path == '/v1/models':
+            await self._send_json(writer, {'object': 'list', 'data': [
+                {'id': model, 'object': 'model', 'created': 0, 'owned_by': 'fake'} for model in self.models]})
+        elif path == '/v1/chat/completions' and method == 'POST':
+            await self._complete(payload, writer)
+        else:
+            await self._send_json(writer, {'error': f'{method} {path} not found'}, '404 Not Found')
+
+    def _chunk(self, model: str, chat: bool, text: str, done: bool) -> dict:
+        chunk = {'model': model, 'created_at': datetime.now(timezone.utc).isoformat(), 'done': done}
+        if chat:
+            chunk['message'] = {'role': 'assistant', 'content': text}
+        else:
+            chunk['response'] = text
+        if done:
+            chunk.update(done_reason='stop', eval_count=self.reply_tokens)
+        return chunk
+
+    def _tokens(self, limit: Optional[int]) -> list:
+        return [f'token{i} ' for i in range(min(limit or self.reply_tokens, self.reply_tokens))]
+
+    async def _stream(self, writer: asyncio.StreamWriter, content_type: str, tokens: list,
+                      encode: Callable[[str], bytes], tail: Iterable[bytes]) -> None:
+        self.active_streams += 1
+        try:
+            writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n'
+                         f'Transfer-Encoding: chunked\r\n\r\n'.encode('latin-1'))
+            start = time.monotonic() + self.ttft
+            for i, token in enumerate(tokens):
+                # 按绝对时间排期, 事件循环繁忙时不会越跑越慢
+                await asyncio.sleep(max(start + i / self.tokens_per_second - time.monotonic(), 0))
+                self._write_chunk(writer, encode(token))
+                await writer.drain()
+            for data in tail:
+                self._write_chunk(writer, data)
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            self.active_streams -= 1
+
+    async def _generate(self, chat: bool, payload: dict, writer: asyncio.StreamWriter) -> None:
+        model = payload.get('model', '')
+        # 预热请求 (num_predict=1) 不需要等待
+        tokens = self._tokens(payload.get('options', {}).get('num_predict'))
+        if not payload.get('stream', True):
+            await asyncio.sleep(self.ttft + len(tokens) / self.tokens_per_second)
+            await self._send_json(writer, self._chunk(model, chat, ''.join(tokens), True))
+            return
+
+        def line(data: dict) -> bytes:
+            return json.dumps(data).encode('utf-8') + b'\n'
+
+        await self._stream(writer, 'application/x-ndjson', tokens,
+                           lambda token: line(self._chunk(model, chat, token, False)),
+                           [line(self._chunk(model, chat, '', True))])
+
+    async def _complete(self, payload: dict, writer: asyncio.StreamWriter) -> None:
+        model = payload.get('model', '')
+        tokens = self._tokens(payload.get('max_tokens') or payload.get('max_completion_tokens'))
+        base = {'id': 'chatcmpl-fake', 'created': int(time.time()), 'model': model}
+        if not payload.get('stream'):
+            await asyncio.sleep(self.ttft + len(tokens) / self.tokens_per_second)
+            await self._send_json(writer, {
+                **base,
+                'object': 'chat.completion',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens), 'total_tokens': len(tokens)},
+            })
+            return
+
+        def event(delta: dict, finish_reason: Optional[str] = None) -> bytes:
+            chunk = {**base, 'object': 'chat.completion.chunk',
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            return b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n'
+
+        await self._stream(writer, 'text/event-stream', tokens,
+                           lambda token: event({'content': token}),
+                           [event({}, 'stop'), b'data: [DONE]\n\n'])
+
+    @staticmethod
+    def _write_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+        writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+class TurnResult:
+    def __init__(self) -> None:
+        self.error: Optional[str] = None
+        self.ttft: Optional[float] = None
+        self.gaps: List[float] = []
+        self.total: Optional[float] = None
+        self.chars = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def open_stream(url: str, token: str, payload: dict, timeout: float,
+                      on_open: Optional[Callable] = None, on_close: Optional[Callable] = None) -> TurnResult:
+    """
+    POST one chat message and read the SSE response until the stop frame,
+    timing the first content frame and the gaps between content frames.
+    HTTP/1.0 is used so the server answers without chunked encoding.
+    """
+    result = TurnResult()
+    parts = urlsplit(url)
+    body = json.dumps(payload).encode()
+    request = (
+        f'POST {parts.path or "/"} HTTP/1.0\r\n'
+        f'Host: {parts.netloc}\r\n'
+        f'Cookie: token={token}\r\n'
+        'Content-Type: application/json;charset=UTF-8\r\n'
+        'Accept: text/event-stream\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'
+    ).encode() + body
+
+    start = time.perf_counter()
+    is_open = False
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port or 80), timeout)
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        if b' 200 ' not in status_line:
+            fields = status_line.split()
+            raise ConnectionError(f'HTTP {fields[1].decode()}' if len(fields) > 1 else 'no response')
+        if on_open:
+            on_open()
+        is_open = True
+
+        finished, last = False, None
+        while not finished:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                break
+            if line.startswith(b'data: '):
+                frame = json.loads(line[6:])
+                content = frame['result']['output']['content']
+                # 排队位置等空内容帧不算输出
+                if content:
+                    now = time.perf_counter()
+                    if last is None:
+                        result.ttft = now - start
+                    else:
+                        result.gaps.append(now - last)
+                    last = now
+                    result.chars += len(content)
+                finished = frame['result']['metadata']['finishReason'] == 'stop'
+        writer.close()
+        if not finished:
+            raise ConnectionError('stream closed before stop frame')
+        result.total = time.perf_counter() - start
+    except asyncio.TimeoutError:
+        result.error = 'timeout'
+    except (OSError, ValueError) as e:
+        result.error = str(e) or type(e).__name__
+    finally:
+        if is_open and on_close:
+            on_close()
+    return result
+
+
+def _percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'p99': round(float(np.percentile(values, 99)), 2),
+        'mean': round(float(values.mean()), 2),
+        'max': round(float(values.max()), 2),
+    }
+
+
+def summarize(results: List[TurnResult], elapsed: float) -> dict:
+    """
+    Aggregate turn results; latencies are in milliseconds. inter_token_ms is
+    measured between content frames, i.e. per token only with SSE_MAX_DELAY=0
+    """
+    completed = [result for result in results if result.ok]
+    return {
+        'turns': len(results),
+        'completed': len(completed),
+        'error_rate': round(1 - len(completed) / len(results), 4) if results else 0,
+        'errors': dict(Counter(result.error for result in results if not result.ok)),
+        'ttft_ms': _percentiles([result.ttft for result in completed if result.ttft is not None]),
+        'inter_token_ms': _percentiles([gap for result in completed for gap in result.gaps]),
+        'turn_ms': _percentiles([result.total for result in completed]),
+        'turns_per_second': round(len(completed) / elapsed, 2) if elapsed else 0,
+        'chars_per_second': round(sum(result.chars for result in completed) / elapsed, 1) if elapsed else 0,
+        'wall_seconds': round(elapsed, 2),
+    }
@@ -0,0 +1,26 @@
+import random
+
+from langchain_core.documents import Document
+
+from chatai.chat_models.vector_db import NumpyVDB, VectoreDatabase
+
+WORDS = ('supply logistics convoy bridge radar missile doctrine armour brigade airfield '
+         'reconnaissance satellite frigate artillery maintenance fuel depot command signal').split()
+
+
+def seed_stub_knowledge(user, chunks: int, seed: int = 0) -> None:
+    """
+    Fill the user's NumPy vector store with synthetic chunks, so retrieval
+    runs against a service-free store of a known size. Embeddings go through
+    the configured Ollama endpoint, i.e. the fake server during benchmarks
+    """
+    rng = random.Random(seed)
+    vector_path = str(VectoreDatabase.get_db_dir(user) / 'vector' / 'bench')
+    docs = [
+        Document(page_content=' '.join(rng.choice(WORDS) for _ in range(60)),
+                 metadata={'source': 'bench', 'page': i // 4})
+        for i in range(chunks)
+    ]
+    for start in range(0, len(docs), 256):
+        batch = docs[start:start + 256]
+        NumpyVDB.store(batch, vector_path, ids=[f'bench-{i}' for i in range(start, start + len(batch))])
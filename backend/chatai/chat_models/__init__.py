@@ -1,5 +1,8 @@
 from .ollama_model import OllamaModel
 from .openai_model import OpenAIModel
+from .ollama_pool import OllamaEndpointPool, RoutedOllamaModel
+from .llm_backend import get_chat_model
 
-from .rag import RAG, ElasticSearchRAG
-from .vector_db import VectoreDatabase, ElasticsearchStore
\ No newline at end of file
+from .rag import RAG, ElasticSearchRAG, NumpyRAG, get_rag
+from .vector_db import VectoreDatabase, ElasticSearchVDB, NumpyVDB, get_vector_db
+from .client_registry import registry
\ No newline at end of file
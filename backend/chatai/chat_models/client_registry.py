@@ -0,0 +1,212 @@
+import logging
+import re
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set
+
+import httpx
+from django.conf import settings
+from elasticsearch import Elasticsearch
+from langchain_elasticsearch import ElasticsearchStore
+from langchain_ollama import OllamaEmbeddings
+from langchain_ollama.llms import OllamaLLM
+from langchain_openai.chat_models import ChatOpenAI
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self, client: Any) -> None:
+        self.client = client
+        self.checked_at = time.monotonic()
+        self.healthy = True
+        self.dependents: Set[Hashable] = set()
+
+
+class ClientRegistry:
+    """
+    Process-wide pool of long-lived clients keyed by (kind, model, endpoint).
+
+    Clients are built on first use and reused afterwards so their HTTP
+    keep-alive pools survive across requests. An optional health check runs
+    at most once per `check_interval` seconds; a client that fails it, or that
+    a caller reports through `invalidate`, is rebuilt lazily on the next `get`.
+
+    Objects built on top of other clients (a vector store over an ES client,
+    a chain over an LLM) pass them as `depends_on`; rebuilding a client drops
+    everything that depends on it, so they are rebuilt too.
+    """
+    def __init__(self, check_interval: float = 30) -> None:
+        self._entries: Dict[Hashable, _Entry] = {}
+        # id(client) -> key, 用来从 depends_on 里的客户端找到它的登记项
+        self._keys: Dict[int, Hashable] = {}
+        # 只保护上面两个字典; 健康检查和构建客户端在各自 key 的锁里做, 慢的 key 不挡住其他 key
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self._check_interval = check_interval
+
+    def _is_fresh(self, entry: Optional[_Entry], health_check: Optional[Callable]) -> bool:
+        if entry is None or not entry.healthy:
+            return False
+        return health_check is None or time.monotonic() - entry.checked_at < self._check_interval
+
+    def _key_lock(self, key: Hashable) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key: Hashable, factory: Callable[[], Any], health_check: Optional[Callable[[Any], bool]] = None,
+            depends_on: Iterable[Any] = ()):
+        entry = self._entries.get(key)
+        if self._is_fresh(entry, health_check):
+            return entry.client
+
+        with self._key_lock(key):
+            entry = self._entries.get(key)
+            if self._is_fresh(entry, health_check):
+                return entry.client
+            if entry is not None and entry.healthy:
+                try:
+                    entry.healthy = bool(health_check(entry.client))
+                except Exception as e:
+                    LOGGER.warning(f'Health check of {key} failed: {e}')
+                    entry.healthy = False
+                entry.checked_at = time.monotonic()
+                if entry.healthy:
+                    return entry.client
+            LOGGER.info(f'Building client {key}')
+            client = factory()
+            with self._lock:
+                if entry is not None:
+                    self._evict(key)
+                self._entries[key] = _Entry(client)
+                self._keys[id(client)] = key
+                for parent_client in depends_on:
+                    parent = self._entries.get(self._keys.get(id(parent_client)))
+                    if parent is not None:
+                        parent.dependents.add(key)
+            return client
+
+    def _evict(self, key: Hashable) -> None:
+        # 连同依赖它的对象一起移除, 它们的 key 里带着旧客户端的 id, 不清掉就永远不会再被用到
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._keys.pop(id(entry.client), None)
+        for dependent in entry.dependents:
+            LOGGER.info(f'Dropping {dependent} built on {key}')
+            self._key_locks.pop(dependent, None)
+            self._evict(dependent)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.healthy = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._key_locks.clear()
+
+
+registry = ClientRegistry()
+
+
+def _ollama_alive(base_url: str) -> bool:
+    with urllib.request.urlopen(f'{base_url.rstrip("/")}/api/version', timeout=2) as res:
+        return res.status == 200
+
+
+def keep_alive_seconds(value) -> Optional[int]:
+    """
+    Ollama keep_alive ('30m', '1h30m', '90s', -1, 300) in seconds;
+    OllamaEmbeddings only accepts an integer
+    """
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip()
+    if re.fullmatch(r'-?\d+', value):
+        return int(value)
+    parts = re.findall(r'(\d+(?:\.\d+)?)([hms])', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        raise ValueError(f'Invalid keep_alive duration: {value!r}')
+    return int(sum(float(number) * {'h': 3600, 'm': 60, 's': 1}[unit] for number, unit in parts))
+
+
+def ollama_options(model: str) -> Dict[str, Any]:
+    """
+    keep_alive / num_ctx configured for the model in OLLAMA_MODELS. Every
+    request for a model must send the same num_ctx, otherwise Ollama reloads
+    it and throws away the cached prompt prefix
+    """
+    config = settings.OLLAMA_MODELS.get(model, {})
+    options = {}
+    if 'KEEP_ALIVE' in config:
+        options['keep_alive'] = config['KEEP_ALIVE']
+    if 'NUM_CTX' in config:
+        options['num_ctx'] = config['NUM_CTX']
+    return options
+
+
+def ollama_llm(model: str, base_url: Optional[str] = None, health_check: bool = True) -> OllamaLLM:
+    """
+    Pass health_check=False when the caller probes the server itself, as
+    the endpoint pool does; the check blocks on an HTTP request
+    """
+    base_url = base_url or settings.OLLAMA_BASE_URL
+    return registry.get(('ollama_llm', model, base_url),
+                        lambda: OllamaLLM(model=model, base_url=base_url, **ollama_options(model)),
+                        (lambda _: _ollama_alive(base_url)) if health_check else None)
+
+
+def ollama_embeddings(model: str, base_url: Optional[str] = None) -> OllamaEmbeddings:
+    base_url = base_url or settings.OLLAMA_BASE_URL
+    keep_alive = keep_alive_seconds(settings.OLLAMA_MODELS.get(model, {}).get('KEEP_ALIVE'))
+    return registry.get(('ollama_embeddings', model, base_url),
+                        lambda: OllamaEmbeddings(model=model, base_url=base_url, keep_alive=keep_alive),
+                        lambda _: _ollama_alive(base_url))
+
+
+def openai_chat(model: str) -> ChatOpenAI:
+    """
+    ChatOpenAI with its own pooled sync and async httpx clients, so
+    connections to the server are kept alive across requests
+    """
+    config = settings.OPENAI
+    base_url = config['BASE_URL']
+
+    def build() -> ChatOpenAI:
+        timeout = httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT'])
+        limits = httpx.Limits(max_connections=config['MAX_CONNECTIONS'],
+                              max_keepalive_connections=config['MAX_CONNECTIONS'])
+        return ChatOpenAI(model=model,
+                          base_url=base_url,
+                          # openai 客户端要求非空 key, 本地服务不校验
+                          api_key=config['API_KEY'] or 'EMPTY',
+                          timeout=timeout,
+                          max_retries=config['MAX_RETRIES'],
+                          http_client=httpx.Client(timeout=timeout, limits=limits),
+                          http_async_client=httpx.AsyncClient(timeout=timeout, limits=limits))
+
+    return registry.get(('openai_chat', model, base_url), build)
+
+
+def elasticsearch_client() -> Elasticsearch:
+    config = settings.ELASTICSEARCH
+    return registry.get(('elasticsearch', config['URL']),
+                        lambda: Elasticsearch(config['URL'],
+                                              basic_auth=(config['USER'], config['PASSWORD']),
+                                              verify_certs=False,
+                                              ssl_show_warn=False,
+                                              connections_per_node=config['CONNECTIONS']),
+                        lambda client: client.ping())
+
+
+def elasticsearch_store(index_name: str, embedding) -> ElasticsearchStore:
+    # 以客户端实例区分, 客户端重建时旧的 store 随之移除
+    client = elasticsearch_client()
+    return registry.get(('elasticsearch_store', index_name, id(client), id(embedding)),
+                        lambda: ElasticsearchStore(index_name=index_name, embedding=embedding, es_connection=client),
+                        depends_on=(client, embedding))
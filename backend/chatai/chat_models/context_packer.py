@@ -0,0 +1,113 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count without loading a tokenizer: one token per CJK
+    character, about four characters per token for everything else
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _overlap(left: str, right: str, min_overlap: int) -> int:
+    """
+    Length of the longest suffix of left that is a prefix of right
+    """
+    for size in range(min(len(left), len(right)) - 1, min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    text = ' '.join(text.split())
+    return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+
+class ContextPacker:
+    """
+    Turns retrieved chunks into the RAG prompt context.
+
+    Chunks of the same source page that overlap (the splitter repeats up to
+    chunk_overlap characters between neighbours) are stitched back into one
+    passage, passages that are contained in or nearly identical to a better
+    scored one are dropped, and the rest fill the token budget in score
+    order. Scores come from metadata['score'], set by every RAG backend.
+    """
+    def __init__(self, token_budget: int = 2000, min_overlap: int = 20, duplicate_threshold: float = 0.85) -> None:
+        self._token_budget = token_budget
+        self._min_overlap = min_overlap
+        self._duplicate_threshold = duplicate_threshold
+
+    @staticmethod
+    def _score(doc: Document) -> float:
+        return doc.metadata.get('score', 0)
+
+    def _merge(self, docs: List[Document]) -> List[Document]:
+        groups: Dict[Tuple, List[Document]] = {}
+        for doc in docs:
+            key = (doc.metadata.get('source'), doc.metadata.get('page'))
+            groups.setdefault(key, []).append(doc)
+
+        merged = []
+        for group in groups.values():
+            passages = [(doc.page_content, doc) for doc in group]
+            changed = True
+            while changed:
+                changed = False
+                for i in range(len(passages)):
+                    for j in range(len(passages)):
+                        if i == j:
+                            continue
+                        left, right = passages[i][0], passages[j][0]
+                        size = _overlap(left, right, self._min_overlap)
+                        if size:
+                            best = max(passages[i][1], passages[j][1], key=self._score)
+                            passages[i] = (left + right[size:], best)
+                            del passages[j]
+                            changed = True
+                            break
+                    if changed:
+                        break
+            merged.extend(
+                Document(id=doc.id, page_content=text, metadata=dict(doc.metadata)) if text != doc.page_content else doc
+                for text, doc in passages
+            )
+        return merged
+
+    def _dedup(self, docs: List[Document]) -> List[Document]:
+        kept: List[Tuple[Document, set]] = []
+        for doc in docs:
+            shingles = _shingles(doc.page_content)
+            duplicate = any(
+                doc.page_content in other.page_content
+                or len(shingles & other_shingles) / len(shingles | other_shingles) >= self._duplicate_threshold
+                for other, other_shingles in kept
+            )
+            if not duplicate:
+                kept.append((doc, shingles))
+        return [doc for doc, _ in kept]
+
+    def pack(self, docs: List[Document], token_budget: Optional[int] = None) -> List[Document]:
+        budget = self._token_budget if token_budget is None else token_budget
+        docs = sorted(self._merge(docs), key=self._score, reverse=True)
+
+        packed, used = [], 0
+        for doc in self._dedup(docs):
+            tokens = estimate_tokens(doc.page_content)
+            if used + tokens <= budget:
+                packed.append(doc)
+                used += tokens
+            elif not packed:
+                # 最相关的段落单独就超出预算时截断保留, 不能让上下文为空
+                ratio = budget / tokens
+                text = doc.page_content[:int(len(doc.page_content) * ratio)]
+                packed.append(Document(id=doc.id, page_content=text, metadata=dict(doc.metadata)))
+                used = budget
+        return packed
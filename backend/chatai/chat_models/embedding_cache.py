@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from langchain_core.embeddings import Embeddings
+
+from ..metrics import EMBEDDING_CACHE_HITS, EMBEDDING_CACHE_MISSES
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _pack(vector: List[float]) -> bytes:
+    return array('f', vector).tobytes()
+
+
+def _unpack(data: bytes) -> List[float]:
+    vector = array('f')
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class DiskEmbeddingStore:
+    """
+    SQLite file of packed float32 vectors, evicting least recently used rows
+    once `max_entries` is exceeded. Access times are only rewritten when
+    older than `touch_interval` seconds, so repeated reads stay read-only.
+    """
+    def __init__(self, path: str, max_entries: int, touch_interval: float = 60) -> None:
+        self._path = str(path)
+        self._max_entries = max_entries
+        self._touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS embedding '
+                               '(key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS embedding_accessed ON embedding (accessed)')
+        return self._conn
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        stale = []
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = conn.execute('SELECT key, vector, accessed FROM embedding '
+                                    f'WHERE key IN ({",".join("?" * len(part))})', part).fetchall()
+                for key, vector, accessed in rows:
+                    found[key] = _unpack(vector)
+                    if now - accessed >= self._touch_interval:
+                        stale.append(key)
+            # 最近刚访问过的行不再写回, LRU 精度为 touch_interval
+            if stale:
+                conn.executemany('UPDATE embedding SET accessed = ? WHERE key = ?', [(now, key) for key in stale])
+                conn.commit()
+        return found
+
+    def set_many(self, items: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany('INSERT OR REPLACE INTO embedding (key, vector, accessed) VALUES (?, ?, ?)',
+                             [(key, _pack(vector), now) for key, vector in items.items()])
+            overflow = conn.execute('SELECT COUNT(*) FROM embedding').fetchone()[0] - self._max_entries
+            if overflow > 0:
+                conn.execute('DELETE FROM embedding WHERE key IN '
+                             '(SELECT key FROM embedding ORDER BY accessed LIMIT ?)', (overflow,))
+            conn.commit()
+
+
+class RedisEmbeddingStore:
+    """
+    Packed float32 vectors in Redis, with a sorted set of access times used
+    to evict the least recently used keys beyond `max_entries`.
+    """
+    LRU_KEY = 'embcache:lru'
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f'embcache:{key}'
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        if not keys:
+            return {}
+        redis = get_redis_connection('default')
+        values = redis.mget([self._key(key) for key in keys])
+        found = {key: _unpack(value) for key, value in zip(keys, values) if value is not None}
+        if found:
+            now = time.time()
+            redis.zadd(self.LRU_KEY, {key: now for key in found})
+        return found
+
+    def set_many(self, items: Dict[str, List[float]]) -> None:
+        redis = get_redis_connection('default')
+        now = time.time()
+        pipe = redis.pipeline()
+        pipe.mset({self._key(key): _pack(vector) for key, vector in items.items()})
+        pipe.zadd(self.LRU_KEY, {key: now for key in items})
+        pipe.execute()
+
+        overflow = redis.zcard(self.LRU_KEY) - self._max_entries
+        if overflow > 0:
+            evicted = [key.decode() for key in redis.zrange(self.LRU_KEY, 0, overflow - 1)]
+            pipe = redis.pipeline()
+            pipe.delete(*[self._key(key) for key in evicted])
+            pipe.zrem(self.LRU_KEY, *evicted)
+            pipe.execute()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings instance with a persistent cache keyed by model name
+    and the SHA-256 of the chunk text. Only missing chunks reach the model,
+    in batches of `batch_size`.
+    """
+    def __init__(self, embeddings: Embeddings, model_name: str, store, batch_size: int = 32) -> None:
+        self._embeddings = embeddings
+        self._model_name = model_name
+        self._store = store
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f'{self._model_name}:{digest}'
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        try:
+            cached = self._store.get_many(list(set(keys)))
+        except Exception as e:
+            LOGGER.warning(f'Embedding cache unavailable: {e}')
+            cached = {}
+
+        missing = list(dict.fromkeys(key for key in keys if key not in cached))
+        hits = sum(1 for key in keys if key in cached)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(missing)
+        EMBEDDING_CACHE_HITS.labels(self._model_name).inc(hits)
+        EMBEDDING_CACHE_MISSES.labels(self._model_name).inc(len(missing))
+
+        if missing:
+            texts_by_key = dict(zip(keys, texts))
+            computed = {}
+            for start in range(0, len(missing), self._batch_size):
+                batch = missing[start:start + self._batch_size]
+                vectors = self._embeddings.embed_documents([texts_by_key[key] for key in batch])
+                computed.update(zip(batch, vectors))
+            try:
+                self._store.set_many(computed)
+            except Exception as e:
+                LOGGER.warning(f'Embedding cache unavailable: {e}')
+            cached.update(computed)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embeddings.embed_query(text)
+
+
+def cached_embeddings(embeddings: Embeddings, model_name: str, backend: Optional[str] = None) -> CachedEmbeddings:
+    config = settings.EMBEDDING_CACHE
+    backend = backend or config['BACKEND']
+    if backend == 'redis':
+        store = RedisEmbeddingStore(config['MAX_ENTRIES'])
+    elif backend == 'disk':
+        store = DiskEmbeddingStore(config['PATH'], config['MAX_ENTRIES'], config['TOUCH_INTERVAL'])
+    else:
+        raise ValueError(f'Unknown embedding cache backend: {backend}')
+    return CachedEmbeddings(embeddings, model_name, store, config['BATCH_SIZE'])
@@ -0,0 +1,129 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import hnswlib
+import numpy as np
+
+
+class HNSWIndex:
+    """
+    Persistent HNSW graph over the rows of a NumpyVectorStore.
+
+    Labels are the store's row numbers, which never change because the store
+    is append-only. hnsw.bin holds the graph and hnsw.json the number of
+    rows already inserted plus the tombstoned labels, so every writer only
+    inserts the rows appended since the last save. Rows the graph has not
+    caught up with yet are still searchable through the store's exact scan.
+
+    Saving rewrites the whole graph, so `update` only saves once the
+    unsaved rows reach `save_rows` or a quarter of the graph, whichever is
+    larger; writers call `flush` when they are done (e.g. at the end of an
+    ingest job).
+    """
+    INDEX = 'hnsw.bin'
+    STATE = 'hnsw.json'
+
+    def __init__(self, directory: str, m: int = 16, ef_construction: int = 200, ef_search: int = 64,
+                 save_rows: int = 1024) -> None:
+        self._dir = str(directory)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.save_rows = save_rows
+        self._index: Optional[hnswlib.Index] = None
+        self._rows = 0
+        self._deleted = set()
+        self._signature = None
+        self._saved_rows = 0
+        self._dirty = False
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._dir, name)
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    def _disk_signature(self):
+        try:
+            stat = os.stat(self._path(self.STATE))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self, dim: int) -> None:
+        """
+        (Re)load the graph if another process saved a newer one; the first
+        call is what makes loading lazy. Unsaved changes are dropped then,
+        and the next update continues from the loaded graph's rows
+        """
+        signature = self._disk_signature()
+        if signature is None or signature == self._signature:
+            return
+        with open(self._path(self.STATE)) as f:
+            state = json.load(f)
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.load_index(self._path(self.INDEX), max_elements=max(state['rows'], 1))
+        index.set_ef(self.ef_search)
+        self._index, self._rows, self._deleted = index, state['rows'], set(state['deleted'])
+        self._signature = signature
+        self._saved_rows, self._dirty = self._rows, False
+
+    def update(self, matrix: Optional[np.ndarray], alive: np.ndarray, save: bool = False) -> None:
+        """
+        Insert rows appended since the last update and tombstone dead ones,
+        saving when enough rows are pending or `save` is set. Callers hold
+        the store's write lock
+        """
+        if matrix is None:
+            return
+        dim = matrix.shape[1]
+        self.load(dim)
+        if self._index is None:
+            self._index = hnswlib.Index(space='ip', dim=dim)
+            self._index.init_index(max_elements=max(len(matrix), 1024), ef_construction=self.ef_construction, M=self.m)
+            self._index.set_ef(self.ef_search)
+
+        if len(matrix) > self._rows:
+            if len(matrix) > self._index.get_max_elements():
+                self._index.resize_index(max(len(matrix), 2 * self._index.get_max_elements()))
+            self._index.add_items(np.asarray(matrix[self._rows:]), np.arange(self._rows, len(matrix)))
+            self._rows = len(matrix)
+            self._dirty = True
+
+        dead = set(np.flatnonzero(~alive[:self._rows]).tolist()) - self._deleted
+        for label in dead:
+            self._index.mark_deleted(label)
+        self._deleted |= dead
+        self._dirty = self._dirty or bool(dead)
+
+        if save or self._rows - self._saved_rows >= max(self.save_rows, self._saved_rows // 4):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._dirty:
+            return
+        # 先写图再写状态, 读者以状态文件的变化为准
+        tmp_path = self._path(self.INDEX + '.tmp')
+        self._index.save_index(tmp_path)
+        os.replace(tmp_path, self._path(self.INDEX))
+        tmp_path = self._path(self.STATE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows': self._rows, 'deleted': sorted(self._deleted)}, f)
+        os.replace(tmp_path, self._path(self.STATE))
+        self._signature = self._disk_signature()
+        self._saved_rows, self._dirty = self._rows, False
+
+    def search(self, query: np.ndarray, k: int, alive: np.ndarray, ef: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, inner product) among the indexed rows that are alive
+        """
+        k = min(k, int(alive[:self._rows].sum()))
+        if self._index is None or k <= 0:
+            return []
+        self._index.set_ef(max(ef or self.ef_search, k))
+        # 过滤回调保证被替换但尚未写入墓碑的旧行不会返回; 其他进程保存的图可能比读者看到的行还多
+        labels, distances = self._index.knn_query(query, k=k, num_threads=1,
+                                                  filter=lambda label: label < len(alive) and bool(alive[label]))
+        return [(int(label), 1 - float(distance)) for label, distance in zip(labels[0], distances[0])]
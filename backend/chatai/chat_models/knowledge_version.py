@@ -0,0 +1,13 @@
+from django_redis import get_redis_connection
+
+# 每个用户知识库的版本号, 知识库变化时递增, 用于让检索相关的缓存失效
+VERSION_KEY = 'kb:version:{}'
+
+
+def get_version(index_name: str) -> int:
+    value = get_redis_connection('default').get(VERSION_KEY.format(index_name))
+    return int(value) if value else 0
+
+
+def bump_version(index_name: str) -> int:
+    return get_redis_connection('default').incr(VERSION_KEY.format(index_name))
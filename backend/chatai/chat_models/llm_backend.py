@@ -0,0 +1,19 @@
+from django.conf import settings
+
+from .base_model import BaseModel
+from .ollama_model import OllamaModel
+from .ollama_pool import RoutedOllamaModel
+from .openai_model import OpenAIModel
+
+
+def get_chat_model(health_check: bool = True) -> BaseModel:
+    """
+    Pass health_check=False on the event loop; the periodic health check of
+    the Ollama client is a blocking HTTP request
+    """
+    if settings.LLM_BACKEND == 'ollama':
+        return OllamaModel(health_check=health_check)
+    return {
+        'ollama_pool': RoutedOllamaModel,
+        'openai': OpenAIModel,
+    }[settings.LLM_BACKEND]()
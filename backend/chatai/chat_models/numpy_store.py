@@ -0,0 +1,215 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document
+
+from backend.caches import TTLCache
+
+
+class NumpyVectorStore:
+    """
+    Exact-search vector store for one user, without any external service.
+
+    vectors.f32 is an append-only file of L2-normalised float32 rows mapped
+    with numpy.memmap; meta.jsonl holds one line per row (id, text,
+    metadata) plus tombstone lines for deleted ids; row i of the matrix
+    belongs to the i-th id line. Re-adding an id appends a new row that
+    supersedes the old one. Writers from several processes
+    are serialised with a file lock; readers pick up appended rows on the
+    next search by comparing file sizes.
+
+    With an HNSWIndex attached, writers keep the graph up to date and search
+    only scans the rows the graph does not cover yet.
+    """
+    VECTORS = 'vectors.f32'
+    META = 'meta.jsonl'
+    INFO = 'info.json'
+    LOCK = '.lock'
+
+    def __init__(self, directory: str, index=None) -> None:
+        self._dir = str(directory)
+        self._index = index
+        self._lock = threading.Lock()
+        self._dim: Optional[int] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._meta_offset = 0
+        self._rows: List[Tuple[str, str, Dict]] = []
+        self._latest: Dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._dir, name)
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self._dir, exist_ok=True)
+        with open(self._path(self.LOCK), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_dim(self) -> Optional[int]:
+        if self._dim is None and os.path.exists(self._path(self.INFO)):
+            with open(self._path(self.INFO)) as f:
+                self._dim = json.load(f)['dim']
+        return self._dim
+
+    def _refresh(self) -> None:
+        """
+        Read meta lines appended since the last call and remap the matrix
+        """
+        if not os.path.exists(self._path(self.META)) or self._read_dim() is None:
+            return
+        if os.path.getsize(self._path(self.META)) == self._meta_offset:
+            return
+
+        with open(self._path(self.META), 'rb') as f:
+            f.seek(self._meta_offset)
+            for line in f:
+                # 只处理写完整的行, 写入中的最后一行留到下次
+                if not line.endswith(b'\n'):
+                    break
+                self._meta_offset += len(line)
+                record = json.loads(line)
+                if 'delete' in record:
+                    self._latest.pop(record['delete'], None)
+                    continue
+                self._latest[record['id']] = len(self._rows)
+                self._rows.append((record['id'], record['text'], record['metadata']))
+
+        rows = len(self._rows)
+        self._matrix = np.memmap(self._path(self.VECTORS), dtype=np.float32, mode='r', shape=(rows, self._dim)) \
+            if rows else None
+        self._alive = np.zeros(rows, dtype=bool)
+        self._alive[list(self._latest.values())] = True
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._latest)
+
+    def add(self, ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[Dict], vectors) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        with self._write_lock():
+            dim = self._read_dim()
+            if dim is None:
+                with open(self._path(self.INFO), 'w') as f:
+                    json.dump({'dim': vectors.shape[1]}, f)
+                self._dim = dim = vectors.shape[1]
+            if vectors.shape[1] != dim:
+                raise ValueError(f'Expected vectors of dimension {dim}, got {vectors.shape[1]}')
+
+            self._truncate_to_meta()
+            # 先写向量再写元数据, 读者以元数据行数为准
+            with open(self._path(self.VECTORS), 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self._path(self.META), 'a', encoding='utf-8') as f:
+                for doc_id, text, metadata in zip(ids, texts, metadatas):
+                    f.write(json.dumps({'id': doc_id, 'text': text, 'metadata': metadata}, ensure_ascii=False) + '\n')
+            self._update_index()
+
+    def _truncate_to_meta(self) -> None:
+        """
+        Drop vector rows and a partial meta line left by a writer that failed
+        between (or during) the two writes; call under the write lock
+        """
+        if self._read_dim() is None:
+            return
+        with self._lock:
+            self._refresh()
+            rows, meta_offset = len(self._rows), self._meta_offset
+        # 不截掉的话, 之后追加的每一行元数据都会对应到错位的向量上
+        if os.path.exists(self._path(self.META)) and os.path.getsize(self._path(self.META)) > meta_offset:
+            os.truncate(self._path(self.META), meta_offset)
+        size = rows * self._dim * np.dtype(np.float32).itemsize
+        if os.path.exists(self._path(self.VECTORS)) and os.path.getsize(self._path(self.VECTORS)) > size:
+            os.truncate(self._path(self.VECTORS), size)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self._write_lock():
+            self._truncate_to_meta()
+            with open(self._path(self.META), 'a', encoding='utf-8') as f:
+                for doc_id in ids:
+                    f.write(json.dumps({'delete': doc_id}) + '\n')
+            self._update_index(save=True)
+
+    def flush(self) -> None:
+        """
+        Save the pending index changes; call after the last add of a batch
+        of writes
+        """
+        if self._index is not None:
+            with self._write_lock():
+                self._update_index(save=True)
+
+    def _update_index(self, save: bool = False) -> None:
+        if self._index is None:
+            return
+        with self._lock:
+            self._refresh()
+            self._index.update(self._matrix, self._alive, save)
+
+    def _exact_top_k(self, query: np.ndarray, k: int, start: int = 0) -> List[Tuple[int, float]]:
+        scores = self._matrix[start:] @ query
+        scores[~self._alive[start:]] = -np.inf
+        k = min(k, int(self._alive[start:].sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(start + int(i), float(scores[i])) for i in top]
+
+    def search(self, embedding: Sequence[float], k: int = 5, exact: bool = False,
+               ef: Optional[int] = None) -> List[Tuple[Document, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+
+        with self._lock:
+            self._refresh()
+            if self._matrix is None:
+                return []
+            if self._index is None or exact:
+                hits = self._exact_top_k(query, k)
+            else:
+                self._index.load(self._dim)
+                hits = self._index.search(query, k, self._alive, ef) + self._exact_top_k(query, k, self._index.rows)
+            hits = sorted(hits, key=lambda hit: -hit[1])[:k]
+            rows = [(self._rows[i], score) for i, score in hits]
+
+        return [(Document(id=doc_id, page_content=text, metadata=dict(metadata)), score)
+                for (doc_id, text, metadata), score in rows]
+
+
+_open_stores = TTLCache(maxsize=1024, ttl=3600)
+_open_lock = threading.Lock()
+
+
+def open_store(directory: str) -> NumpyVectorStore:
+    """
+    Shared NumpyVectorStore per directory, so the web process keeps its
+    memory maps and sidecar offsets between requests
+    """
+    directory = str(directory)
+    with _open_lock:
+        store = _open_stores.get(directory)
+        if store is None:
+            index = None
+            if settings.VECTOR_INDEX['MODE'] == 'hnsw':
+                from .hnsw_index import HNSWIndex
+                index = HNSWIndex(directory, m=settings.VECTOR_INDEX['M'],
+                                  ef_construction=settings.VECTOR_INDEX['EF_CONSTRUCTION'],
+                                  ef_search=settings.VECTOR_INDEX['EF_SEARCH'],
+                                  save_rows=settings.VECTOR_INDEX['SAVE_ROWS'])
+            store = NumpyVectorStore(directory, index)
+            _open_stores.set(directory, store)
+        return store
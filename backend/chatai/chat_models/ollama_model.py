@@ -1,9 +1,16 @@
+import json
+import logging
+import urllib.request
+
+from django.conf import settings
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
-from langchain_ollama.llms import OllamaLLM
+from . import client_registry
 from .base_model import BaseModel
 
+LOGGER = logging.getLogger(__name__)
+
 RAG_TEMPLATE = """
 You are an assistant for question-answering tasks. Below is the context retrieved from documents. 
 If the question is related to the context, use the information to generate an answer. 
@@ -61,12 +68,72 @@ Question:
 Answer:
 """
 
+# 模板中 {context} 之前的说明部分每轮都逐字节相同, Ollama 可以直接复用这段前缀的 KV 缓存,
+# 所以可变内容只能放在模板末尾
 rag_prompt = ChatPromptTemplate.from_template(RAG_MULITARY_TEMPLATE)
 
+
+def format_docs(docs):
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+def rag_chain(llm):
+    """
+    The RAG chain for an LLM client, built once and shared by every request
+    """
+    return client_registry.registry.get(
+        ('rag_chain', id(llm)),
+        lambda: (
+            RunnablePassthrough.assign(context=lambda input: format_docs(input["context"]))
+            | rag_prompt
+            | llm
+            | StrOutputParser()
+        ),
+        depends_on=(llm,),
+    )
+
+
+def _post(base_url: str, path: str, payload: dict, timeout: float) -> None:
+    payload = {key: value for key, value in payload.items() if value is not None}
+    request = urllib.request.Request(f'{base_url.rstrip("/")}{path}',
+                                     data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as res:
+        res.read()
+
+
+def warm_up_models(timeout: float = 600) -> None:
+    """
+    Load every model in OLLAMA_MODELS with its keep_alive on every Ollama
+    server, and evaluate the static RAG instruction prefix once so the first
+    chat does not pay for it
+    """
+    for base_url in dict.fromkeys([settings.OLLAMA_BASE_URL, *settings.OLLAMA_ENDPOINTS]):
+        for model, config in settings.OLLAMA_MODELS.items():
+            _warm_up(base_url, model, config, timeout)
+
+
+def _warm_up(base_url: str, model: str, config: dict, timeout: float) -> None:
+    options = client_registry.ollama_options(model)
+    try:
+        if config.get('KIND') == 'embedding':
+            _post(base_url, '/api/embed', {'model': model, 'input': '', 'keep_alive': options.get('keep_alive')}, timeout)
+        else:
+            _post(base_url, '/api/generate', {
+                'model': model,
+                'prompt': rag_prompt.format(context='', question=''),
+                'stream': False,
+                'keep_alive': options.get('keep_alive'),
+                'options': {'num_predict': 1, **({'num_ctx': options['num_ctx']} if 'num_ctx' in options else {})},
+            }, timeout)
+        LOGGER.info(f'Warmed up Ollama model {model} on {base_url}')
+    except Exception as e:
+        LOGGER.warning(f'Failed to warm up Ollama model {model} on {base_url}: {e}')
+
 class OllamaModel(BaseModel):
-    def __init__(self) -> None:
+    def __init__(self, health_check: bool = True) -> None:
         super().__init__()
-        self._llm = OllamaLLM(model='llama3.3')
+        self._llm = client_registry.ollama_llm('llama3.3', health_check=health_check)
 
     def chat_response(self, message: str) -> str:
         res = self._llm.invoke(message)
@@ -77,16 +144,15 @@ class OllamaModel(BaseModel):
         for token in res:
             yield token
 
-    def _format_docs(self, docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-    
+    async def achat_stream(self, message: str):
+        async for token in self._llm.astream(message):
+            yield token
+
     def chat_stream_rag(self, message, docs):
-        chain = (
-            RunnablePassthrough.assign(context=lambda input: self._format_docs(input["context"]))
-            | rag_prompt
-            | self._llm
-            | StrOutputParser()
-        )
-        res = chain.stream({"context": docs, "question": message})
+        res = rag_chain(self._llm).stream({"context": docs, "question": message})
         for token in res:
             yield token
+
+    async def achat_stream_rag(self, message, docs):
+        async for token in rag_chain(self._llm).astream({"context": docs, "question": message}):
+            yield token
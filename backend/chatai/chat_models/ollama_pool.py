@@ -0,0 +1,253 @@
+import json
+import logging
+import threading
+import time
+import urllib.request
+from typing import Iterable, List, Optional, Set
+
+from django.conf import settings
+
+from chatai import metrics
+from . import client_registry
+from .base_model import BaseModel
+from .ollama_model import rag_chain
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _model_name(name: str) -> str:
+    # /api/ps 返回带 tag 的名字, 配置里的 llama3.3 对应 llama3.3:latest
+    return name[:-len(':latest')] if name.endswith(':latest') else name
+
+
+class Endpoint:
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.models: Set[str] = set()
+        self.ejected = False
+        self.ejected_until = 0.0
+        self.failures = 0
+        self.probe_seconds: Optional[float] = None
+
+
+class OllamaEndpointPool:
+    """
+    A set of Ollama servers that serve the same models.
+
+    `acquire` hands out the endpoint with the fewest outstanding streams,
+    counting an endpoint that does not have the model loaded as
+    `cold_penalty` extra streams, since loading it costs far more than
+    queueing behind a few generations. A background thread probes /api/ps
+    every `probe_interval` seconds; an endpoint whose probe fails or takes
+    longer than `slow_probe` seconds, or that a caller reports through
+    `report_failure`, is ejected for `eject_seconds`, doubling on each
+    consecutive failure up to `max_eject_seconds`, and re-admitted by the
+    first successful probe after that. When every endpoint is ejected the
+    pool still hands them out rather than failing outright.
+    """
+    def __init__(self, urls: Iterable[str], probe_interval: float, probe_timeout: float, slow_probe: float,
+                 eject_seconds: float, max_eject_seconds: float, cold_penalty: int) -> None:
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._probe_interval = probe_interval
+        self._probe_timeout = probe_timeout
+        self._slow_probe = slow_probe
+        self._eject_seconds = eject_seconds
+        self._max_eject_seconds = max_eject_seconds
+        self._cold_penalty = cold_penalty
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        for endpoint in self.endpoints:
+            metrics.LLM_ENDPOINT_UP.labels(endpoint.url).set(1)
+            metrics.LLM_ENDPOINT_OUTSTANDING.labels(endpoint.url).set(0)
+
+    def start(self) -> 'OllamaEndpointPool':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._probe_loop, name='ollama-probe', daemon=True)
+            self._thread.start()
+        return self
+
+    def _load(self, endpoint: Endpoint, model: str) -> float:
+        return endpoint.outstanding + (0 if model in endpoint.models else self._cold_penalty)
+
+    def acquire(self, model: str, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        """
+        Reserve the least loaded endpoint not in `exclude`, or None when all
+        of them have been tried; the caller must `release` it
+        """
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if not candidates:
+                return None
+            available = [endpoint for endpoint in candidates if not endpoint.ejected]
+            if available:
+                endpoint = min(available, key=lambda endpoint: self._load(endpoint, model))
+            else:
+                endpoint = min(candidates, key=lambda endpoint: endpoint.ejected_until)
+                LOGGER.warning(f'All Ollama endpoints are ejected, trying {endpoint.url} anyway')
+            endpoint.outstanding += 1
+            metrics.LLM_ENDPOINT_OUTSTANDING.labels(endpoint.url).set(endpoint.outstanding)
+            return endpoint
+
+    def release(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            metrics.LLM_ENDPOINT_OUTSTANDING.labels(endpoint.url).set(endpoint.outstanding)
+
+    def report_success(self, endpoint: Endpoint, model: str) -> None:
+        # 成功生成过说明模型已经加载, 不必等下一次探测
+        with self._lock:
+            endpoint.models.add(model)
+
+    def report_failure(self, endpoint: Endpoint, reason: str) -> None:
+        with self._lock:
+            self._eject(endpoint, reason)
+
+    def _eject(self, endpoint: Endpoint, reason: str) -> None:
+        endpoint.failures += 1
+        seconds = min(self._eject_seconds * 2 ** (endpoint.failures - 1), self._max_eject_seconds)
+        endpoint.ejected_until = time.monotonic() + seconds
+        if not endpoint.ejected:
+            LOGGER.warning(f'Ejecting Ollama endpoint {endpoint.url} for {seconds:.0f}s: {reason}')
+        endpoint.ejected = True
+        metrics.LLM_ENDPOINT_UP.labels(endpoint.url).set(0)
+
+    def _record_probe(self, endpoint: Endpoint, seconds: float, models: Optional[List[str]],
+                      error: Optional[Exception] = None) -> None:
+        with self._lock:
+            endpoint.probe_seconds = seconds
+            if error is not None:
+                self._eject(endpoint, f'probe failed: {error}')
+                return
+            endpoint.models = {_model_name(name) for name in models}
+            if seconds > self._slow_probe:
+                self._eject(endpoint, f'probe took {seconds:.2f}s')
+            elif endpoint.ejected and time.monotonic() >= endpoint.ejected_until:
+                endpoint.ejected = False
+                endpoint.failures = 0
+                metrics.LLM_ENDPOINT_UP.labels(endpoint.url).set(1)
+                LOGGER.info(f'Re-admitting Ollama endpoint {endpoint.url}')
+
+    def probe(self, endpoint: Endpoint) -> None:
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(f'{endpoint.url}/api/ps', timeout=self._probe_timeout) as res:
+                models = [model['name'] for model in json.load(res).get('models', [])]
+        except Exception as e:
+            self._record_probe(endpoint, time.monotonic() - start, None, e)
+        else:
+            self._record_probe(endpoint, time.monotonic() - start, models)
+
+    def _probe_loop(self) -> None:
+        while True:
+            for endpoint in self.endpoints:
+                self.probe(endpoint)
+            time.sleep(self._probe_interval)
+
+
+def ollama_pool() -> OllamaEndpointPool:
+    endpoints = tuple(settings.OLLAMA_ENDPOINTS)
+    config = settings.OLLAMA_ROUTING
+    return client_registry.registry.get(('ollama_pool', endpoints), lambda: OllamaEndpointPool(
+        endpoints,
+        probe_interval=config['PROBE_INTERVAL'],
+        probe_timeout=config['PROBE_TIMEOUT'],
+        slow_probe=config['SLOW_PROBE'],
+        eject_seconds=config['EJECT_SECONDS'],
+        max_eject_seconds=config['MAX_EJECT_SECONDS'],
+        cold_penalty=config['COLD_PENALTY'],
+    ).start())
+
+
+class RoutedOllamaModel(BaseModel):
+    """
+    OllamaModel spread over the endpoints in OLLAMA_ENDPOINTS.
+
+    Each call goes to the endpoint the pool picks. If it fails before the
+    first token, the endpoint is ejected and the call moves on to the next
+    one; after the first token the client already has part of the answer,
+    so errors are raised as they are.
+    """
+    def __init__(self, model: str = 'llama3.3', pool: Optional[OllamaEndpointPool] = None) -> None:
+        super().__init__()
+        self._model = model
+        self._pool = pool or ollama_pool()
+
+    def _llm(self, endpoint: Endpoint):
+        # 存活由连接池的 /api/ps 探测负责, 不在请求路径上 (可能是事件循环里) 做阻塞的健康检查
+        return client_registry.ollama_llm(self._model, endpoint.url, health_check=False)
+
+    def _next(self, tried: List[Endpoint], error: Optional[Exception]) -> Endpoint:
+        endpoint = self._pool.acquire(self._model, tried)
+        if endpoint is None:
+            raise error or RuntimeError('No Ollama endpoint configured')
+        tried.append(endpoint)
+        return endpoint
+
+    def _failed(self, endpoint: Endpoint, error: Exception) -> None:
+        LOGGER.warning(f'Ollama endpoint {endpoint.url} failed before the first token: {error}')
+        self._pool.report_failure(endpoint, str(error))
+
+    def _stream(self, start):
+        tried, error = [], None
+        while True:
+            endpoint = self._next(tried, error)
+            started = False
+            try:
+                for token in start(self._llm(endpoint)):
+                    started = True
+                    yield token
+                self._pool.report_success(endpoint, self._model)
+                return
+            except Exception as e:
+                if started:
+                    raise
+                self._failed(endpoint, e)
+                error = e
+            finally:
+                self._pool.release(endpoint)
+
+    async def _astream(self, start):
+        tried, error = [], None
+        while True:
+            endpoint = self._next(tried, error)
+            started = False
+            try:
+                async for token in start(self._llm(endpoint)):
+                    started = True
+                    yield token
+                self._pool.report_success(endpoint, self._model)
+                return
+            except Exception as e:
+                if started:
+                    raise
+                self._failed(endpoint, e)
+                error = e
+            finally:
+                self._pool.release(endpoint)
+
+    def chat_response(self, message: str) -> str:
+        tried, error = [], None
+        while True:
+            endpoint = self._next(tried, error)
+            try:
+                res = self._llm(endpoint).invoke(message)
+                self._pool.report_success(endpoint, self._model)
+                return res
+            except Exception as e:
+                self._failed(endpoint, e)
+                error = e
+            finally:
+                self._pool.release(endpoint)
+
+    def chat_stream(self, message: str):
+        return self._stream(lambda llm: llm.stream(message))
+
+    def achat_stream(self, message: str):
+        return self._astream(lambda llm: llm.astream(message))
+
+    def chat_stream_rag(self, message, docs):
+        return self._stream(lambda llm: rag_chain(llm).stream({"context": docs, "question": message}))
+
+    def achat_stream_rag(self, message, docs):
+        return self._astream(lambda llm: rag_chain(llm).astream({"context": docs, "question": message}))
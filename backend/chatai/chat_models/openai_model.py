@@ -1,13 +1,38 @@
-import os
-os.environ["OPENAI_API_KEY"] = ""   # TODO get activate api key
+from typing import Optional
 
-from langchain_openai.chat_models import ChatOpenAI
+from django.conf import settings
+from . import client_registry
 from .base_model import BaseModel
+from .ollama_model import rag_chain
 
 class OpenAIModel(BaseModel):
+    """
+    Chat model behind an OpenAI-compatible API (OpenAI, vLLM, llama.cpp
+    server, ...), configured through settings.OPENAI
+    """
+    def __init__(self, model: Optional[str] = None) -> None:
+        super().__init__()
+        self._llm = client_registry.openai_chat(model or settings.OPENAI['MODEL'])
 
     def chat_response(self, message: str) -> str:
-        llm = ChatOpenAI(model="gpt-3.5-turbo")
-        res = llm.invoke(message)
-        
-        return res
\ No newline at end of file
+        res = self._llm.invoke(message)
+        return res.content
+
+    def chat_stream(self, message: str):
+        for chunk in self._llm.stream(message):
+            if chunk.content:
+                yield chunk.content
+
+    async def achat_stream(self, message: str):
+        async for chunk in self._llm.astream(message):
+            if chunk.content:
+                yield chunk.content
+
+    def chat_stream_rag(self, message, docs):
+        res = rag_chain(self._llm).stream({"context": docs, "question": message})
+        for token in res:
+            yield token
+
+    async def achat_stream_rag(self, message, docs):
+        async for token in rag_chain(self._llm).astream({"context": docs, "question": message}):
+            yield token
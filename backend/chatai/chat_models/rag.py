@@ -1,45 +1,144 @@
+import hashlib
+import heapq
 import logging
 import os
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from langchain_chroma import Chroma
-from langchain_elasticsearch import ElasticsearchStore
-from langchain_ollama import OllamaEmbeddings
+from langchain_core.documents import Document
+
+from backend.caches import TTLCache
+from chatai.metrics import stage
+from . import client_registry
+from .knowledge_version import get_version
+from .numpy_store import open_store
 
 LOGGER = logging.getLogger(__name__)
 
 class RAG():
-    embeddings = OllamaEmbeddings(model="nomic-embed-text")
     similarity_threshold = 0.75
+    # 一级缓存: 归一化后的问题 -> 问题向量
+    query_embeddings = TTLCache(settings.RAG_QUERY_CACHE['MAX_ENTRIES'], settings.RAG_QUERY_CACHE['TTL'])
+    # 已打开的 Chroma 目录, 以知识库版本区分, 文件重新上传后自动换新
+    stores = TTLCache(settings.RAG_SEARCH['MAX_OPEN_STORES'], settings.RAG_SEARCH['STORE_TTL'])
+    executor = ThreadPoolExecutor(max_workers=settings.RAG_SEARCH['WORKERS'], thread_name_prefix='rag-search')
+
+    @staticmethod
+    def get_embeddings():
+        # 每次从 registry 取, 健康检查失败后重建的客户端才会被用上
+        return client_registry.ollama_embeddings("nomic-embed-text")
+
+    @staticmethod
+    def _normalize(query: str) -> str:
+        return ' '.join(unicodedata.normalize('NFKC', query).split()).lower()
+
+    @staticmethod
+    def embed_query(query: str) -> List[float]:
+        with stage('embed_query'):
+            key = RAG._normalize(query)
+            embedding = RAG.query_embeddings.get(key)
+            if embedding is None:
+                embedding = RAG.get_embeddings().embed_query(query)
+                RAG.query_embeddings.set(key, embedding)
+        return embedding
+
+    @staticmethod
+    def _get_store(folder_path: str, version: int) -> Chroma:
+        key = (folder_path, version)
+        store = RAG.stores.get(key)
+        if store is None:
+            store = Chroma(persist_directory=folder_path, embedding_function=RAG.get_embeddings())
+            RAG.stores.set(key, store)
+        return store
+
+    @staticmethod
+    def _search_folder(folder_path: str, version: int, embedding: List[float], top_k: int):
+        store = RAG._get_store(folder_path, version)
+        return store.similarity_search_by_vector_with_relevance_scores(embedding, k=top_k)
 
     @staticmethod
     def search_documents(query: str, db_dir: str, top_k: int = 5):
         # 用户还没上传任何知识库
         if not os.path.exists(db_dir):
             return []
-        all_documents = []
-        # 遍历目录中的所有用户文档
-        for file_name in os.listdir(db_dir):
-            folder_path = os.path.join(db_dir, file_name)
-            if os.path.isdir(folder_path):
-                vector_store = Chroma(persist_directory=folder_path, embedding_function=RAG.embeddings)
-                search_results = vector_store.similarity_search(query, k=top_k)
-                all_documents.extend(search_results)
-
-        return all_documents
+        folders = [os.path.join(db_dir, name) for name in os.listdir(db_dir)
+                   if os.path.isdir(os.path.join(db_dir, name))]
+        if not folders:
+            return []
+
+        version = get_version(db_dir.split('/')[-2])
+        embedding = RAG.embed_query(query)
+        # 并行检索每个文档目录, 再按距离合并出全局 top_k
+        with stage('vector_search'):
+            futures = [RAG.executor.submit(RAG._search_folder, folder, version, embedding, top_k) for folder in folders]
+            results = [item for future in futures for item in future.result()]
+        best = heapq.nsmallest(top_k, results, key=lambda item: item[1])
+
+        for doc, distance in best:
+            doc.metadata['score'] = 1 / (1 + distance)
+        return [doc for doc, _ in best]
+
+    @staticmethod
+    async def asearch_documents(query: str, db_dir: str, top_k: int = 5):
+        return await sync_to_async(RAG.search_documents, thread_sensitive=False)(query, db_dir, top_k)
     
 class ElasticSearchRAG(RAG):
+    # 二级缓存: (索引, 知识库版本, 问题向量, top_k) -> [(文档id, 得分, 内容, 元数据)]
+    search_results = TTLCache(settings.RAG_QUERY_CACHE['MAX_ENTRIES'], settings.RAG_QUERY_CACHE['TTL'])
+
+    @staticmethod
+    def _get_index(index_name: str):
+        return client_registry.elasticsearch_store(index_name, RAG.get_embeddings())
+
+    @staticmethod
+    def search_documents(query: str, db_dir: str, top_k: int = 5):
+        index_name = db_dir.split('/')[-2]
+        embedding = RAG.embed_query(query)
+        key = (index_name, get_version(index_name), hashlib.sha1(array('f', embedding).tobytes()).hexdigest(), top_k)
+
+        with stage('vector_search'):
+            hits = ElasticSearchRAG.search_results.get(key)
+            if hits is None:
+                es = ElasticSearchRAG._get_index(index_name)
+                results = es.similarity_search_by_vector_with_relevance_scores(embedding, k=top_k)
+                hits = [(doc.id, score, doc.page_content, doc.metadata) for doc, score in results]
+                ElasticSearchRAG.search_results.set(key, hits)
+        LOGGER.debug(f'Search results of {index_name}: {hits}')
+
+        return [Document(id=doc_id, page_content=content, metadata={**metadata, 'score': score})
+                for doc_id, score, content, metadata in hits]
+
+    @staticmethod
+    async def asearch_documents(query: str, db_dir: str, top_k: int = 5):
+        return await sync_to_async(ElasticSearchRAG.search_documents, thread_sensitive=False)(query, db_dir, top_k)
+
+
+class NumpyRAG(RAG):
     @staticmethod
     def search_documents(query: str, db_dir: str, top_k: int = 5):
-        user = db_dir.split('/')[-2]
-        es = ElasticsearchStore(
-            index_name=user,
-            embedding=RAG.embeddings,
-            es_url="https://localhost:9200/",
-            es_user='elastic',
-            es_password='e4nkJk6FHIFUKfIukRhn',
-            es_params={'ca_certs': False, 'verify_certs': False}
-        )
-        all_documents = es.search(query, search_type="similarity")
-        LOGGER.error('test')
-        LOGGER.error(all_documents)
-        return all_documents
\ No newline at end of file
+        store_dir = os.path.join(os.path.dirname(db_dir), 'numpy')
+        if not os.path.exists(store_dir):
+            return []
+        embedding = RAG.embed_query(query)
+        with stage('vector_search'):
+            results = open_store(store_dir).search(embedding, top_k)
+        for doc, score in results:
+            doc.metadata['score'] = score
+        return [doc for doc, _ in results]
+
+    @staticmethod
+    async def asearch_documents(query: str, db_dir: str, top_k: int = 5):
+        return await sync_to_async(NumpyRAG.search_documents, thread_sensitive=False)(query, db_dir, top_k)
+
+
+def get_rag():
+    return {
+        'chroma': RAG,
+        'elasticsearch': ElasticSearchRAG,
+        'numpy': NumpyRAG,
+    }[settings.VECTOR_BACKEND]
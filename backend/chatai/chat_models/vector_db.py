@@ -1,13 +1,23 @@
 import chromadb.api
 import os
-from typing import List
+import uuid
+from typing import List, Optional
 from django.conf import settings
 from langchain_chroma import Chroma
-from langchain_elasticsearch import ElasticsearchStore
-from langchain_ollama import OllamaEmbeddings
+
+from . import client_registry
+from .embedding_cache import cached_embeddings
+from .knowledge_version import bump_version
+from .numpy_store import open_store
 
 class VectoreDatabase():
-    embeddings = OllamaEmbeddings(model="nomic-embed-text")
+    @staticmethod
+    def get_embeddings():
+        # 文档块的向量按内容哈希缓存, 重复上传时只计算变化的部分; 嵌入客户端重建时缓存包装随之重建
+        embeddings = client_registry.ollama_embeddings("nomic-embed-text")
+        return client_registry.registry.get(('cached_embeddings', "nomic-embed-text", id(embeddings)),
+                                            lambda: cached_embeddings(embeddings, "nomic-embed-text"),
+                                            depends_on=(embeddings,))
 
     @staticmethod
     def get_db_dir(user):
@@ -15,24 +25,72 @@ class VectoreDatabase():
         return path
 
     @staticmethod
-    def store(docs: List, persist_path: str):
+    def store(docs: List, persist_path: str, ids: Optional[List[str]] = None):
         chromadb.api.client.SharedSystemClient.clear_system_cache()
         vectordb = Chroma.from_documents(documents=docs, 
-                                         embedding=VectoreDatabase.embeddings, 
-                                         persist_directory=persist_path)
+                                         embedding=VectoreDatabase.get_embeddings(), 
+                                         persist_directory=persist_path,
+                                         ids=ids)
         vectordb = None # 释放内存
+        bump_version(persist_path.split('/')[-3])
+
+    @staticmethod
+    def flush(persist_path: str):
+        # 一批写入结束后调用, 只有需要落盘索引的后端才实现
+        pass
+
+    @staticmethod
+    def delete(ids: List[str], persist_path: str):
+        if not os.path.exists(persist_path):
+            return
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+        vectordb = Chroma(persist_directory=persist_path, embedding_function=VectoreDatabase.get_embeddings())
+        vectordb.delete(ids)
+        vectordb = None
+        bump_version(persist_path.split('/')[-3])
     
 class ElasticSearchVDB(VectoreDatabase):
     @staticmethod
-    def store(docs: List, persist_path: str):
+    def store(docs: List, persist_path: str, ids: Optional[List[str]] = None):
+        user = persist_path.split('/')[-3]
+        vectordb = client_registry.elasticsearch_store(user, VectoreDatabase.get_embeddings())
+        vectordb.add_documents(docs, ids=ids)
+        bump_version(user)
+
+    @staticmethod
+    def delete(ids: List[str], persist_path: str):
         user = persist_path.split('/')[-3]
-        vectordb = ElasticsearchStore.from_documents(
-            docs,
-            index_name=user,
-            embedding=VectoreDatabase.embeddings,
-            es_url="https://localhost:9200/",
-            es_user='elastic',
-            es_password='e4nkJk6FHIFUKfIukRhn',
-            es_params={'ca_certs': False, 'verify_certs': False}
-        )
-        vectordb = None
\ No newline at end of file
+        vectordb = client_registry.elasticsearch_store(user, VectoreDatabase.get_embeddings())
+        vectordb.delete(ids)
+        bump_version(user)
+
+class NumpyVDB(VectoreDatabase):
+    @staticmethod
+    def get_store_dir(persist_path: str):
+        # 每个用户一个向量文件, 与 vector 目录同级
+        return os.path.join(os.path.dirname(os.path.dirname(persist_path)), 'numpy')
+
+    @staticmethod
+    def store(docs: List, persist_path: str, ids: Optional[List[str]] = None):
+        ids = ids or [uuid.uuid4().hex for _ in docs]
+        texts = [doc.page_content for doc in docs]
+        vectors = VectoreDatabase.get_embeddings().embed_documents(texts)
+        open_store(NumpyVDB.get_store_dir(persist_path)).add(ids, texts, [doc.metadata for doc in docs], vectors)
+        bump_version(persist_path.split('/')[-3])
+
+    @staticmethod
+    def flush(persist_path: str):
+        open_store(NumpyVDB.get_store_dir(persist_path)).flush()
+
+    @staticmethod
+    def delete(ids: List[str], persist_path: str):
+        open_store(NumpyVDB.get_store_dir(persist_path)).delete(ids)
+        bump_version(persist_path.split('/')[-3])
+
+
+def get_vector_db():
+    return {
+        'chroma': VectoreDatabase,
+        'elasticsearch': ElasticSearchVDB,
+        'numpy': NumpyVDB,
+    }[settings.VECTOR_BACKEND]
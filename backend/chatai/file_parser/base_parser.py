@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
+from typing import Iterable, Iterator
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 
 class BaseParser(ABC):
     def __init__(self, chunk_size=400, chunk_overlap=50):
@@ -7,10 +9,32 @@ class BaseParser(ABC):
         self._chunk_size = chunk_size
         self._chunk_overlap = chunk_overlap
 
+    def _splitter(self):
+        return RecursiveCharacterTextSplitter(chunk_size=self._chunk_size, chunk_overlap=self._chunk_overlap)
+
     def split_docs(self, docs):
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=self._chunk_size, chunk_overlap=self._chunk_overlap)
-        return text_splitter.split_documents(docs)
+        return self._splitter().split_documents(docs)
+
+    def iter_chunks(self, pages: Iterable[Document]) -> Iterator[Document]:
+        """
+        Split pages one at a time, same chunks as split_docs without holding every page
+        """
+        text_splitter = self._splitter()
+        for page in pages:
+            yield from text_splitter.split_documents([page])
     
     @abstractmethod
+    def load(self, file_path: str):
+        """
+        Load the file as a list of page documents, before splitting
+        """
+        pass
+
+    def lazy_load(self, file_path: str) -> Iterator[Document]:
+        """
+        Yield page documents one by one, parsers that can stream should override it
+        """
+        yield from self.load(file_path)
+
     def parse(self, file_path: str):
-        pass
\ No newline at end of file
+        return self.split_docs(self.load(file_path))
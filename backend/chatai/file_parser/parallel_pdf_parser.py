@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+from .pdf_parser import PDFParser
+from .registry import register_parser
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    # 整个进程共用一个池, 不必每个文件重新拉起子进程; 用 spawn 而不是 fork,
+    # 调用方是 worker 的线程, fork 会把其他线程持有的锁一起复制到子进程里
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[workers] = pool
+        return pool
+
+
+def _purge_metadata(metadata: dict) -> dict:
+    """
+    Document info normalized the way PyPDFLoader does it: keys without the
+    leading '/' and lower-cased, dates as ISO strings, other values as str
+    """
+    # 与 langchain_community 的私有函数 _purge_metadata 保持一致, 复制到这里以免其改名或删除
+    purged = {}
+    for key, value in metadata.items():
+        if type(value) not in (str, int):
+            value = str(value)
+        key = (key[1:] if key.startswith('/') else key).lower()
+        if key in ('creationdate', 'moddate'):
+            try:
+                purged[key] = datetime.strptime(value.replace("'", ''), 'D:%Y%m%d%H%M%S%z').isoformat('T')
+            except ValueError:
+                purged[key] = value
+        elif key in ('page_count', 'file_path'):
+            purged[{'page_count': 'total_pages', 'file_path': 'source'}[key]] = value
+            purged[key] = value
+        elif isinstance(value, str):
+            purged[key] = value.strip()
+        else:
+            purged[key] = value
+    return purged
+
+
+def _extract_pages(file_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    # 在子进程中执行, 每个进程单独打开文件
+    reader = PdfReader(file_path)
+    return [(index, reader.pages[index].extract_text().strip()) for index in range(start, end)]
+
+
+@register_parser(extensions=('.pdf',), mime_types=('application/pdf',))
+class ParallelPDFParser(PDFParser):
+    """
+    Extracts page ranges of large PDFs on a shared process pool and yields
+    the pages back in order with the same metadata as PDFParser (document
+    info, total_pages, page, page_label). At most two ranges per worker are
+    in flight, so memory stays bounded while the consumer embeds earlier
+    pages.
+    """
+    def __init__(self, workers: int = None, pages_per_task: int = None, min_pages: int = None, **kwargs):
+        super().__init__(**kwargs)
+        config = settings.PDF_PARALLEL_EXTRACT
+        if workers is None and not config['ENABLED']:
+            workers = 1
+        self._workers = workers or config['WORKERS'] or os.cpu_count()
+        self._pages_per_task = pages_per_task or config['PAGES_PER_TASK']
+        self._min_pages = config['MIN_PAGES'] if min_pages is None else min_pages
+
+    def lazy_load(self, file_path):
+        file_path = str(file_path)
+        reader = PdfReader(file_path)
+        total = len(reader.pages)
+        if self._workers <= 1 or total < self._min_pages:
+            yield from super().lazy_load(file_path)
+            return
+
+        # 与 PyPDFLoader 相同的文档级元数据
+        doc_metadata = _purge_metadata({'producer': 'PyPDF', 'creator': 'PyPDF', 'creationdate': ''}
+                                       | dict(reader.metadata or {})
+                                       | {'source': file_path, 'total_pages': total})
+        # reader.page_labels 每次访问都要重新计算全部页码, 只在这里取一次
+        labels = reader.page_labels
+        ranges = deque((start, min(start + self._pages_per_task, total))
+                       for start in range(0, total, self._pages_per_task))
+        pool = _get_pool(self._workers)
+        in_flight = deque()
+        try:
+            while ranges or in_flight:
+                while ranges and len(in_flight) < self._workers * 2:
+                    start, end = ranges.popleft()
+                    in_flight.append(pool.submit(_extract_pages, file_path, start, end))
+                for index, text in in_flight.popleft().result():
+                    yield Document(page_content=text,
+                                   metadata={**doc_metadata, 'page': index, 'page_label': labels[index]})
+        finally:
+            # 消费方提前停止时, 不让还没开始的页段继续占着共用的池
+            for future in in_flight:
+                future.cancel()
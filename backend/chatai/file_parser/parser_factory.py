@@ -1,16 +1,18 @@
 import os
-from typing import Type
+from typing import Optional, Type
 from .base_parser import BaseParser
-from .pdf_parser import PDFParser
+from .registry import lookup_parser, register_parser
+# 导入内置解析器模块以完成注册
+from . import parallel_pdf_parser, text_parser  # noqa: F401
 
 class ParserFactory:
-    @staticmethod
-    def get_parser(file_path: str) -> Type[BaseParser]:
-        # 获取文件扩展名
-        file_extension = os.path.splitext(file_path)[1].lower()
+    register = staticmethod(register_parser)
 
-        # 根据文件扩展名选择对应的Parser
-        if file_extension == '.pdf':
-            return PDFParser
-        else:
+    @staticmethod
+    def get_parser(file_path: str, mime_type: Optional[str] = None) -> Type[BaseParser]:
+        # 先按扩展名, 再按 MIME 类型查找已注册的 Parser
+        parser_cls = lookup_parser(file_path, mime_type)
+        if parser_cls is None:
+            file_extension = os.path.splitext(str(file_path))[1].lower()
             raise ValueError(f"不支持的文件类型: {file_extension}")
+        return parser_cls
@@ -3,9 +3,9 @@ from .base_parser import BaseParser
 
 class PDFParser(BaseParser):
 
-    def parse(self, file_path):
+    def load(self, file_path):
+        return list(self.lazy_load(file_path))
+
+    def lazy_load(self, file_path):
         loader=PyPDFLoader(file_path)
-        docs = loader.load()
-        split_docs = self.split_docs(docs)
-        return split_docs
-        
\ No newline at end of file
+        return loader.lazy_load()
@@ -0,0 +1,35 @@
+import mimetypes
+import os
+from typing import Dict, Iterable, Optional, Type
+
+from .base_parser import BaseParser
+
+_BY_EXTENSION: Dict[str, Type[BaseParser]] = {}
+_BY_MIME_TYPE: Dict[str, Type[BaseParser]] = {}
+
+
+def register_parser(extensions: Iterable[str] = (), mime_types: Iterable[str] = ()):
+    """
+    Class decorator registering a BaseParser subclass for file extensions
+    (with the dot, e.g. '.md') and MIME types. Later registrations win.
+    """
+    def decorator(parser_cls: Type[BaseParser]) -> Type[BaseParser]:
+        for extension in extensions:
+            _BY_EXTENSION[extension.lower()] = parser_cls
+        for mime_type in mime_types:
+            _BY_MIME_TYPE[mime_type.lower()] = parser_cls
+        return parser_cls
+    return decorator
+
+
+def lookup_parser(file_path: str, mime_type: Optional[str] = None) -> Optional[Type[BaseParser]]:
+    parser_cls = _BY_EXTENSION.get(os.path.splitext(str(file_path))[1].lower())
+    if parser_cls is None:
+        mime_type = mime_type or mimetypes.guess_type(str(file_path))[0]
+        if mime_type:
+            parser_cls = _BY_MIME_TYPE.get(mime_type.split(';')[0].strip().lower())
+    return parser_cls
+
+
+def supported_extensions():
+    return sorted(_BY_EXTENSION)
@@ -0,0 +1,172 @@
+import codecs
+import mmap
+import os
+from html import parser as html_parser
+from typing import Iterator, List, Tuple
+
+from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+from .base_parser import BaseParser
+from .registry import register_parser
+
+
+@register_parser(extensions=('.txt', '.text', '.log', '.csv'), mime_types=('text/plain', 'text/csv'))
+class TextParser(BaseParser):
+    """
+    Decodes the memory-mapped file incrementally and yields it as segments
+    of about `segment_size` characters cut at paragraph or line breaks, so
+    neither the file nor the decoded text is ever held as one string.
+
+    The encoding comes from a BOM, else the first of `encodings` that
+    decodes the whole file; files none of them decode are rejected rather
+    than indexed with replacement characters. Segments carry no 'page',
+    their positions shift whenever earlier text changes.
+    """
+    # 优先在这些位置切分
+    _boundaries = ('\n\n', '\n')
+    # UTF-32 LE 的 BOM 以 UTF-16 LE 的 BOM 开头, 需先判断
+    _boms = ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'),
+             (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+    def __init__(self, segment_size: int = 64 * 1024, encodings: Tuple[str, ...] = ('utf-8', 'gb18030'), **kwargs):
+        super().__init__(**kwargs)
+        self._segment_size = segment_size
+        self._encodings = encodings
+
+    def _blocks(self, mm: mmap.mmap) -> Iterator[bytes]:
+        for start in range(0, len(mm), self._segment_size):
+            yield mm[start:start + self._segment_size]
+
+    def _decoder(self, mm: mmap.mmap, file_path: str):
+        for bom, encoding in self._boms:
+            if mm[:len(bom)] == bom:
+                return codecs.getincrementaldecoder(encoding)()
+        for encoding in self._encodings:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            try:
+                for block in self._blocks(mm):
+                    decoder.decode(block)
+                decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                continue
+            return codecs.getincrementaldecoder(encoding)()
+        raise ValueError(f'无法识别文件编码: {os.path.basename(file_path)}, 已尝试 {", ".join(self._encodings)}')
+
+    def _cut(self, text: str) -> int:
+        end = self._segment_size
+        for boundary in self._boundaries:
+            position = text.rfind(boundary, end // 2, end)
+            if position != -1:
+                return position + len(boundary)
+        return end
+
+    def _segments(self, file_path: str) -> Iterator[str]:
+        with open(file_path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                decoder = self._decoder(mm, file_path)
+                text = ''
+                for block in self._blocks(mm):
+                    text += decoder.decode(block)
+                    while len(text) > self._segment_size:
+                        end = self._cut(text)
+                        yield text[:end]
+                        text = text[end:]
+                yield text + decoder.decode(b'', final=True)
+
+    def lazy_load(self, file_path) -> Iterator[Document]:
+        file_path = str(file_path)
+        for text in self._segments(file_path):
+            if text.strip():
+                yield Document(page_content=text, metadata={'source': file_path})
+
+    def load(self, file_path) -> List[Document]:
+        return list(self.lazy_load(file_path))
+
+
+@register_parser(extensions=('.md', '.markdown'), mime_types=('text/markdown', 'text/x-markdown'))
+class MarkdownParser(TextParser):
+    # 优先在标题前切分
+    _boundaries = ('\n#', '\n\n', '\n')
+
+    def _cut(self, text: str) -> int:
+        end = super()._cut(text)
+        # 在 "\n#" 处切分时让 "#" 留给下一段
+        if text[end - 1] == '#':
+            end -= 1
+        return end
+
+    def _splitter(self):
+        return RecursiveCharacterTextSplitter.from_language(Language.MARKDOWN,
+                                                            chunk_size=self._chunk_size,
+                                                            chunk_overlap=self._chunk_overlap)
+
+
+class _TextExtractor(html_parser.HTMLParser):
+    _skipped = {'script', 'style', 'noscript', 'template', 'head'}
+    _blocks = {'p', 'div', 'br', 'li', 'tr', 'section', 'article', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.size = 0
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._skipped:
+            self._skip_depth += 1
+        elif tag in self._blocks:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self._skipped and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self._blocks:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+            self.size += len(data)
+
+    def take(self, final: bool = False) -> str:
+        text = ''.join(self.parts)
+        # 未结束时只取到最后一个换行, 避免把一句话切成两段
+        cut = len(text) if final else text.rfind('\n')
+        if cut <= 0:
+            cut = len(text)
+        self.parts = [text[cut:]] if cut < len(text) else []
+        self.size = len(text) - cut
+        return text[:cut]
+
+
+@register_parser(extensions=('.html', '.htm', '.xhtml'), mime_types=('text/html', 'application/xhtml+xml'))
+class HTMLParser(TextParser):
+    """
+    Feeds the memory-mapped file to an incremental HTML tokenizer block by
+    block and yields the visible text whenever `segment_size` characters
+    have accumulated.
+    """
+    def _segment(self, text: str, file_path: str) -> Document:
+        lines = (line.strip() for line in text.splitlines())
+        return Document(page_content='\n'.join(line for line in lines if line), metadata={'source': file_path})
+
+    def lazy_load(self, file_path) -> Iterator[Document]:
+        file_path = str(file_path)
+        extractor = _TextExtractor()
+        with open(file_path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                decoder = self._decoder(mm, file_path)
+                for block in self._blocks(mm):
+                    extractor.feed(decoder.decode(block))
+                    if extractor.size >= self._segment_size:
+                        yield self._segment(extractor.take(), file_path)
+        extractor.feed(decoder.decode(b'', final=True))
+        extractor.close()
+        text = extractor.take(final=True)
+        if text.strip():
+            yield self._segment(text, file_path)
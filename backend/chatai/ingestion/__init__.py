@@ -0,0 +1,2 @@
+from .jobs import IngestJob, JobCancelled
+from .manifest import ChunkManifest
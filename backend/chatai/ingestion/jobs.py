@@ -0,0 +1,205 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Optional
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+QUEUE_KEY = 'ingest:queue'
+JOB_KEY = 'ingest:job:{}'
+# 每个 worker 正在处理的任务, worker 挂掉后由其他 worker 放回队列
+PROCESSING_KEY = 'ingest:processing:{}'
+# worker 存活标记, 由心跳续期
+WORKER_KEY = 'ingest:worker:{}'
+# 文件路径 -> 最近一次提交的任务
+FILE_KEY = 'ingest:file:{}'
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class IngestJob:
+    """
+    Knowledge ingestion job stored as a Redis hash.
+
+    The web process creates the job and pushes its id onto QUEUE_KEY; workers
+    started with `manage.py ingest_worker` move ids into their own processing
+    list and report progress back into the hash, which the status endpoint
+    reads. Each run of a job gets an attempt token; a worker whose token is
+    no longer the job's current one has been cancelled or superseded.
+    """
+    _INT_FIELDS = ('user_id', 'attempts', 'pages', 'chunks', 'embedded', 'unchanged', 'removed')
+    _FLOAT_FIELDS = ('created_at', 'started_at', 'finished_at')
+
+    def __init__(self, job_id: str) -> None:
+        self.id = job_id
+        self._key = JOB_KEY.format(job_id)
+        self.attempt = ''
+
+    @staticmethod
+    def _redis():
+        return get_redis_connection('default')
+
+    @classmethod
+    def submit(cls, user, file_path: str, vector_path: str, mime_type: Optional[str] = None) -> 'IngestJob':
+        job = cls(uuid.uuid4().hex)
+        redis = cls._redis()
+        redis.hset(job._key, mapping={
+            'user_id': user.id,
+            'file_path': str(file_path),
+            'vector_path': str(vector_path),
+            'mime_type': mime_type or '',
+            'status': QUEUED,
+            'attempts': 0,
+            'pages': 0,
+            'chunks': 0,
+            'embedded': 0,
+            'unchanged': 0,
+            'removed': 0,
+            'error': '',
+            'attempt': '',
+            'created_at': time.time(),
+            'started_at': 0,
+            'finished_at': 0,
+        })
+        redis.expire(job._key, settings.INGEST_JOB_TTL)
+        redis.set(FILE_KEY.format(file_path), job.id, ex=settings.INGEST_JOB_TTL)
+        redis.lpush(QUEUE_KEY, job.id)
+        return job
+
+    @classmethod
+    def active_for(cls, file_path: str) -> Optional['IngestJob']:
+        """
+        The queued or running job of a file, if any
+        """
+        job_id = cls._redis().get(FILE_KEY.format(file_path))
+        if job_id is None:
+            return None
+        job = cls(job_id.decode())
+        return job if job.status in (QUEUED, RUNNING) else None
+
+    @classmethod
+    def get(cls, job_id: str, user=None) -> Optional['IngestJob']:
+        job = cls(job_id)
+        user_id = cls._redis().hget(job._key, 'user_id')
+        if user_id is None or (user is not None and int(user_id) != user.id):
+            return None
+        return job
+
+    @staticmethod
+    def worker_id() -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @classmethod
+    def heartbeat(cls, worker_id: str) -> None:
+        cls._redis().set(WORKER_KEY.format(worker_id), 1, ex=settings.INGEST_WORKER_TTL)
+
+    @classmethod
+    def pop(cls, worker_id: str, timeout: int = 5) -> Optional['IngestJob']:
+        # 出队的同时放进自己的处理列表, 处理完再 ack, worker 中途挂掉任务也不会丢
+        job_id = cls._redis().blmove(QUEUE_KEY, PROCESSING_KEY.format(worker_id), timeout, 'RIGHT', 'LEFT')
+        return cls(job_id.decode()) if job_id else None
+
+    def ack(self, worker_id: str) -> None:
+        self._redis().lrem(PROCESSING_KEY.format(worker_id), 1, self.id)
+
+    @classmethod
+    def recover_stale(cls) -> int:
+        """
+        Put the jobs of workers whose heartbeat expired back on the queue, or
+        fail them once they used up their attempts; returns how many
+        """
+        redis = cls._redis()
+        prefix = PROCESSING_KEY.format('')
+        recovered = 0
+        for key in redis.scan_iter(PROCESSING_KEY.format('*')):
+            worker_id = key.decode()[len(prefix):]
+            if redis.exists(WORKER_KEY.format(worker_id)):
+                continue
+            while (job_id := redis.lindex(key, -1)) is not None:
+                job = cls(job_id.decode())
+                # 先改状态再放回队列, 否则别的 worker 可能取到仍是 running 的任务而跳过它
+                if job.status == RUNNING:
+                    if int(job.field('attempts') or 0) >= settings.INGEST_MAX_ATTEMPTS:
+                        job.set(status=FAILED, error='ingest worker died', finished_at=time.time(), attempt='')
+                    else:
+                        job.reset()
+                if job.status == QUEUED:
+                    redis.rpoplpush(key, QUEUE_KEY)
+                else:
+                    redis.rpop(key)
+                LOGGER.warning(f'Recovered ingest job {job.id} from dead worker {worker_id}')
+                recovered += 1
+        return recovered
+
+    def info(self) -> Dict:
+        raw = {k.decode(): v.decode() for k, v in self._redis().hgetall(self._key).items()}
+        data = {'job_id': self.id, 'status': raw['status'], 'error': raw['error'],
+                'file_name': raw['file_path'].replace('\\', '/').split('/')[-1]}
+        data.update({k: int(raw[k]) for k in self._INT_FIELDS})
+        data.update({k: float(raw[k]) for k in self._FLOAT_FIELDS})
+
+        started = data['started_at']
+        end = data['finished_at'] or time.time()
+        data['chunks_per_second'] = round(data['embedded'] / (end - started), 2) if started and end > started else 0.0
+        return data
+
+    def field(self, name: str) -> str:
+        value = self._redis().hget(self._key, name)
+        return value.decode() if value is not None else ''
+
+    @property
+    def status(self) -> str:
+        return self.field('status')
+
+    def set(self, **fields) -> None:
+        self._redis().hset(self._key, mapping=fields)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        self._redis().hincrby(self._key, name, amount)
+
+    def start(self) -> None:
+        self.attempt = uuid.uuid4().hex
+        self.set(status=RUNNING, attempt=self.attempt, started_at=time.time(), finished_at=0, error='')
+
+    def is_current(self) -> bool:
+        # 被取消, 或取消后又被重新排队 (另一个 worker 已开始新的一次), 当前 worker 都应放弃
+        status, attempt = self._redis().hmget(self._key, 'status', 'attempt')
+        return status == RUNNING.encode() and (attempt or b'').decode() == self.attempt
+
+    def check_cancelled(self) -> None:
+        if not self.is_current():
+            raise JobCancelled(self.id)
+
+    def cancel(self) -> bool:
+        if self.status not in (QUEUED, RUNNING):
+            return False
+        # 运行中的任务由 worker 在下一批次前检查状态后退出
+        self.set(status=CANCELLED, finished_at=time.time())
+        return True
+
+    def retry(self) -> bool:
+        if self.status not in (FAILED, CANCELLED):
+            return False
+        self.requeue()
+        return True
+
+    def reset(self) -> None:
+        self.set(status=QUEUED, error='', pages=0, chunks=0, embedded=0, unchanged=0, removed=0,
+                 started_at=0, finished_at=0, attempt='')
+
+    def requeue(self) -> None:
+        self.reset()
+        self._redis().lpush(QUEUE_KEY, self.id)
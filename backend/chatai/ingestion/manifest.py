@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Set
+
+from langchain_core.documents import Document
+
+
+class ChunkManifest:
+    """
+    Ids of the chunks currently indexed for one knowledge file, stored as
+    JSON next to the user's vector directory.
+
+    Chunk ids are derived from the file name, the chunk text and the
+    metadata cited in answers (plus an occurrence counter for repeated
+    chunks), so re-parsing an edited file gives the same id for every
+    unchanged chunk and only the difference has to be embedded or deleted.
+    Text that moved to another page gets a new id, and with it the new page.
+    """
+    CITATION_KEYS = ('page', 'page_label')
+    def __init__(self, vector_path: str) -> None:
+        vector_path = Path(vector_path)
+        self._path = vector_path.parent.parent / 'manifest' / f'{vector_path.name}.json'
+        self._source = vector_path.name
+        self._seen = Counter()
+
+    def load(self) -> Set[str]:
+        if not self._path.exists():
+            return set()
+        with open(self._path, encoding='utf-8') as f:
+            return set(json.load(f)['ids'])
+
+    def assign_ids(self, docs: Iterable[Document]) -> List[str]:
+        ids = []
+        for doc in docs:
+            citation = json.dumps([doc.metadata.get(key) for key in self.CITATION_KEYS], default=str)
+            digest = hashlib.sha256(f'{self._source}\0{citation}\0{doc.page_content}'.encode('utf-8')).hexdigest()[:40]
+            ids.append(f'{digest}-{self._seen[digest]}')
+            self._seen[digest] += 1
+        return ids
+
+    def save(self, ids: Iterable[str]) -> None:
+        os.makedirs(self._path.parent, exist_ok=True)
+        tmp_path = self._path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'ids': list(ids)}, f)
+        os.replace(tmp_path, self._path)
+
+    def delete(self) -> None:
+        if self._path.exists():
+            os.remove(self._path)
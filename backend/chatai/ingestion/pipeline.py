@@ -0,0 +1,86 @@
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from langchain_core.documents import Document
+
+from chatai.file_parser.base_parser import BaseParser
+from chatai.metrics import timed_iter
+
+_DONE = object()
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _observed(pages: Iterable[Document], on_page: Callable[[Document], None]) -> Iterator[Document]:
+    for page in pages:
+        on_page(page)
+        yield page
+
+
+class IngestPipeline:
+    """
+    pages -> chunks -> embedding batches -> vector store upserts.
+
+    A producer thread parses and splits the file lazily and hands batches to
+    the calling thread through a bounded queue, so at most `queue_size`
+    batches plus the page being split are in memory whatever the file size,
+    and every stored batch is searchable before parsing has finished.
+    """
+    def __init__(self, parser: BaseParser, batch_size: int, queue_size: int) -> None:
+        self._parser = parser
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, file_path: str, on_page: Optional[Callable[[Document], None]]) -> None:
+        try:
+            pages = self._parser.lazy_load(file_path)
+            if on_page is not None:
+                pages = _observed(pages, on_page)
+            # 只统计解析本身的耗时, 不含等待消费者的时间
+            chunks = timed_iter(self._parser.iter_chunks(pages), 'parse')
+            for batch in batched(chunks, self._batch_size):
+                if not self._put(batch):
+                    return
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._put(_DONE)
+
+    def run(self, file_path: str, store: Callable[[List[Document]], None],
+            on_page: Optional[Callable[[Document], None]] = None) -> None:
+        producer = threading.Thread(target=self._produce, args=(file_path, on_page),
+                                    name='ingest-parser', daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = self._queue.get()
+                if batch is _DONE:
+                    break
+                store(batch)
+        finally:
+            # 消费端出错或被取消时让解析线程退出
+            self._stop.set()
+            producer.join()
+        if self._error is not None:
+            raise self._error
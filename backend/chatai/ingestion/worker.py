@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from chatai.chat_models.vector_db import VectoreDatabase, get_vector_db
+from chatai.file_parser.parser_factory import ParserFactory
+from chatai.metrics import stage
+from .manifest import ChunkManifest
+from .pipeline import IngestPipeline
+from .jobs import IngestJob, JobCancelled, QUEUED, DONE, FAILED
+
+LOGGER = logging.getLogger(__name__)
+
+
+def vectorize(job: IngestJob) -> None:
+    file_path = job.field('file_path')
+    vector_path = job.field('vector_path')
+    # 文档块 id 总是由清单确定性地生成, 重试时覆盖而不是重复写入;
+    # 增量模式下只写入新增的文档块, 最后删除已不存在的文档块
+    manifest = ChunkManifest(vector_path)
+    previous_ids = manifest.load()
+    current_ids = []
+    # 本次写入且不在旧清单里的 id, 任务没完成时要删掉
+    written_ids = []
+
+    def store(batch):
+        job.check_cancelled()
+        job.incr('chunks', len(batch))
+        ids = manifest.assign_ids(batch)
+        current_ids.extend(ids)
+        if settings.INGEST_INCREMENTAL:
+            added = [(doc, doc_id) for doc, doc_id in zip(batch, ids) if doc_id not in previous_ids]
+            job.incr('unchanged', len(batch) - len(added))
+            batch = [doc for doc, _ in added]
+            ids = [doc_id for _, doc_id in added]
+        if batch:
+            written_ids.extend(doc_id for doc_id in ids if doc_id not in previous_ids)
+            with stage('embed_store'):
+                get_vector_db().store(batch, vector_path, ids=ids)
+            job.incr('embedded', len(batch))
+
+    try:
+        parser = ParserFactory.get_parser(file_path, job.field('mime_type') or None)()
+        pipeline = IngestPipeline(parser, settings.INGEST_BATCH_SIZE, settings.INGEST_QUEUE_SIZE)
+        pipeline.run(file_path, store, on_page=lambda page: job.incr('pages'))
+        get_vector_db().flush(vector_path)
+        job.check_cancelled()
+        # 文件在处理期间被删除时不能再写回清单, 否则删掉的文档块又能被检索到
+        if not os.path.exists(file_path):
+            raise JobCancelled(job.id)
+    except BaseException:
+        # 取消或失败时撤回这次写入的新文档块, 向量库回到旧清单记录的状态
+        if written_ids:
+            get_vector_db().delete(list(dict.fromkeys(written_ids)), vector_path)
+        raise
+
+    removed = list(previous_ids.difference(current_ids))
+    if removed:
+        get_vector_db().delete(removed, vector_path)
+    job.set(removed=len(removed))
+    manifest.save(current_ids)
+
+
+def process(job: IngestJob) -> None:
+    job.start()
+    job.incr('attempts')
+    try:
+        vectorize(job)
+    except JobCancelled:
+        LOGGER.info(f'Ingest job {job.id} cancelled')
+        return
+    except Exception as e:
+        LOGGER.exception(f'Ingest job {job.id} failed')
+        if not job.is_current():
+            return
+        if int(job.field('attempts')) < settings.INGEST_MAX_ATTEMPTS:
+            job.requeue()
+            job.set(error=str(e))
+        else:
+            job.set(status=FAILED, error=str(e), finished_at=time.time())
+        return
+    if not job.is_current():
+        return
+    job.set(status=DONE, finished_at=time.time())
+    LOGGER.info(f'Ingest job {job.id} done, embedding cache {VectoreDatabase.get_embeddings().stats()}')
+
+
+def _heartbeat(worker_id: str) -> None:
+    while True:
+        try:
+            IngestJob.heartbeat(worker_id)
+        except Exception as e:
+            LOGGER.warning(f'Ingest worker heartbeat failed: {e}')
+        time.sleep(settings.INGEST_WORKER_TTL / 3)
+
+
+def run_worker() -> None:
+    worker_id = IngestJob.worker_id()
+    IngestJob.heartbeat(worker_id)
+    threading.Thread(target=_heartbeat, args=(worker_id,), name='ingest-heartbeat', daemon=True).start()
+    LOGGER.info(f'Ingest worker {worker_id} started')
+    recovered_at = 0
+    while True:
+        # 启动时以及之后每个心跳周期, 接手已经挂掉的 worker 留下的任务
+        if time.monotonic() - recovered_at >= settings.INGEST_WORKER_TTL:
+            IngestJob.recover_stale()
+            recovered_at = time.monotonic()
+        job = IngestJob.pop(worker_id)
+        if job is None:
+            continue
+        # 排队期间被取消的任务直接跳过
+        if job.status == QUEUED:
+            process(job)
+        job.ack(worker_id)
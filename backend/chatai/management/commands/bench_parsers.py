@@ -0,0 +1,60 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatai.file_parser.parser_factory import ParserFactory
+
+PARAGRAPH = ('Military logistics depends on supply lines, maintenance and transport capacity. '
+             '后勤保障依赖补给线、维修能力与运输能力。') * 4
+
+
+def _write_sample(path: str, extension: str, size: int) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        if extension == '.html':
+            f.write('<html><head><style>p { margin: 0 }</style></head><body>\n')
+        section = 0
+        while f.tell() < size:
+            section += 1
+            if extension == '.md':
+                f.write(f'## Section {section}\n\n{PARAGRAPH}\n\n')
+            elif extension == '.html':
+                f.write(f'<h2>Section {section}</h2>\n<p>{PARAGRAPH}</p>\n')
+            else:
+                f.write(f'{PARAGRAPH}\n\n')
+        if extension == '.html':
+            f.write('</body></html>\n')
+
+
+class Command(BaseCommand):
+    help = 'Report parse + split throughput for each registered text format (and optionally a PDF)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=float, default=50, help='size of the generated sample per format')
+        parser.add_argument('--formats', default='.txt,.md,.html')
+        parser.add_argument('--pdf', help='also benchmark this PDF file')
+
+    def _measure(self, file_path: str):
+        parser = ParserFactory.get_parser(file_path)()
+        start = time.perf_counter()
+        chunks = sum(1 for _ in parser.iter_chunks(parser.lazy_load(file_path)))
+        return chunks, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        size = int(options['size_mb'] * 1024 * 1024)
+        self.stdout.write('format    MB  chunks  seconds    MB/s  chunks/s')
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for extension in options['formats'].split(','):
+                path = os.path.join(tmp, f'sample{extension}')
+                _write_sample(path, extension, size)
+                files.append((extension, path))
+            if options['pdf']:
+                files.append(('.pdf', options['pdf']))
+
+            for extension, path in files:
+                megabytes = os.path.getsize(path) / 1024 / 1024
+                chunks, elapsed = self._measure(path)
+                self.stdout.write(f'{extension:<6} {megabytes:>5.1f}  {chunks:>6}  {elapsed:>7.2f}'
+                                  f'  {megabytes / elapsed:>6.2f}  {chunks / elapsed:>8.0f}')
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatai.file_parser.parallel_pdf_parser import ParallelPDFParser
+
+
+class Command(BaseCommand):
+    help = 'Report PDF text extraction throughput (pages per second) for increasing worker counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='PDF file to extract')
+        parser.add_argument('--workers', default='1,2,4,8', help='comma separated worker counts')
+        parser.add_argument('--pages-per-task', type=int, default=16)
+        parser.add_argument('--repeat', type=int, default=1, help='runs per worker count, the best one is reported')
+
+    def handle(self, *args, **options):
+        self.stdout.write('workers  pages  seconds  pages/s  speedup')
+        baseline = None
+        for workers in [int(count) for count in options['workers'].split(',')]:
+            parser = ParallelPDFParser(workers=workers, pages_per_task=options['pages_per_task'], min_pages=0)
+            best = None
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                pages = sum(1 for _ in parser.lazy_load(options['file']))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            rate = pages / best
+            baseline = baseline or rate
+            self.stdout.write(f'{workers:>7}  {pages:>5}  {best:>7.2f}  {rate:>7.1f}  {rate / baseline:>6.2f}x')
@@ -0,0 +1,59 @@
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chatai.chat_models.hnsw_index import HNSWIndex
+from chatai.chat_models.numpy_store import NumpyVectorStore
+
+
+def _sample(rng, count: int, dim: int, clusters: int) -> np.ndarray:
+    # 聚簇数据比均匀随机数据更接近真实文本向量
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(clusters, size=count)] + 0.35 * rng.normal(size=(count, dim))).astype(np.float32)
+
+
+class Command(BaseCommand):
+    help = 'Compare HNSW recall and latency against exact search on the same synthetic knowledge base'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vectors', type=int, default=100000)
+        parser.add_argument('--dim', type=int, default=768, help='768 matches nomic-embed-text')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--m', type=int, default=16)
+        parser.add_argument('--ef-construction', type=int, default=200)
+        parser.add_argument('--ef', default='16,32,64,128,256')
+
+    def _timed_search(self, store, queries, top_k, **kwargs):
+        results, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results.append({doc.id for doc, _ in store.search(query, top_k, **kwargs)})
+            latencies.append(time.perf_counter() - start)
+        return results, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        vectors = _sample(rng, options['vectors'], options['dim'], clusters=max(options['vectors'] // 500, 1))
+        queries = vectors[rng.integers(len(vectors), size=options['queries'])] \
+            + 0.1 * rng.normal(size=(options['queries'], options['dim'])).astype(np.float32)
+        ids = [str(i) for i in range(len(vectors))]
+        top_k = options['top_k']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index = HNSWIndex(tmp, m=options['m'], ef_construction=options['ef_construction'])
+            store = NumpyVectorStore(tmp, index)
+            start = time.perf_counter()
+            store.add(ids, [''] * len(ids), [{}] * len(ids), vectors)
+            self.stdout.write(f'{len(vectors)} x {options["dim"]} vectors, '
+                              f'insert + HNSW build {time.perf_counter() - start:.1f}s (M={options["m"]})')
+
+            truth, p50, p95 = self._timed_search(store, queries, top_k, exact=True)
+            self.stdout.write('mode        recall@k   p50 ms   p95 ms')
+            self.stdout.write(f'exact       {1:>8.3f}  {p50:>7.2f}  {p95:>7.2f}')
+            for ef in [int(ef) for ef in options['ef'].split(',')]:
+                results, p50, p95 = self._timed_search(store, queries, top_k, ef=ef)
+                recall = np.mean([len(found & expected) / len(expected) for found, expected in zip(results, truth)])
+                self.stdout.write(f'hnsw ef={ef:<4} {recall:>7.3f}  {p50:>7.2f}  {p95:>7.2f}')
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import secrets
+import subprocess
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chatai.benchmark import open_stream, seed_stub_knowledge, summarize
+from user.models import Session, User
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=settings.BASE_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Drive /chat/ with concurrent SSE conversations and report time to first token, inter-token '
+            'latency, turn latency percentiles and error rate as JSON. Run the server against the fake '
+            'Ollama (manage.py fake_ollama, OLLAMA_BASE_URL) with VECTOR_BACKEND=numpy for repeatable numbers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/chat/')
+        parser.add_argument('--email', default='bench@example.com', help='benchmark user, created if missing')
+        parser.add_argument('--concurrency', type=int, default=20, help='conversations in flight at once')
+        parser.add_argument('--turns', type=int, default=200, help='total chat turns to send')
+        parser.add_argument('--knowledge-chunks', type=int, default=0,
+                            help='seed the user\'s NumPy store with this many synthetic chunks first')
+        parser.add_argument('--same-message', action='store_true',
+                            help='send the same message every turn (exercises the answer cache)')
+        parser.add_argument('--timeout', type=float, default=120, help='per read timeout in seconds')
+        parser.add_argument('--output', help='write the JSON report to this file')
+
+    def _prepare_user(self, options):
+        user = User.objects.filter(email=options['email']).first()
+        if user is None:
+            user = User.objects.create_user('bench', options['email'], secrets.token_urlsafe(16))
+        # 每个并发会话一个 Session, 避免同一会话里互相影响
+        sessions = [Session.objects.create(user=user, session_name=f'bench {i}') for i in range(options['concurrency'])]
+        token = RefreshToken.for_user(user).access_token
+        token.set_exp(lifetime=timedelta(hours=6))
+        return user, sessions, str(token)
+
+    async def _run(self, options, sessions, token):
+        turns = iter(range(options['turns']))
+        results = []
+
+        async def conversation(session):
+            for turn in turns:
+                message = 'What supplies does the convoy need?'
+                if not options['same_message']:
+                    message = f'{message} (turn {turn})'
+                payload = {'session_id': session.id, 'message': message}
+                results.append(await open_stream(options['url'], token, payload, options['timeout']))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(conversation(session) for session in sessions))
+        return results, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        user, sessions, token = self._prepare_user(options)
+        if options['knowledge_chunks']:
+            self.stdout.write(f'Seeding {options["knowledge_chunks"]} chunks for {user.email}')
+            seed_stub_knowledge(user, options['knowledge_chunks'])
+
+        try:
+            results, elapsed = asyncio.run(self._run(options, sessions, token))
+        finally:
+            Session.objects.filter(id__in=[session.id for session in sessions]).delete()
+
+        report = {
+            'commit': _git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'config': {key: options[key] for key in ('url', 'concurrency', 'turns', 'knowledge_chunks', 'same_message')},
+            'results': summarize(results, elapsed),
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Report written to {options["output"]}'))
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatai.benchmark import open_stream
+
+
+class StreamStats:
+    def __init__(self):
+        self.open = 0
+        self.peak = 0
+        self.completed = 0
+        self.failed = 0
+        self.first_token = []
+
+    def opened(self):
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+
+    def closed(self):
+        self.open -= 1
+
+
+class Command(BaseCommand):
+    help = 'Open increasing numbers of concurrent /chat/ SSE streams and report how many one process can hold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/chat/')
+        parser.add_argument('--token', required=True, help='JWT of an existing user, sent as the token cookie')
+        parser.add_argument('--session-id', type=int, required=True, help='session owned by that user')
+        parser.add_argument('--levels', default='50,100,200,400,800', help='comma separated concurrency levels')
+        parser.add_argument('--message', default='What is the smallest prime number?')
+        parser.add_argument('--timeout', type=float, default=120, help='per read timeout in seconds')
+
+    async def _run_level(self, options, concurrency):
+        stats = StreamStats()
+        payload = {'session_id': options['session_id'], 'message': options['message']}
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            open_stream(options['url'], options['token'], payload, options['timeout'], stats.opened, stats.closed)
+            for _ in range(concurrency)
+        ))
+        for result in results:
+            if result.ok:
+                stats.completed += 1
+                if result.ttft is not None:
+                    stats.first_token.append(result.ttft)
+            else:
+                stats.failed += 1
+        return stats, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options['levels'].split(',')]
+        capacity = 0
+        self.stdout.write('level  peak_open  completed  failed  p50_first_token  wall')
+        for concurrency in levels:
+            stats, elapsed = asyncio.run(self._run_level(options, concurrency))
+            first_token = sorted(stats.first_token)
+            p50 = first_token[len(first_token) // 2] if first_token else float('nan')
+            self.stdout.write(f'{concurrency:>5}  {stats.peak:>9}  {stats.completed:>9}  {stats.failed:>6}'
+                              f'  {p50:>14.3f}s  {elapsed:.1f}s')
+            if stats.failed:
+                break
+            capacity = stats.peak
+
+        self.stdout.write(self.style.SUCCESS(f'Concurrent streams held without errors: {capacity}'))
+        self.stdout.write('Run the server with a single worker process so the number above is per process.')
@@ -0,0 +1,33 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chatai.benchmark import FakeOllama
+
+
+class Command(BaseCommand):
+    help = ('Serve a fake Ollama API, and an OpenAI-compatible one under /v1, with a fixed time to first token '
+            'and token rate, for benchmarks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=11435)
+        parser.add_argument('--tokens-per-second', type=float, default=50)
+        parser.add_argument('--ttft', type=float, default=0.2, help='seconds before the first token')
+        parser.add_argument('--reply-tokens', type=int, default=100)
+        parser.add_argument('--dim', type=int, default=768, help='embedding dimension')
+
+    def handle(self, *args, **options):
+        server = FakeOllama(tokens_per_second=options['tokens_per_second'], ttft=options['ttft'],
+                            reply_tokens=options['reply_tokens'], dim=options['dim'])
+
+        async def serve():
+            await server.start(options['host'], options['port'])
+            self.stdout.write(f'Fake Ollama listening on http://{options["host"]}:{options["port"]} '
+                              f'(ttft {options["ttft"]}s, {options["tokens_per_second"]} tokens/s)')
+            await server.serve_forever()
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,62 @@
+import multiprocessing
+
+import prometheus_client
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from chatai.ingestion.worker import run_worker
+from chatai.metrics import collector_registry, mark_process_dead, multiprocess_enabled
+
+
+def _serve_metrics(port):
+    # worker 不经过 Django, 自己暴露 /metrics 供 Prometheus 抓取
+    if port:
+        prometheus_client.start_http_server(port, registry=collector_registry())
+
+
+def _worker_main(metrics_port):
+    # 子进程不能复用父进程的数据库连接
+    connections.close_all()
+    _serve_metrics(metrics_port)
+    run_worker()
+
+
+class Command(BaseCommand):
+    help = 'Run local worker processes that vectorize uploaded knowledge files from the Redis job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.INGEST_WORKERS)
+        parser.add_argument('--metrics-port', type=int, default=0,
+                            help='expose stage metrics on this port; without PROMETHEUS_MULTIPROC_DIR '
+                                 'worker i uses port + i; 0 disables')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            _serve_metrics(options['metrics_port'])
+            run_worker()
+            return
+
+        # 非 daemon 进程, 以便 worker 内还能使用进程池解析 PDF
+        port = options['metrics_port']
+        if multiprocess_enabled():
+            # 多进程模式下由父进程在一个端口上汇总所有 worker 的指标
+            _serve_metrics(port)
+            ports = [0] * options['processes']
+        else:
+            ports = [port + i if port else 0 for i in range(options['processes'])]
+        workers = [multiprocessing.Process(target=_worker_main, args=(worker_port,)) for worker_port in ports]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'Started {len(workers)} ingest workers')
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                mark_process_dead(worker.pid)
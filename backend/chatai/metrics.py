@@ -0,0 +1,137 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, Optional
+
+from django.http import HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# 多 worker 部署 (gunicorn / uvicorn --workers, ingest_worker --processes) 时设置 PROMETHEUS_MULTIPROC_DIR,
+# 各进程把指标写入该目录, /metrics 汇总所有进程; 该目录需在启动前清空.
+# 未设置时指标只属于处理本次抓取的进程, 只适合单进程部署
+ADMISSION_ACTIVE = Gauge('chat_admission_active', 'Chat generations currently running',
+                         multiprocess_mode='livesum')
+ADMISSION_QUEUE_DEPTH = Gauge('chat_admission_queue_depth', 'Chat requests waiting for a generation slot',
+                              multiprocess_mode='livesum')
+ADMISSION_WAIT_SECONDS = Histogram('chat_admission_wait_seconds', 'Time chat requests waited for a generation slot',
+                                   buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+ADMISSION_REJECTED = Counter('chat_admission_rejected_total', 'Chat requests rejected because the queue was full')
+
+LLM_ENDPOINT_UP = Gauge('llm_endpoint_up', 'Whether an Ollama endpoint is in rotation', ['endpoint'],
+                        multiprocess_mode='livemax')
+LLM_ENDPOINT_OUTSTANDING = Gauge('llm_endpoint_outstanding', 'Streams in flight per Ollama endpoint', ['endpoint'],
+                                 multiprocess_mode='livesum')
+
+EMBEDDING_CACHE_HITS = Counter('embedding_cache_hits_total', 'Chunks whose embedding came from the cache', ['model'])
+EMBEDDING_CACHE_MISSES = Counter('embedding_cache_misses_total', 'Chunks sent to the embedding model', ['model'])
+
+PRINCIPAL_CACHE_LOOKUPS = Counter('principal_cache_lookups_total',
+                                  'Authenticated user lookups by where the principal was found', ['source'])
+
+STAGE_SECONDS = Histogram('request_stage_seconds', 'Time spent in each stage of chat, upload and ingest work',
+                          ['stage'], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                              1, 2.5, 5, 10, 30, 60, 300))
+
+_current_timer: ContextVar[Optional['StageTimer']] = ContextVar('stage_timer', default=None)
+
+
+class StageTimer:
+    """
+    Stage durations of one request, filled by `stage` / `observe` while the
+    timer is active in the current context. StageTimingMiddleware creates
+    one per request; streaming views activate it again inside their
+    generators, which run after the middleware has returned.
+    """
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def activate(self):
+        return _current_timer.set(self)
+
+    @staticmethod
+    def deactivate(token) -> None:
+        _current_timer.reset(token)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Milliseconds per stage plus the total so far
+        """
+        summary = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+        summary['total'] = round((time.perf_counter() - self.started) * 1000, 1)
+        return summary
+
+    def server_timing(self) -> str:
+        return ', '.join(f'{name};dur={ms}' for name, ms in self.summary().items())
+
+
+def current_timer() -> Optional[StageTimer]:
+    return _current_timer.get()
+
+
+def observe(name: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed_iter(iterable: Iterable, name: str) -> Iterator:
+    """
+    Yield from `iterable`, timing only the time spent producing items (not
+    the consumer's work between them), observed once at the end
+    """
+    iterator = iter(iterable)
+    spent = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                spent += time.perf_counter() - start
+            yield item
+    finally:
+        observe(name, spent)
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def collector_registry():
+    """
+    Registry to expose: every process's samples in multiprocess mode, else
+    this process's default registry
+    """
+    if not multiprocess_enabled():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid: int) -> None:
+    # 进程退出后删除其 live* gauge 文件, 否则已退出进程的数值仍被汇总
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
+
+
+def metrics_view(request):
+    return HttpResponse(generate_latest(collector_registry()), content_type=CONTENT_TYPE_LATEST)
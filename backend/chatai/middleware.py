@@ -0,0 +1,45 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import StageTimer
+
+
+class StageTimingMiddleware:
+    """
+    Starts a StageTimer for every request (request.stage_timer) and adds a
+    Server-Timing header to non-streaming responses. Streaming responses
+    report their stages in the last SSE frame instead.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _annotate(timer: StageTimer, response):
+        if not response.streaming:
+            response['Server-Timing'] = timer.server_timing()
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = request.stage_timer = StageTimer()
+        token = timer.activate()
+        try:
+            response = self.get_response(request)
+        finally:
+            StageTimer.deactivate(token)
+        return self._annotate(timer, response)
+
+    async def __acall__(self, request):
+        timer = request.stage_timer = StageTimer()
+        token = timer.activate()
+        try:
+            response = await self.get_response(request)
+        finally:
+            StageTimer.deactivate(token)
+        return self._annotate(timer, response)
@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import AsyncIterator, Iterator, Optional, Set
+
+import redis.asyncio
+from django.conf import settings
+from django.db import connections
+from django_redis import get_redis_connection
+
+from .sse import error_frame
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent chat requests across worker processes.
+
+    The first request for a (user, session, message) key takes a Redis lock
+    with SET NX and becomes the leader. Its generation runs to completion in
+    a background thread (or task, for the async view) that appends every SSE
+    frame to a Redis stream, so a leader whose client disconnects does not
+    cut the answer short for everyone else. The leader's response and every
+    identical request arriving while the lock is held read that stream from
+    the start, without a second retrieval or generation. While generating,
+    the leader refreshes the short-lived lock every `lock_ttl / 3` seconds,
+    and after the end keeps it for `linger` seconds, so a retry landing just
+    after the answer finished still attaches. If the leader's process dies,
+    the lock lapses within `lock_ttl`: new requests generate on their own
+    and readers end with an error frame, as they do when the generation
+    fails or nothing arrives for `idle_timeout` seconds.
+    """
+    LOCK = 'flight:{}:lock'
+    STREAM = 'flight:{}:stream'
+
+    def __init__(self, lock_ttl: int, linger: int, idle_timeout: int) -> None:
+        self._lock_ttl = lock_ttl
+        self._linger = linger
+        self._idle_timeout = idle_timeout
+        self._async_client: Optional[redis.asyncio.Redis] = None
+        # 后台生成任务的强引用, 防止被垃圾回收
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def flight_key(user_id: int, session_id: int, message: str) -> str:
+        return hashlib.sha256(f'{user_id}\0{session_id}\0{message.strip()}'.encode('utf-8')).hexdigest()
+
+    def _aclient(self) -> redis.asyncio.Redis:
+        # django-redis 只有同步客户端, 异步视图单独用一个 asyncio 连接池
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(settings.CACHES['default']['LOCATION'])
+        return self._async_client
+
+    def _publish(self, pipe, key: str, fields: dict, ttl: int) -> None:
+        pipe.xadd(self.STREAM.format(key), fields)
+        pipe.expire(self.STREAM.format(key), ttl)
+        pipe.expire(self.LOCK.format(key), ttl)
+
+    @staticmethod
+    def _read(entries, last_id: str):
+        """
+        Frames of the stream entries; the last item is the next id to read
+        from, or None once the stream has ended
+        """
+        for entry_id, fields in entries:
+            last_id = entry_id
+            if b'end' in fields:
+                yield None
+                return
+            if b'error' in fields:
+                # 生成失败时给读取方一个结束帧, 前端据此关闭连接
+                yield error_frame()
+                yield None
+                return
+            yield fields[b'frame'].decode('utf-8')
+        yield last_id
+
+    def _refresh(self, pipe, key: str) -> None:
+        pipe.expire(self.LOCK.format(key), self._lock_ttl)
+        pipe.expire(self.STREAM.format(key), self._lock_ttl)
+
+    def _block_ms(self, idle: float) -> int:
+        # 每次最多等一个锁的有效期, 以便及时发现发起者已经不在
+        # (block=0 在 Redis 里表示一直等, 至少等 1ms)
+        return max(1, int(min(self._lock_ttl, self._idle_timeout - idle) * 1000))
+
+    def _gave_up(self, key: str, idle: float, lock_held: bool) -> bool:
+        if lock_held and idle < self._idle_timeout:
+            return False
+        LOGGER.warning(f'Leader of flight {key} went silent, ending follower stream')
+        return True
+
+    def acquire(self, key: str) -> bool:
+        return bool(get_redis_connection('default').set(self.LOCK.format(key), 1, nx=True, ex=self._lock_ttl))
+
+    def _heartbeat(self, key: str, stop: threading.Event) -> None:
+        conn = get_redis_connection('default')
+        while not stop.wait(self._lock_ttl / 3):
+            try:
+                with conn.pipeline() as pipe:
+                    self._refresh(pipe, key)
+                    pipe.execute()
+            except Exception as e:
+                LOGGER.warning(f'Heartbeat of flight {key} failed: {e}')
+
+    def _produce(self, key: str, frames: Iterator[str]) -> None:
+        conn = get_redis_connection('default')
+        final = {'end': 1}
+        # 检索和排队时没有帧输出, 由心跳线程给锁续期
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(key, stop), name=f'flight-{key[:8]}-heartbeat',
+                         daemon=True).start()
+        try:
+            for frame in frames:
+                with conn.pipeline() as pipe:
+                    self._publish(pipe, key, {'frame': frame}, self._lock_ttl)
+                    pipe.execute()
+        except Exception:
+            LOGGER.exception(f'Generation of flight {key} failed')
+            final = {'error': 1}
+        finally:
+            stop.set()
+            # 无论正常结束还是出错, 都要通知读取方结束
+            with conn.pipeline() as pipe:
+                self._publish(pipe, key, final, self._linger)
+                pipe.execute()
+            connections.close_all()
+
+    def lead(self, key: str, frames: Iterator[str]) -> Iterator[str]:
+        threading.Thread(target=self._produce, args=(key, frames), name=f'flight-{key[:8]}', daemon=True).start()
+        return self.follow(key)
+
+    def follow(self, key: str) -> Iterator[str]:
+        conn = get_redis_connection('default')
+        last_id, idle = '0', 0
+        while True:
+            block = self._block_ms(idle)
+            result = conn.xread({self.STREAM.format(key): last_id}, count=100, block=block)
+            if not result:
+                idle += block / 1000
+                if self._gave_up(key, idle, conn.exists(self.LOCK.format(key))):
+                    yield error_frame()
+                    return
+                continue
+            idle = 0
+            *frames, last_id = self._read(result[0][1], last_id)
+            for frame in frames:
+                yield frame
+            if last_id is None:
+                return
+
+    async def aacquire(self, key: str) -> bool:
+        return bool(await self._aclient().set(self.LOCK.format(key), 1, nx=True, ex=self._lock_ttl))
+
+    async def _aheartbeat(self, key: str) -> None:
+        client = self._aclient()
+        while True:
+            await asyncio.sleep(self._lock_ttl / 3)
+            try:
+                async with client.pipeline() as pipe:
+                    self._refresh(pipe, key)
+                    await pipe.execute()
+            except Exception as e:
+                LOGGER.warning(f'Heartbeat of flight {key} failed: {e}')
+
+    async def _aproduce(self, key: str, frames: AsyncIterator[str]) -> None:
+        client = self._aclient()
+        final = {'end': 1}
+        heartbeat = asyncio.get_running_loop().create_task(self._aheartbeat(key))
+        try:
+            async for frame in frames:
+                async with client.pipeline() as pipe:
+                    self._publish(pipe, key, {'frame': frame}, self._lock_ttl)
+                    await pipe.execute()
+        except Exception:
+            LOGGER.exception(f'Generation of flight {key} failed')
+            final = {'error': 1}
+        finally:
+            heartbeat.cancel()
+            async with client.pipeline() as pipe:
+                self._publish(pipe, key, final, self._linger)
+                await pipe.execute()
+
+    def alead(self, key: str, frames: AsyncIterator[str]) -> AsyncIterator[str]:
+        task = asyncio.get_running_loop().create_task(self._aproduce(key, frames))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return self.afollow(key)
+
+    async def afollow(self, key: str) -> AsyncIterator[str]:
+        client = self._aclient()
+        last_id, idle = '0', 0
+        while True:
+            block = self._block_ms(idle)
+            result = await client.xread({self.STREAM.format(key): last_id}, count=100, block=block)
+            if not result:
+                idle += block / 1000
+                if self._gave_up(key, idle, await client.exists(self.LOCK.format(key))):
+                    yield error_frame()
+                    return
+                continue
+            idle = 0
+            *frames, last_id = self._read(result[0][1], last_id)
+            for frame in frames:
+                yield frame
+            if last_id is None:
+                return
+
+
+single_flight = SingleFlight(
+    lock_ttl=settings.SINGLE_FLIGHT['LOCK_TTL'],
+    linger=settings.SINGLE_FLIGHT['LINGER'],
+    idle_timeout=settings.SINGLE_FLIGHT['IDLE_TIMEOUT'],
+)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import time
+from json.encoder import encode_basestring_ascii
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+from .metrics import observe
+
+# 帧结构固定, 只有内容需要转义; 与 json.dumps 生成的结果逐字节相同
+_FRAME_PREFIX = 'data: {"result": {"output": {"content": '
+_FRAME_SUFFIX = '}, "metadata": {"finishReason": %s}}}\n\n'
+_SUFFIXES = {reason: _FRAME_SUFFIX % encode_basestring_ascii(reason) for reason in ('continue', 'stop')}
+
+
+def sse_frame(content: str, finish_reason: str = 'continue') -> str:
+    suffix = _SUFFIXES.get(finish_reason) or _FRAME_SUFFIX % encode_basestring_ascii(finish_reason)
+    return _FRAME_PREFIX + encode_basestring_ascii(content) + suffix # SSE需要\n\n
+
+
+def stop_frame(timing: Optional[Dict[str, float]] = None) -> str:
+    """
+    Last frame of a stream; with `timing`, metadata also carries the stage
+    durations of the turn in milliseconds
+    """
+    if not timing:
+        return sse_frame('', 'stop')
+    result_data = {
+        'result': {
+            'output': {
+                'content': ''
+            },
+            'metadata': {
+                'finishReason': 'stop',
+                'timing': timing
+            }
+        }
+    }
+    return f"data: {json.dumps(result_data)}\n\n"
+
+
+def error_frame(message: str = '生成回复时出错, 请重试') -> str:
+    """
+    Last frame of a stream whose generation failed; it carries finishReason
+    'stop' so clients close the connection, plus the error message
+    """
+    result_data = {
+        'result': {
+            'output': {
+                'content': ''
+            },
+            'metadata': {
+                'finishReason': 'stop',
+                'error': message
+            }
+        }
+    }
+    return f"data: {json.dumps(result_data, ensure_ascii=False)}\n\n"
+
+
+class SSEWriter:
+    """
+    Turns a token stream into SSE frames, several tokens per frame.
+
+    Buffered tokens are sent once they reach `max_chars` or `max_delay`
+    seconds have passed since the previous frame, so the first token still
+    goes out at once and later ones at most `max_delay` late. The async
+    variant also flushes when the model pauses; the sync one flushes on the
+    next token. Every token is appended to `sink` when given, which is how
+    the views collect the reply they save. The wait for the first token and
+    the whole generation are recorded as the first_token / generation
+    stages.
+    """
+    def __init__(self, max_chars: int = 64, max_delay: float = 0.05) -> None:
+        self._max_chars = max_chars
+        self._max_delay = max_delay
+
+    def frames(self, tokens: Iterable[str], sink: Optional[List[str]] = None) -> Iterator[str]:
+        buffer, size, flushed_at = [], 0, float('-inf')
+        started = time.perf_counter()
+        for token in tokens:
+            if flushed_at == float('-inf'):
+                observe('first_token', time.perf_counter() - started)
+            if sink is not None:
+                sink.append(token)
+            buffer.append(token)
+            size += len(token)
+            if size >= self._max_chars or time.monotonic() - flushed_at >= self._max_delay:
+                yield sse_frame(''.join(buffer))
+                buffer, size, flushed_at = [], 0, time.monotonic()
+        if buffer:
+            yield sse_frame(''.join(buffer))
+        observe('generation', time.perf_counter() - started)
+
+    async def aframes(self, tokens: AsyncIterable[str], sink: Optional[List[str]] = None) -> AsyncIterator[str]:
+        iterator = tokens.__aiter__()
+        buffer, size, flushed_at = [], 0, float('-inf')
+        pending = None
+        started = time.perf_counter()
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(flushed_at + self._max_delay - time.monotonic(), 0) if buffer else None
+                # 不取消等待中的 __anext__, 超时只是先把已缓冲的内容发出去
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield sse_frame(''.join(buffer))
+                    buffer, size, flushed_at = [], 0, time.monotonic()
+                    continue
+                try:
+                    token = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+                if flushed_at == float('-inf'):
+                    observe('first_token', time.perf_counter() - started)
+                if sink is not None:
+                    sink.append(token)
+                buffer.append(token)
+                size += len(token)
+                if size >= self._max_chars or time.monotonic() - flushed_at >= self._max_delay:
+                    yield sse_frame(''.join(buffer))
+                    buffer, size, flushed_at = [], 0, time.monotonic()
+            if buffer:
+                yield sse_frame(''.join(buffer))
+            observe('generation', time.perf_counter() - started)
+        finally:
+            if pending is not None:
+                pending.cancel()
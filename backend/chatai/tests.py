@@ -1,8 +1,763 @@
-from django.test import TestCase
+import asyncio
+import codecs
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from langchain_core.documents import Document
+from prometheus_client import REGISTRY
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from user.models import Message, Session, User
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from .admission import AdmissionController, QueueFull, RedisSlots
+from .answer_cache import AnswerCache, replay_chunks
+from .benchmark import FakeOllama
+from .chat_models import OllamaModel, OpenAIModel, client_registry
+from .chat_models.context_packer import ContextPacker
+from .chat_models.embedding_cache import CachedEmbeddings, DiskEmbeddingStore
+from .chat_models.hnsw_index import HNSWIndex
+from .chat_models.knowledge_version import bump_version
+from .chat_models.numpy_store import NumpyVectorStore
+from .chat_models.ollama_pool import OllamaEndpointPool, RoutedOllamaModel
+from .file_parser.base_parser import BaseParser
+from .file_parser.parallel_pdf_parser import ParallelPDFParser
+from .file_parser.pdf_parser import PDFParser
+from .file_parser.text_parser import HTMLParser, MarkdownParser, TextParser
+from .ingestion.jobs import QUEUED, IngestJob, JobCancelled
+from .ingestion.manifest import ChunkManifest
+from .ingestion.worker import vectorize
+from .metrics import StageTimer, collector_registry, mark_process_dead, stage
+from .single_flight import SingleFlight
+from .sse import SSEWriter, error_frame, sse_frame, stop_frame
+from .views import AdmittedStream, AsyncChatView, ChatView, MetricsView, replay_answer
 
 # Create your tests here.
-from chat_models import OllamaModel
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+@unittest.skipUnless(os.environ.get('OLLAMA_SMOKE_TEST'), 'needs a running Ollama server')
+class OllamaModelTest(TestCase):
+    def test_chat_response(self):
+        model = OllamaModel()
+        res = model.chat_response("what is the smallest prime number")
+        self.assertIn('2', res)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChatViewTest(TestCase):
+    def test_foreign_session_is_not_found(self):
+        owner = User.objects.create_user(email='owner@example.com', nickname='owner', password='x')
+        other = User.objects.create_user(email='other@example.com', nickname='other', password='x')
+        session = Session.objects.create(user=owner, session_name='新对话')
+
+        request = APIRequestFactory().post('/chat', {'message': 'hi', 'session_id': session.id}, format='json')
+        force_authenticate(request, user=other)
+        self.assertEqual(ChatView.as_view()(request).status_code, 404)
+
+    def test_cached_answer_is_replayed_without_a_generation_slot(self):
+        user = User.objects.create_user(email='owner@example.com', nickname='owner', password='x')
+        session = Session.objects.create(user=user, session_name='新对话')
+        request = APIRequestFactory().post('/chat', {'message': 'hi', 'session_id': session.id}, format='json')
+        force_authenticate(request, user=user)
+
+        with mock.patch('chatai.views.admission') as admission, \
+                mock.patch('chatai.views.message_buffer') as buffer, \
+                mock.patch('chatai.views.RAG.embed_query', return_value=[1.0, 0.0]), \
+                mock.patch('chatai.views.answer_cache.key', return_value='answers:owner'), \
+                mock.patch('chatai.views.answer_cache.lookup', return_value='cached answer'), \
+                self.settings(ANSWER_CACHE={**settings.ANSWER_CACHE, 'ENABLED': True, 'REPLAY_CHARS_PER_SECOND': 0}):
+            response = ChatView.as_view()(request)
+            frames = list(response.streaming_content)
+
+        admission.enqueue.assert_not_called()
+        contents = [json.loads(frame[len(b'data: '):])['result']['output']['content'] for frame in frames]
+        self.assertEqual(''.join(contents), 'cached answer')
+        buffer.add.assert_called_once_with(session.id, 'model', 'cached answer')
+        self.assertTrue(Message.objects.filter(session=session, role='user', content='hi').exists())
+
+
+class OllamaClientTest(SimpleTestCase):
+    def test_embeddings_client_with_default_settings(self):
+        embeddings = client_registry.ollama_embeddings('nomic-embed-text')
+        self.assertEqual(embeddings.keep_alive,
+                         client_registry.keep_alive_seconds(settings.OLLAMA_MODELS['nomic-embed-text']['KEEP_ALIVE']))
+        self.assertEqual(client_registry.keep_alive_seconds('1h30m'), 5400)
+        self.assertEqual(client_registry.keep_alive_seconds('-1'), -1)
+
+    @override_settings(LLM_BACKEND='ollama')
+    def test_async_view_skips_the_blocking_health_check(self):
+        llm = client_registry.ollama_llm('llama3.3')
+        client_registry.registry._entries[('ollama_llm', 'llama3.3', settings.OLLAMA_BASE_URL)].checked_at = 0
+        with mock.patch('chatai.chat_models.client_registry._ollama_alive') as alive:
+            self.assertIs(AsyncChatView()._model._llm, llm)
+        alive.assert_not_called()
+
+    def test_slow_health_check_does_not_block_other_clients(self):
+        registry = client_registry.ClientRegistry(check_interval=0)
+        checking, release = threading.Event(), threading.Event()
+        def slow_check(client):
+            checking.set()
+            return release.wait(5)
+        registry.get('slow', object, slow_check)
+        thread = threading.Thread(target=registry.get, args=('slow', object, slow_check))
+        thread.start()
+        try:
+            self.assertTrue(checking.wait(5))
+            started = time.monotonic()
+            registry.get('other', object)
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_rebuilt_client_drops_what_was_built_on_it(self):
+        registry = client_registry.ClientRegistry()
+        client = registry.get('client', object)
+        chain = registry.get(('chain', id(client)), object, depends_on=(client,))
+        registry.get(('store', id(chain)), object, depends_on=(chain,))
+
+        registry.invalidate('client')
+        rebuilt = registry.get('client', object)
+        self.assertIsNot(rebuilt, client)
+        self.assertEqual(set(registry._entries), {'client'})
+        self.assertIsNot(registry.get(('chain', id(rebuilt)), object, depends_on=(rebuilt,)), chain)
+
+
+class EmbeddingCacheTest(SimpleTestCase):
+    def test_only_missing_chunks_are_embedded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fake = FakeEmbeddings()
+            hits = REGISTRY.get_sample_value('embedding_cache_hits_total', {'model': 'fake'}) or 0
+            cache = CachedEmbeddings(fake, 'fake', DiskEmbeddingStore(os.path.join(tmp, 'cache.sqlite3'), 100), batch_size=2)
+
+            first = cache.embed_documents(['a', 'bb', 'ccc'])
+            second = cache.embed_documents(['a', 'bb', 'dddd'])
+
+            self.assertEqual(first[:2], second[:2])
+            self.assertEqual(fake.calls, [['a', 'bb'], ['ccc'], ['dddd']])
+            self.assertEqual(cache.stats()['hits'], 2)
+            self.assertEqual(cache.stats()['misses'], 4)
+            self.assertEqual(REGISTRY.get_sample_value('embedding_cache_hits_total', {'model': 'fake'}) - hits, 2)
+
+    def test_recent_reads_do_not_rewrite_access_time(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DiskEmbeddingStore(os.path.join(tmp, 'cache.sqlite3'), 100, touch_interval=60)
+            store.set_many({'a': [1.0]})
+            changes = store._conn.total_changes
+            self.assertEqual(store.get_many(['a']), {'a': [1.0]})
+            self.assertEqual(store._conn.total_changes, changes)
+
+            with mock.patch('chatai.chat_models.embedding_cache.time.time', return_value=time.time() + 120):
+                store.get_many(['a'])
+            self.assertEqual(store._conn.total_changes, changes + 1)
+
+    def test_store_evicts_beyond_max_entries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DiskEmbeddingStore(os.path.join(tmp, 'cache.sqlite3'), 2)
+            store.set_many({'a': [1.0]})
+            store.set_many({'b': [2.0]})
+            store.set_many({'c': [3.0]})
+            self.assertEqual(set(store.get_many(['a', 'b', 'c'])), {'b', 'c'})
+
+
+class ChunkManifestTest(SimpleTestCase):
+    def test_unchanged_chunks_keep_their_ids(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            vector_path = os.path.join(tmp, 'vector', 'manual')
+            old = ChunkManifest(vector_path)
+            old_ids = old.assign_ids([Document(page_content=text) for text in ['a', 'b', 'a']])
+            old.save(old_ids)
+
+            new = ChunkManifest(vector_path)
+            new_ids = new.assign_ids([Document(page_content=text) for text in ['a', 'c', 'a']])
+
+            self.assertEqual(len(set(old_ids)), 3)
+            self.assertEqual(new.load(), set(old_ids))
+            self.assertEqual(set(new_ids) - set(old_ids), {new_ids[1]})
+            self.assertEqual(set(old_ids) - set(new_ids), {old_ids[1]})
+
+    def test_text_moved_to_another_page_gets_a_new_id(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            vector_path = os.path.join(tmp, 'vector', 'manual.pdf')
+            old_ids = ChunkManifest(vector_path).assign_ids([Document(page_content='a', metadata={'page': 1})])
+            new_ids = ChunkManifest(vector_path).assign_ids([Document(page_content='a', metadata={'page': 2})])
+            self.assertNotEqual(old_ids, new_ids)
+
+
+class FakeVectorDB:
+    def __init__(self):
+        self.vectors = {}
+
+    def store(self, docs, persist_path, ids=None):
+        self.vectors.update(zip(ids, docs))
+
+    def flush(self, persist_path):
+        pass
+
+    def delete(self, ids, persist_path):
+        for doc_id in ids:
+            self.vectors.pop(doc_id, None)
+
+
+class PagesParser(BaseParser):
+    def load(self, file_path):
+        return [Document(page_content=f'page {index}', metadata={'page': index}) for index in range(4)]
+
+
+class IngestWorkerTest(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.file_path = os.path.join(tmp.name, 'file', 'manual.txt')
+        self.vector_path = os.path.join(tmp.name, 'vector', 'manual.txt')
+        os.makedirs(os.path.dirname(self.file_path))
+        open(self.file_path, 'w').close()
+        self.vector_db = FakeVectorDB()
+        for target, value in [('get_vector_db', self.vector_db), ('ParserFactory.get_parser', PagesParser)]:
+            patcher = mock.patch(f'chatai.ingestion.worker.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _job(self, cancel_at=None):
+        job = mock.Mock()
+        job.field.side_effect = {'file_path': self.file_path, 'vector_path': self.vector_path, 'mime_type': ''}.get
+        checks = iter(range(100))
+        def check_cancelled():
+            if next(checks) == cancel_at:
+                raise JobCancelled(job)
+        job.check_cancelled.side_effect = check_cancelled
+        return job
+
+    @override_settings(INGEST_INCREMENTAL=False, INGEST_BATCH_SIZE=1)
+    def test_cancelled_attempt_is_rolled_back_and_retry_does_not_duplicate(self):
+        with self.assertRaises(JobCancelled):
+            vectorize(self._job(cancel_at=2))
+        self.assertEqual(self.vector_db.vectors, {})
+
+        vectorize(self._job())
+        vectorize(self._job())
+        self.assertEqual(set(self.vector_db.vectors), ChunkManifest(self.vector_path).load())
+        self.assertEqual(len(self.vector_db.vectors), 4)
+
+    def test_file_deleted_during_ingest_is_not_indexed(self):
+        # 第一批写入后文件被删除
+        def incr(name, amount=1):
+            if name == 'embedded' and os.path.exists(self.file_path):
+                os.remove(self.file_path)
+        job = self._job()
+        job.incr.side_effect = incr
+        with self.assertRaises(JobCancelled):
+            vectorize(job)
+        self.assertEqual(self.vector_db.vectors, {})
+        self.assertEqual(ChunkManifest(self.vector_path).load(), set())
+
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class IngestJobTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(IngestJob, '_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.job = IngestJob.submit(mock.Mock(id=1), '/data/file/manual.txt', '/data/vector/manual.txt')
+
+    def test_superseded_attempt_is_cancelled(self):
+        first = IngestJob.pop('w1', timeout=1)
+        first.start()
+        first.check_cancelled()
+        self.assertEqual(IngestJob.active_for('/data/file/manual.txt').id, self.job.id)
+
+        first.cancel()
+        first.retry()
+        second = IngestJob.pop('w2', timeout=1)
+        second.start()
+        second.check_cancelled()
+        with self.assertRaises(JobCancelled):
+            first.check_cancelled()
+
+    def test_jobs_of_a_dead_worker_are_requeued(self):
+        IngestJob.heartbeat('alive')
+        job = IngestJob.pop('dead', timeout=1)
+        job.start()
+        job.incr('attempts')
+        self.assertEqual(IngestJob.recover_stale(), 1)
+
+        self.assertEqual(job.status, QUEUED)
+        again = IngestJob.pop('alive', timeout=1)
+        self.assertEqual(again.id, job.id)
+        again.ack('alive')
+        self.assertEqual(IngestJob.recover_stale(), 0)
+        self.assertEqual(self.redis.keys('ingest:processing:*'), [])
+
+
+class NumpyVectorStoreTest(SimpleTestCase):
+    def test_search_sees_upserts_and_deletes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = NumpyVectorStore(tmp)
+            writer.add(['a', 'b', 'c'], ['x', 'y', 'z'], [{}, {}, {}], [[1, 0], [0.8, 0.6], [0, 1]])
+
+            reader = NumpyVectorStore(tmp)
+            self.assertEqual([doc.id for doc, _ in reader.search([1, 0], k=2)], ['a', 'b'])
+
+            writer.delete(['a'])
+            writer.add(['c'], ['z2'], [{}], [[1, 0.1]])
+            results = reader.search([1, 0], k=5)
+            self.assertEqual([doc.id for doc, _ in results], ['c', 'b'])
+            self.assertEqual(results[0][0].page_content, 'z2')
+            self.assertEqual(len(reader), 2)
+
+    def test_failed_add_does_not_shift_later_rows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = NumpyVectorStore(tmp)
+            writer.add(['a'], ['x'], [{}], [[1, 0, 0]])
+            # 向量已写入, 第二行元数据序列化失败
+            with self.assertRaises(TypeError):
+                writer.add(['b', 'c'], ['y', 'z'], [{}, {'bad': object()}], [[0, 1, 0], [0, 0, 1]])
+            NumpyVectorStore(tmp).add(['d'], ['w'], [{}], [[0.6, 0.8, 0]])
+
+            reader = NumpyVectorStore(tmp)
+            (doc, score), = reader.search([0.6, 0.8, 0], k=1)
+            self.assertEqual(doc.id, 'd')
+            self.assertAlmostEqual(score, 1, places=5)
+            self.assertEqual([doc.id for doc, _ in reader.search([0, 1, 0], k=1)], ['b'])
+            self.assertEqual(os.path.getsize(os.path.join(tmp, NumpyVectorStore.VECTORS)), 3 * 3 * 4)
+
+    def test_hnsw_index_agrees_with_exact_search(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = NumpyVectorStore(tmp, HNSWIndex(tmp))
+            vectors = [[float(i), float(i % 7), 1.0] for i in range(200)]
+            writer.add([str(i) for i in range(200)], [''] * 200, [{}] * 200, vectors)
+            writer.delete(['150'])
+
+            reader = NumpyVectorStore(tmp, HNSWIndex(tmp))
+            for query in ([150, 3, 1], [10, 0, 1], [1, 6, 1]):
+                self.assertEqual([doc.id for doc, _ in reader.search(query, k=3)],
+                                 [doc.id for doc, _ in reader.search(query, k=3, exact=True)])
+
+    def test_hnsw_index_saves_in_batches(self):
+        def saved_rows():
+            with open(os.path.join(tmp, HNSWIndex.STATE)) as f:
+                return json.load(f)['rows']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = NumpyVectorStore(tmp, HNSWIndex(tmp, save_rows=100))
+            for start in range(0, 150, 50):
+                writer.add([str(i) for i in range(start, start + 50)], [''] * 50, [{}] * 50,
+                           [[float(i), 1.0] for i in range(start, start + 50)])
+            self.assertEqual(saved_rows(), 100)
+            writer.flush()
+            self.assertEqual(saved_rows(), 150)
+
+            # 读者映射的行可能比刚保存的图少, 多出来的标签要被过滤掉
+            index = HNSWIndex(tmp)
+            index.load(2)
+            hits = index.search(np.array([1, 0], dtype=np.float32), 3, np.ones(100, dtype=bool))
+            self.assertEqual(len(hits), 3)
+            self.assertTrue(all(row < 100 for row, _ in hits))
+
+
+class TextParserTest(SimpleTestCase):
+    def _write(self, tmp, name, data: bytes) -> str:
+        path = os.path.join(tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_segments_end_at_line_breaks_without_page(self):
+        lines = [f'第 {i} 行内容' for i in range(200)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self._write(tmp, 'a.txt', '\n'.join(lines).encode('utf-8'))
+            docs = TextParser(segment_size=256).load(path)
+        self.assertGreater(len(docs), 1)
+        self.assertTrue(all(doc.page_content.endswith('\n') for doc in docs[:-1]))
+        self.assertEqual(''.join(doc.page_content for doc in docs), '\n'.join(lines))
+        self.assertTrue(all('page' not in doc.metadata for doc in docs))
+
+    def test_encoding_is_detected(self):
+        text = '知识库文件\n# 标题\n正文'
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, data in [('gbk.txt', text.encode('gb18030')),
+                               ('bom.md', text.encode('utf-16')),
+                               ('sig.txt', codecs.BOM_UTF8 + text.encode('utf-8'))]:
+                parser = MarkdownParser() if name.endswith('.md') else TextParser()
+                self.assertEqual(parser.load(self._write(tmp, name, data))[0].page_content, text, name)
+            html = self._write(tmp, 'a.html', '<p>你好</p><script>x</script>'.encode('gb18030'))
+            self.assertEqual(HTMLParser().load(html)[0].page_content, '你好')
+
+    def test_undecodable_file_is_rejected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self._write(tmp, 'a.txt', b'abc\xff\xff')
+            with self.assertRaises(ValueError):
+                TextParser().load(path)
+
+
+class ParallelPDFParserTest(SimpleTestCase):
+    def test_metadata_matches_pdf_parser(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from pypdf import PdfWriter
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'a.pdf')
+            writer = PdfWriter()
+            for _ in range(5):
+                writer.add_blank_page(612, 792)
+            writer.set_page_label(0, 1, style='/r')
+            writer.set_page_label(2, 4, style='/D')
+            writer.add_metadata({'/Title': ' Manual ', '/CreationDate': "D:20240102030405+08'00'"})
+            writer.write(path)
+
+            with ThreadPoolExecutor(2) as pool, \
+                    mock.patch('chatai.file_parser.parallel_pdf_parser._get_pool', return_value=pool):
+                parallel = list(ParallelPDFParser(workers=2, pages_per_task=2, min_pages=0).lazy_load(path))
+            expected = list(PDFParser().lazy_load(path))
+
+        self.assertEqual([doc.metadata['page_label'] for doc in parallel], ['i', 'ii', '1', '2', '3'])
+        self.assertEqual([doc.metadata for doc in parallel], [doc.metadata for doc in expected])
+
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class AnswerCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for target in ('chatai.answer_cache.get_redis_connection', 'chatai.chat_models.knowledge_version.get_redis_connection'):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = AnswerCache(threshold=0.95, max_entries=2, ttl=60)
+        self.user = mock.Mock(email='nick@example.com', answer_cache_enabled=True)
+
+    def test_lookup_needs_threshold_similarity(self):
+        key = self.cache.key(self.user)
+        self.cache.store(key, [1.0, 0.0], 'answer')
+        self.assertEqual(self.cache.lookup(key, [0.99, 0.05]), 'answer')
+        self.assertIsNone(self.cache.lookup(key, [0.7, 0.7]))
+
+    def test_knowledge_change_invalidates_answers(self):
+        self.cache.store(self.cache.key(self.user), [1.0, 0.0], 'answer')
+        bump_version(self.user.email)
+        self.assertIsNone(self.cache.lookup(self.cache.key(self.user), [1.0, 0.0]))
+
+    def test_empty_answers_are_not_stored(self):
+        key = self.cache.key(self.user)
+        self.cache.store(key, [1.0, 0.0], ' \n')
+        self.assertIsNone(self.cache.lookup(key, [1.0, 0.0]))
+
+    def test_user_opt_out(self):
+        self.assertTrue(AnswerCache.enabled_for(self.user))
+        self.user.answer_cache_enabled = False
+        self.assertFalse(AnswerCache.enabled_for(self.user))
+
+    @override_settings(ANSWER_CACHE={**settings.ANSWER_CACHE, 'REPLAY_CHARS_PER_SECOND': 0, 'REPLAY_CHUNK_CHARS': 4})
+    def test_replay_frames_match_live_generation(self):
+        self.assertEqual(list(replay_chunks('回答内容, 共十个字')), [('回答内容', 0), (', 共十', 0), ('个字', 0)])
+        with mock.patch('chatai.views.save_reply') as save_reply:
+            frames = list(replay_answer('回答内容, 共十个字', mock.Mock()))
+        self.assertEqual(frames, [sse_frame('回答内容'), sse_frame(', 共十'), sse_frame('个字'), stop_frame()])
+        self.assertEqual(''.join(save_reply.call_args[0][1]), '回答内容, 共十个字')
+
+
+class ContextPackerTest(SimpleTestCase):
+    def test_overlapping_chunks_are_merged_and_duplicates_dropped(self):
+        first = 'the supply lines were cut off near the river crossing and the convoy halted there'
+        second = 'the convoy halted there for three days until engineers rebuilt the bridge'
+        docs = [
+            Document(page_content=second, metadata={'source': 'a.pdf', 'page': 1, 'score': 0.5}),
+            Document(page_content=first, metadata={'source': 'a.pdf', 'page': 1, 'score': 0.9}),
+            Document(page_content=first[:60], metadata={'source': 'b.pdf', 'page': 3, 'score': 0.4}),
+        ]
+
+        packed = ContextPacker(min_overlap=20).pack(docs)
+
+        self.assertEqual([doc.page_content for doc in packed], [first + second[len('the convoy halted there'):]])
+        self.assertEqual(packed[0].metadata['score'], 0.9)
+
+    def test_budget_is_filled_in_score_order(self):
+        docs = [Document(page_content=text * 40, metadata={'score': score})
+                for text, score in [('alpha ', 0.2), ('bravo ', 0.8), ('delta ', 0.5)]]
+        packed = ContextPacker(token_budget=130).pack(docs)
+        self.assertEqual([doc.page_content[:5] for doc in packed], ['bravo', 'delta'])
+
+
+class AdmissionControllerTest(SimpleTestCase):
+    def test_slots_go_round_robin_across_users(self):
+        controller = AdmissionController(max_active=1, max_per_user=1, max_queue=3, max_queued_per_user=2)
+        running = controller.enqueue(1)
+        burst = [controller.enqueue(1), controller.enqueue(1)]
+        other = controller.enqueue(2)
+
+        self.assertTrue(running.granted)
+        self.assertEqual([controller.position(ticket) for ticket in burst + [other]], [1, 3, 2])
+        with self.assertRaises(QueueFull):
+            controller.enqueue(3)
+
+        controller.release(running)
+        self.assertTrue(burst[0].granted)
+        controller.release(burst[0])
+        self.assertTrue(other.granted)
+        self.assertFalse(burst[1].granted)
+
+    def test_unread_response_releases_its_ticket(self):
+        controller = AdmissionController(max_active=1, max_per_user=1, max_queue=1, max_queued_per_user=1)
+        ticket = controller.enqueue(1)
+        waiting = controller.enqueue(2)
+        with mock.patch('chatai.views.admission', controller):
+            response = StreamingHttpResponse(AdmittedStream(iter(['frame']), ticket))
+            response.close()
+        self.assertTrue(waiting.granted)
+        # 重复归还不会多放出名额
+        controller.release(ticket)
+        self.assertEqual(controller.enqueue(3).granted, False)
+
+
+class MetricsViewTest(SimpleTestCase):
+    def test_only_internal_addresses_and_admins_can_scrape(self):
+        factory = APIRequestFactory()
+        view = MetricsView.as_view()
+        self.assertEqual(view(factory.get('/metrics', REMOTE_ADDR='127.0.0.1')).status_code, 200)
+        self.assertIn(view(factory.get('/metrics', REMOTE_ADDR='10.0.0.5')).status_code, (401, 403))
+
+        request = factory.get('/metrics', REMOTE_ADDR='10.0.0.5')
+        force_authenticate(request, user=mock.Mock(is_admin=True, is_authenticated=True))
+        self.assertEqual(view(request).status_code, 200)
+
+    def test_multiprocess_dir_sums_every_worker(self):
+        from prometheus_client import generate_latest
+        from prometheus_client.values import MultiProcessValue
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            # 模拟两个 worker 进程各自写入的 gauge
+            for pid in (101, 102):
+                value = MultiProcessValue(lambda pid=pid: pid)(
+                    'gauge', 'chat_admission_active', 'chat_admission_active', (), (),
+                    'Chat generations currently running', multiprocess_mode='livesum')
+                value.set(2)
+            self.assertIn(b'chat_admission_active 4.0', generate_latest(collector_registry()))
+
+            mark_process_dead(101)
+            self.assertIn(b'chat_admission_active 2.0', generate_latest(collector_registry()))
+
+
+@unittest.skipIf(fakeredis is None or importlib.util.find_spec('lupa') is None, 'needs fakeredis with Lua scripting')
+class GlobalAdmissionTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(RedisSlots, '_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _process(self):
+        # 模拟同一个 Redis 后面的一个 uvicorn worker
+        return AdmissionController(max_active=2, max_per_user=1, max_queue=8, max_queued_per_user=4,
+                                   slots=RedisSlots(max_active=2, max_per_user=1, lease_ttl=30), poll_interval=0.05)
+
+    def test_limits_hold_across_processes(self):
+        first, second = self._process(), self._process()
+        a1 = first.enqueue(1)
+        self.assertTrue(first.wait(a1, 2))
+        a2 = second.enqueue(1)
+        b = second.enqueue(2)
+        self.assertTrue(second.wait(b, 2))
+        c = first.enqueue(3)
+        # 全局两个名额已满, 用户 1 在另一个进程也已经占了一个
+        self.assertFalse(second.wait(a2, 0.3))
+        self.assertFalse(first.wait(c, 0.1))
+
+        first.release(a1)
+        self.assertTrue(second.wait(a2, 2) or first.wait(c, 2))
+        self.assertEqual(sum(ticket.granted for ticket in (a2, c)), 1)
+        for controller, ticket in ((second, a2), (second, b), (first, c)):
+            controller.release(ticket)
+        # 后台线程把租约还给 Redis
+        deadline = time.monotonic() + 2
+        while self.redis.zcard(RedisSlots.ACTIVE_KEY) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.redis.zcard(RedisSlots.ACTIVE_KEY), 0)
+
+
+class SSEWriterTest(SimpleTestCase):
+    def test_frame_matches_json_envelope(self):
+        for content, finish_reason in [('token', 'continue'), ('引号"\n', 'continue'), ('', 'stop')]:
+            envelope = {'result': {'output': {'content': content}, 'metadata': {'finishReason': finish_reason}}}
+            self.assertEqual(sse_frame(content, finish_reason), f'data: {json.dumps(envelope)}\n\n')
+
+    def test_tokens_are_coalesced_up_to_max_chars(self):
+        tokens = []
+        frames = list(SSEWriter(max_chars=5, max_delay=60).frames(['a', 'b', 'cdefg', 'h', 'i'], tokens))
+        contents = [json.loads(frame[len('data: '):])['result']['output']['content'] for frame in frames]
+        self.assertEqual(contents, ['a', 'bcdefg', 'hi'])
+        self.assertEqual(tokens, ['a', 'b', 'cdefg', 'h', 'i'])
+
+
+class StageTimerTest(SimpleTestCase):
+    def test_stages_are_recorded_only_while_active(self):
+        timer = StageTimer()
+        with stage('ignored'):
+            pass
+        token = timer.activate()
+        try:
+            with stage('embed_query'):
+                pass
+            with stage('embed_query'):
+                pass
+        finally:
+            timer.deactivate(token)
+        with stage('ignored'):
+            pass
+        summary = timer.summary()
+        self.assertEqual(set(summary), {'embed_query', 'total'})
+        self.assertIn('embed_query;dur=', timer.server_timing())
+
+
+class OllamaEndpointPoolTest(SimpleTestCase):
+    def setUp(self):
+        self.pool = OllamaEndpointPool(['http://a', 'http://b'], probe_interval=5, probe_timeout=1, slow_probe=1,
+                                       eject_seconds=0, max_eject_seconds=0, cold_penalty=4)
+        self.a, self.b = self.pool.endpoints
+
+    def test_prefers_least_outstanding_with_model_loaded(self):
+        self.pool._record_probe(self.a, 0.01, ['llama3.3:latest'])
+        self.pool._record_probe(self.b, 0.01, [])
+        picked = [self.pool.acquire('llama3.3') for _ in range(6)]
+        self.assertEqual([endpoint.url for endpoint in picked], ['http://a'] * 5 + ['http://b'])
+        self.assertIsNone(self.pool.acquire('llama3.3', exclude=[self.a, self.b]))
+
+    def test_ejected_until_probe_succeeds(self):
+        self.pool.report_failure(self.a, 'connection refused')
+        self.assertIs(self.pool.acquire('llama3.3'), self.b)
+        self.assertIs(self.pool.acquire('llama3.3', exclude=[self.b]), self.a)
+        self.pool._record_probe(self.b, 0.01, [], TimeoutError())
+        self.pool._record_probe(self.a, 0.01, [])
+        self.assertFalse(self.a.ejected)
+        self.assertTrue(self.b.ejected)
+
+    def test_stream_fails_over_before_the_first_token(self):
+        class FakeLLM:
+            def __init__(self, url):
+                self.url = url
+
+            def stream(self, message):
+                if self.url == 'http://a':
+                    raise ConnectionError('connection refused')
+                yield from ['hello', ' world']
+
+        self.pool._record_probe(self.a, 0.01, ['llama3.3'])
+        with mock.patch('chatai.chat_models.ollama_pool.client_registry.ollama_llm',
+                        side_effect=lambda model, url, health_check: FakeLLM(url)) as ollama_llm:
+            tokens = list(RoutedOllamaModel(pool=self.pool).chat_stream('hi'))
+        self.assertEqual(tokens, ['hello', ' world'])
+        self.assertEqual([call.args[1] for call in ollama_llm.call_args_list], ['http://a', 'http://b'])
+        self.assertTrue(self.a.ejected)
+        self.assertEqual([self.a.outstanding, self.b.outstanding], [0, 0])
+
+
+class OpenAIModelTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 假服务跑在后台线程的事件循环里, 同时提供 OpenAI 兼容接口
+        cls.loop = asyncio.new_event_loop()
+        cls.server = FakeOllama(tokens_per_second=1000, ttft=0, reply_tokens=5)
+        cls.loop.run_until_complete(cls.server.start(port=0))
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.server.close(), cls.loop).result()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        super().tearDownClass()
+
+    def setUp(self):
+        config = {**settings.OPENAI, 'BASE_URL': f'http://127.0.0.1:{self.server.port}/v1'}
+        override = self.settings(OPENAI=config)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.expected = ''.join(f'token{i} ' for i in range(5))
+
+    def test_stream_and_response(self):
+        model = OpenAIModel('fake-model')
+        self.assertEqual(''.join(model.chat_stream('hi')), self.expected)
+        self.assertEqual(''.join(model.chat_stream_rag('hi', [Document(page_content='context')])), self.expected)
+        self.assertEqual(model.chat_response('hi'), self.expected)
+
+    def test_async_stream(self):
+        async def collect():
+            return ''.join([token async for token in OpenAIModel('fake-model').achat_stream('hi')])
+        self.assertEqual(asyncio.run(collect()), self.expected)
+
+
+@unittest.skipUnless(fakeredis, 'needs fakeredis')
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('chatai.single_flight.get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.flight = SingleFlight(lock_ttl=10, linger=1, idle_timeout=5)
+
+    def test_generation_outlives_the_leader_connection(self):
+        def frames():
+            for frame in ['a', 'b', 'c']:
+                time.sleep(0.05)
+                yield frame
+
+        self.assertTrue(self.flight.acquire('key'))
+        self.assertFalse(self.flight.acquire('key'))
+        leader = self.flight.lead('key', frames())
+        self.assertEqual(next(leader), 'a')
+        leader.close()
+        self.assertEqual(list(self.flight.follow('key')), ['a', 'b', 'c'])
+
+    def test_heartbeat_keeps_a_slow_flight_attachable(self):
+        self.flight = SingleFlight(lock_ttl=1, linger=1, idle_timeout=5)
+        def frames():
+            yield 'a'
+            time.sleep(1.5)
+            yield 'b'
+
+        self.assertTrue(self.flight.acquire('key'))
+        leader = self.flight.lead('key', frames())
+        self.assertEqual(next(leader), 'a')
+        time.sleep(1.2)
+        self.assertFalse(self.flight.acquire('key'))
+        self.assertEqual(list(leader), ['b'])
+
+    def test_followers_of_a_dead_leader_get_an_error_frame(self):
+        self.flight = SingleFlight(lock_ttl=1, linger=1, idle_timeout=5)
+        # 发起者写了一帧后进程崩溃, 锁不再续期
+        self.assertTrue(self.flight.acquire('key'))
+        self.redis.xadd(SingleFlight.STREAM.format('key'), {'frame': 'a'})
+        started = time.monotonic()
+        self.assertEqual(list(self.flight.follow('key')), ['a', error_frame()])
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertTrue(self.flight.acquire('key'))
+
+    def test_failure_before_first_frame_ends_followers(self):
+        def frames():
+            raise ConnectionError('model is down')
+            yield
 
-model = OllamaModel()
-res = model.chat_response("what is the smallest prime number")
-print(res)
\ No newline at end of file
+        leader = self.flight.lead('key', frames())
+        self.assertEqual(list(leader), [error_frame()])
+        self.assertEqual(list(self.flight.follow('key')), [error_frame()])
@@ -1,65 +1,213 @@
+import asyncio
 import logging
 import json
+import time
 from typing import Any
-from django.http import StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import BasePermission
 from rest_framework.views import APIView
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework import status
 
-from .chat_models import OllamaModel, ElasticSearchRAG, RAG, VectoreDatabase
+from .admission import QueueFull, admission
+from .answer_cache import answer_cache, replay_chunks
+from .chat_models import RAG, VectoreDatabase, get_chat_model, get_rag
+from .chat_models.context_packer import ContextPacker, estimate_tokens
+from .single_flight import single_flight
+from .metrics import current_timer, metrics_view, observe, stage
+from .sse import SSEWriter, sse_frame, stop_frame
 
+from backend.authentications import CookieJWTAuthentication
+from user.message_buffer import message_buffer
 from user.models import Message, Session
 
 LOGGER = logging.getLogger(__name__)
 
+sse_writer = SSEWriter(max_chars=settings.SSE_WRITER['MAX_CHARS'], max_delay=settings.SSE_WRITER['MAX_DELAY'])
+
+context_packer = ContextPacker(
+    token_budget=settings.RAG_CONTEXT['TOKEN_BUDGET'],
+    min_overlap=settings.RAG_CONTEXT['MIN_OVERLAP'],
+    duplicate_threshold=settings.RAG_CONTEXT['DUPLICATE_THRESHOLD'],
+)
+
+def queue_frame(position: int) -> str:
+    # 内容为空, 旧前端会直接忽略这类帧
+    result_data = {
+        'result': {
+            'output': {
+                'content': ''
+            },
+            'metadata': {
+                'finishReason': 'queued',
+                'queuePosition': position
+            }
+        }
+    }
+    return f"data: {json.dumps(result_data)}\n\n"
+
+def queue_full_response(error: QueueFull):
+    return JsonResponse({"message": "当前请求较多, 请稍后再试"}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': str(error.retry_after)})
+
+def finish_frame() -> str:
+    # 最后一帧带上本轮各阶段耗时, 同时记录到日志
+    timer = current_timer()
+    if timer is None:
+        return stop_frame()
+    timing = timer.summary()
+    LOGGER.info(f'Chat turn stages (ms): {timing}')
+    return stop_frame(timing)
+
+def timed_stream(timer, stream):
+    # 生成器在视图返回后才执行, 且在 ASGI 下每一帧可能跑在不同线程, 每次取帧前都要重新激活计时器
+    iterator = iter(stream)
+    while True:
+        token = timer.activate()
+        try:
+            frame = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timer.deactivate(token)
+        yield frame
+
+async def atimed_stream(timer, stream):
+    # 异步生成器始终在同一个任务里迭代, 激活一次即可
+    timer.activate()
+    async for frame in stream:
+        yield frame
+
+def admitted(ticket, stream):
+    # 排队期间定期告知位置, 轮到后才开始检索和生成; 无论如何结束都要归还名额
+    try:
+        while not admission.wait(ticket, settings.ADMISSION['POSITION_INTERVAL']):
+            yield queue_frame(admission.position(ticket))
+        observe('admission_wait', ticket.granted_at - ticket.enqueued_at)
+        yield from stream
+    finally:
+        admission.release(ticket)
+
+async def aadmitted(ticket, stream):
+    try:
+        while not await admission.await_grant(ticket, settings.ADMISSION['POSITION_INTERVAL']):
+            yield queue_frame(admission.position(ticket))
+        observe('admission_wait', ticket.granted_at - ticket.enqueued_at)
+        async for frame in stream:
+            yield frame
+    finally:
+        await stream.aclose()
+        admission.release(ticket)
+
+class AdmittedStream:
+    """
+    Streaming content holding an admission ticket. Django calls close()
+    when the response is closed, which releases the ticket even if the body
+    was never iterated
+    """
+    def __init__(self, stream, ticket) -> None:
+        self._stream = stream
+        self._ticket = ticket
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __aiter__(self):
+        return aiter(self._stream)
+
+    def close(self) -> None:
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+        admission.release(self._ticket)
+
+def pack_context(docs):
+    with stage('context_pack'):
+        packed = context_packer.pack(docs)
+    LOGGER.info(f'Find {len(docs)} file blocks, packed into {len(packed)} passages '
+                f'(~{sum(estimate_tokens(doc.page_content) for doc in packed)} tokens)')
+    return packed
+
+def save_reply(session, tokens) -> None:
+    # 流结束或客户端中断时保存(部分)回复, 由 write-behind 缓冲批量写入
+    if tokens:
+        message_buffer.add(session.id, 'model', ''.join(tokens))
+
+def replay_answer(answer, session):
+    # 命中答案缓存时按配置的速度重放, 前端收到的帧与实时生成时一致
+    sent = []
+    try:
+        for chunk, delay in replay_chunks(answer):
+            sent.append(chunk)
+            yield sse_frame(chunk)
+            if delay:
+                time.sleep(delay)
+
+        yield finish_frame()
+    finally:
+        save_reply(session, sent)
+
+async def areplay_answer(answer, session):
+    sent = []
+    try:
+        for chunk, delay in replay_chunks(answer):
+            sent.append(chunk)
+            yield sse_frame(chunk)
+            if delay:
+                await asyncio.sleep(delay)
+
+        yield finish_frame()
+    finally:
+        save_reply(session, sent)
+
 # Create your views here.
 class ChatView(APIView):
     def __init__(self, **kwargs: Any) -> None:
         super().__init__(**kwargs)
-        self._model = OllamaModel()
+        self._model = get_chat_model()
         self._use_rag = True
 
-    def _event_stream(self, message):
-        finished = False
-        for token in self._model.chat_stream(message):
-            result_data = {
-                'result': {
-                    'output': {
-                        'content': token
-                    },
-                    'metadata': {
-                        'finishReason': 'continue'
-                    }
-                }
-            }
-            yield f"data: {json.dumps(result_data)}\n\n" # SSE需要\n\n
+    def _event_stream(self, message, session):
+        tokens = []
+        try:
+            yield from sse_writer.frames(self._model.chat_stream(message), tokens)
 
-        if not finished:
-            yield f"data: {json.dumps({'result': {'output': {'content': ''}, 'metadata': {'finishReason': 'stop'}}})}\n\n"
+            yield finish_frame()
+        finally:
+            save_reply(session, tokens)
 
-    def _event_stream_rag(self, message, user):
-        releated_docs = ElasticSearchRAG.search_documents(message, str(VectoreDatabase.get_db_dir(user) / 'vector'))
-        LOGGER.info(f'Find {len(releated_docs)} file blocks')
+    def _cached_answer(self, message, user):
+        """
+        (cached answer or None, cache key, query embedding); the key is None
+        when the answer cache is off for this request
+        """
+        if not (self._use_rag and answer_cache.enabled_for(user)):
+            return None, None, None
+        embedding = RAG.embed_query(message)
+        with stage('answer_cache'):
+            cache_key = answer_cache.key(user)
+            return answer_cache.lookup(cache_key, embedding), cache_key, embedding
+
+    def _event_stream_rag(self, message, user, session, cache_key=None, embedding=None):
+        releated_docs = pack_context(get_rag().search_documents(message, str(VectoreDatabase.get_db_dir(user) / 'vector')))
         for doc in releated_docs:
             LOGGER.info(doc)
 
-        finished = False
-        for token in self._model.chat_stream_rag(message, releated_docs):
-            result_data = {
-                'result': {
-                    'output': {
-                        'content': token
-                    },
-                    'metadata': {
-                        'finishReason': 'stop' if finished else 'continue'
-                    }
-                }
-            }
-            yield f"data: {json.dumps(result_data)}\n\n"
+        tokens = []
+        try:
+            yield from sse_writer.frames(self._model.chat_stream_rag(message, releated_docs), tokens)
 
-        if not finished:
-            yield f"data: {json.dumps({'result': {'output': {'content': ''}, 'metadata': {'finishReason': 'stop'}}})}\n\n"
+            if cache_key is not None:
+                answer_cache.store(cache_key, embedding, ''.join(tokens))
+            yield finish_frame()
+        finally:
+            save_reply(session, tokens)
 
     def post(self, request: Request):
         message = request.data.get('message', None)
@@ -69,12 +217,180 @@ class ChatView(APIView):
         
         user = request.user
         LOGGER.info(f"{user.nickname} Sent Message: {message}")
-        session = Session.objects.get(id=session_id)
-        Message.objects.create(session=session, role='user', content=message)
+        try:
+            with stage('session_lookup'):
+                session = Session.objects.get(id=session_id, user=user)
+        except Session.DoesNotExist:
+            return Response({"message": "会话不存在"}, status=status.HTTP_404_NOT_FOUND)
+
+        # 命中答案缓存时直接重放, 不排队占用生成名额
+        cached, cache_key, embedding = self._cached_answer(message, user)
+        if cached is not None:
+            with stage('message_write'):
+                Message.objects.create(session=session, role='user', content=message)
+            return StreamingHttpResponse(replay_answer(cached, session), content_type='text/event-stream')
+
+        try:
+            ticket = admission.enqueue(user.id)
+        except QueueFull as e:
+            return queue_full_response(e)
+
+        # 从排队到返回响应之间任何一步出错都要归还名额, 否则这个进程永久少一个并发
+        try:
+            # 相同的请求并发到达时只有第一个生成, 其余跟随它的输出, 也不重复保存消息
+            coalesce = settings.SINGLE_FLIGHT['ENABLED']
+            if coalesce:
+                flight_key = single_flight.flight_key(user.id, session.id, message)
+                if not single_flight.acquire(flight_key):
+                    admission.release(ticket)
+                    LOGGER.info(f'Attach {user.nickname} to an identical request in flight')
+                    return StreamingHttpResponse(single_flight.follow(flight_key), content_type='text/event-stream')
+
+            with stage('message_write'):
+                Message.objects.create(session=session, role='user', content=message)
+
+            stream = self._event_stream_rag(message, user, session, cache_key, embedding) if self._use_rag \
+                else self._event_stream(message, session)
+            stream = timed_stream(request.stage_timer, admitted(ticket, stream))
+            if coalesce:
+                # 生成在后台跑完, 发起者断开也不影响跟随者; 名额由后台生成归还
+                stream = single_flight.lead(flight_key, stream)
+            else:
+                stream = AdmittedStream(stream, ticket)
+            return StreamingHttpResponse(stream, content_type='text/event-stream')
+        except BaseException:
+            admission.release(ticket)
+            raise
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    """
+    Async variant of ChatView, enabled by settings.CHAT_ASYNC_STREAMING.
+
+    Served through backend/asgi.py, every open SSE stream is a coroutine on the
+    event loop instead of a worker thread, so one process can hold hundreds of
+    concurrent generations.
+    """
+    authentication = CookieJWTAuthentication()
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # 视图在事件循环上构造, 不能在这里做阻塞的健康检查; Ollama 出错时由流本身报错
+        self._model = get_chat_model(health_check=False)
+        self._use_rag = True
+
+    async def _event_stream(self, message, session):
+        tokens = []
+        try:
+            async for frame in sse_writer.aframes(self._model.achat_stream(message), tokens):
+                yield frame
+
+            yield finish_frame()
+        finally:
+            save_reply(session, tokens)
+
+    async def _cached_answer(self, message, user):
+        if not (self._use_rag and answer_cache.enabled_for(user)):
+            return None, None, None
+        embedding = await sync_to_async(RAG.embed_query, thread_sensitive=False)(message)
+        with stage('answer_cache'):
+            cache_key = await sync_to_async(answer_cache.key, thread_sensitive=False)(user)
+            cached = await sync_to_async(answer_cache.lookup, thread_sensitive=False)(cache_key, embedding)
+        return cached, cache_key, embedding
+
+    async def _event_stream_rag(self, message, user, session, cache_key=None, embedding=None):
+        db_dir = str(VectoreDatabase.get_db_dir(user) / 'vector')
+        releated_docs = pack_context(await get_rag().asearch_documents(message, db_dir))
+
+        tokens = []
+        try:
+            async for frame in sse_writer.aframes(self._model.achat_stream_rag(message, releated_docs), tokens):
+                yield frame
+
+            if cache_key is not None:
+                await sync_to_async(answer_cache.store, thread_sensitive=False)(cache_key, embedding, ''.join(tokens))
+            yield finish_frame()
+        finally:
+            save_reply(session, tokens)
+
+    async def post(self, request):
+        try:
+            auth = await sync_to_async(self.authentication.authenticate)(request)
+        except AuthenticationFailed:
+            auth = None
+        if auth is None:
+            return JsonResponse({'code': 'token_not_valid',
+                                 'message': 'Token is invalid or expired. Please log in again.'},
+                                status=status.HTTP_401_UNAUTHORIZED)
+        user = auth[0]
+
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            data = {}
+        message = data.get('message', None)
+        session_id = data.get('session_id', None)
+        if not message or not session_id:
+            return JsonResponse({"message": "参数错误"}, status=status.HTTP_400_BAD_REQUEST)
+
+        LOGGER.info(f"{user.nickname} Sent Message: {message}")
+        try:
+            with stage('session_lookup'):
+                session = await Session.objects.aget(id=session_id, user=user)
+        except Session.DoesNotExist:
+            return JsonResponse({"message": "会话不存在"}, status=status.HTTP_404_NOT_FOUND)
+
+        cached, cache_key, embedding = await self._cached_answer(message, user)
+        if cached is not None:
+            with stage('message_write'):
+                await Message.objects.acreate(session=session, role='user', content=message)
+            return StreamingHttpResponse(areplay_answer(cached, session), content_type='text/event-stream')
+
+        try:
+            ticket = admission.enqueue(user.id)
+        except QueueFull as e:
+            return queue_full_response(e)
+
+        try:
+            coalesce = settings.SINGLE_FLIGHT['ENABLED']
+            if coalesce:
+                flight_key = single_flight.flight_key(user.id, session.id, message)
+                if not await single_flight.aacquire(flight_key):
+                    admission.release(ticket)
+                    LOGGER.info(f'Attach {user.nickname} to an identical request in flight')
+                    return StreamingHttpResponse(single_flight.afollow(flight_key), content_type='text/event-stream')
+
+            with stage('message_write'):
+                await Message.objects.acreate(session=session, role='user', content=message)
+
+            stream = self._event_stream_rag(message, user, session, cache_key, embedding) if self._use_rag \
+                else self._event_stream(message, session)
+            stream = atimed_stream(request.stage_timer, aadmitted(ticket, stream))
+            if coalesce:
+                stream = single_flight.alead(flight_key, stream)
+            else:
+                stream = AdmittedStream(stream, ticket)
+            return StreamingHttpResponse(stream, content_type='text/event-stream')
+        except BaseException:
+            admission.release(ticket)
+            raise
+
+class MetricsPermission(BasePermission):
+    """
+    Prometheus scrapes from METRICS_ALLOWED_IPS without logging in; anyone
+    else must be an admin user
+    """
+    def has_permission(self, request, view):
+        if request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS:
+            return True
+        return bool(getattr(request.user, 'is_admin', False))
+
+class MetricsView(APIView):
+    permission_classes = [MetricsPermission]
+
+    def get(self, request):
+        return metrics_view(request)
 
-        return StreamingHttpResponse(self._event_stream_rag(message, user) if self._use_rag else self._event_stream(message), 
-                                     content_type='text/event-stream')
-    
 class DebugView(APIView):
     def get(self, request):
         LOGGER.info('Successfully Get Request!')
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+
+from .models import Message
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer for chat messages.
+
+    `add` only enqueues; a daemon thread drains the queue and inserts rows
+    with one bulk_create per `max_batch` messages or per `flush_interval`
+    seconds, whichever comes first. A failed batch is retried `retries`
+    times with exponential backoff, then written row by row so only the
+    rows that cannot be inserted are lost.
+    """
+    def __init__(self, max_batch: int, flush_interval: float, retries: int = 3, retry_delay: float = 0.5) -> None:
+        self._max_batch = max_batch
+        self._flush_interval = flush_interval
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, session_id: int, role: str, content: str) -> None:
+        self._queue.put(Message(session_id=session_id, role=role, content=content))
+        if self._thread is None:
+            self._start()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-write-buffer', daemon=True)
+                self._thread.start()
+
+    def _drain(self, block: bool):
+        batch = []
+        try:
+            batch.append(self._queue.get() if block else self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+
+        # 拿到第一条后最多再等 flush_interval, 把同一波结束的回复合并写入
+        deadline = time.monotonic() + (self._flush_interval if block else 0)
+        while len(batch) < self._max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch) -> None:
+        for attempt in range(self._retries + 1):
+            try:
+                # 断开的连接在这里关闭, 下次查询时重连
+                close_old_connections()
+                with transaction.atomic():
+                    Message.objects.bulk_create(batch)
+                return
+            except IntegrityError as e:
+                # 数据本身有问题 (例如会话已删除), 重试没有意义
+                LOGGER.warning(f'Failed to write {len(batch)} buffered messages: {e}')
+                break
+            except Exception as e:
+                LOGGER.warning(f'Failed to write {len(batch)} buffered messages (attempt {attempt + 1}): {e}')
+                if attempt < self._retries:
+                    time.sleep(self._retry_delay * 2 ** attempt)
+
+        # 整批写不进去时逐条写入, 只丢弃失败的那几条
+        for message in batch:
+            try:
+                close_old_connections()
+                with transaction.atomic():
+                    message.save(force_insert=True)
+            except Exception:
+                LOGGER.exception(f'Dropped buffered {message.role} message of session {message.session_id}')
+
+    def _run(self) -> None:
+        while True:
+            batch = self._drain(block=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self) -> None:
+        batch = self._drain(block=False)
+        while batch:
+            self._write(batch)
+            batch = self._drain(block=False)
+
+
+message_buffer = MessageWriteBuffer(settings.MESSAGE_WRITE_BUFFER['MAX_BATCH'],
+                                    settings.MESSAGE_WRITE_BUFFER['FLUSH_INTERVAL'],
+                                    settings.MESSAGE_WRITE_BUFFER['RETRIES'],
+                                    settings.MESSAGE_WRITE_BUFFER['RETRY_DELAY'])
+atexit.register(message_buffer.flush)
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0002_session_message"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(
+                fields=["user", "is_visible", "created_at"],
+                name="session_user_visible_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["session", "created_at"], name="message_session_created_idx"
+            ),
+        ),
+    ]
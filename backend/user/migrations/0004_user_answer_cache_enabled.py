@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0003_session_message_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="answer_cache_enabled",
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -2,7 +2,29 @@ from django.db import models
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 
-class CustomUserManager(BaseUserManager):
+class UserQuerySet(models.QuerySet):
+    """
+    QuerySet.update skips the post_save signal, so the cached principals of
+    the updated users are invalidated here
+    """
+    def update(self, **kwargs):
+        from backend.authentications import principal_cache
+
+        user_ids = list(self.values_list('id', flat=True))
+        rows = super().update(**kwargs)
+        for user_id in user_ids:
+            principal_cache.invalidate(user_id)
+        return rows
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        from backend.authentications import principal_cache
+
+        rows = super().bulk_update(objs, fields, batch_size=batch_size)
+        for obj in objs:
+            principal_cache.invalidate(obj.pk)
+        return rows
+
+class CustomUserManager(BaseUserManager.from_queryset(UserQuerySet)):
     def create_user(self, nickname, email, password=None):
         if not email:
             raise ValueError('The Email field must be set')
@@ -30,6 +52,7 @@ class User(AbstractBaseUser):
     password = models.CharField(max_length=128)
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
+    answer_cache_enabled = models.BooleanField(default=True)  # 关闭后每个问题都重新检索和生成
 
     objects = CustomUserManager()
 
@@ -60,6 +83,11 @@ class Session(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_visible = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_visible', 'created_at'], name='session_user_visible_idx'),
+        ]
+
     def __str__(self):
         return f"{self.session_name}"
 
@@ -69,5 +97,10 @@ class Message(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['session', 'created_at'], name='message_session_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.role}: {self.content}({self.created_at})"
\ No newline at end of file
@@ -0,0 +1,46 @@
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+
+
+def encode_cursor(obj) -> str:
+    raw = f'{obj.created_at.isoformat()}|{obj.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Raise ValueError if the cursor was not produced by encode_cursor
+    """
+    try:
+        created_at, obj_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(obj_id)
+    except (UnicodeDecodeError, ValueError, TypeError) as e:
+        raise ValueError(f'invalid cursor: {cursor}') from e
+
+
+def parse_limit(value: Optional[str]) -> int:
+    limit = int(value) if value else settings.PAGE_SIZE
+    if limit <= 0:
+        raise ValueError(f'invalid limit: {value}')
+    return min(limit, settings.MAX_PAGE_SIZE)
+
+
+def keyset_page(queryset: QuerySet, cursor: Optional[str], limit: int):
+    """
+    Newest-first page of `queryset` strictly older than `cursor`, ordered by
+    (created_at, id) so it is served from the (..., created_at) indexes.
+    Returns the items and the cursor of the next (older) page, or None.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, obj_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=obj_id))
+
+    items = list(queryset[:limit + 1])
+    has_more = len(items) > limit
+    items = items[:limit]
+    return items, encode_cursor(items[-1]) if has_more else None
@@ -10,4 +10,5 @@ class MessageSerializer(ModelSerializer):
 class UserSerializer(ModelSerializer):
     class Meta:
         model = User
-        fields = ['email', 'nickname']
\ No newline at end of file
+        fields = ['email', 'nickname', 'answer_cache_enabled']
+        read_only_fields = ['email', 'nickname']
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from backend.authentications import principal_cache
+from .models import User
+
+# 用户信息变更或停用后立即让缓存的登录身份失效
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_principal(sender, instance, **kwargs):
+    principal_cache.invalidate(instance.id)
@@ -1,8 +1,147 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest import mock
+
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.contrib.auth.hashers import make_password, check_password
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from backend.authentications import principal_cache
+from .message_buffer import MessageWriteBuffer
+from .models import Message, Session, User
+from .pagination import decode_cursor, encode_cursor, keyset_page
+from .views import SessionView, UserView
 # Create your tests here.
 class UserTest(TestCase):
     def test_generate_password(self):
         encrypt = make_password('1')
         print(encrypt)
         self.assertTrue(check_password('1', encrypt))
+
+class CursorTest(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        created_at = timezone.now()
+        cursor = encode_cursor(SimpleNamespace(created_at=created_at, id=42))
+        self.assertEqual(decode_cursor(cursor), (created_at, 42))
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PrincipalCacheTest(TestCase):
+    def test_cached_principal_is_partial_and_read_only(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        principal_cache.get(user.id)
+        cached = principal_cache.get(user.id)
+        self.assertEqual((cached.email, cached.nickname), ('nick@example.com', 'nick'))
+        self.assertNotIn('password', principal_cache._dump(cached))
+        self.assertIn('password', cached.get_deferred_fields())
+        with self.assertRaises(TypeError):
+            cached.save()
+
+    def test_update_does_not_write_back_stale_fields(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        cached = principal_cache.get(user.id)
+        User.objects.filter(id=user.id).update(nickname='renamed')
+
+        request = APIRequestFactory().put('/user/info/', {'answer_cache_enabled': False}, format='json')
+        force_authenticate(request, user=cached)
+        response = UserView.as_view({'put': 'update'})(request)
+
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertEqual((user.nickname, user.answer_cache_enabled), ('renamed', False))
+        self.assertFalse(principal_cache.get(user.id).answer_cache_enabled)
+
+    def test_queryset_update_invalidates_principal(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        self.assertTrue(principal_cache.get(user.id).is_active)
+        User.objects.filter(id=user.id).update(is_active=False)
+        self.assertFalse(principal_cache.get(user.id).is_active)
+
+    def test_invalidate_survives_cache_outage(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        principal_cache.get(user.id)
+        with mock.patch('backend.authentications.cache.delete', side_effect=ConnectionError('down')):
+            self.assertEqual(User.objects.filter(id=user.id).update(nickname='renamed'), 1)
+        self.assertIsNone(principal_cache._local.get(user.id))
+
+    def test_lookups_are_exported(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        before = REGISTRY.get_sample_value('principal_cache_lookups_total', {'source': 'local'}) or 0
+        principal_cache.get(user.id)
+        principal_cache.get(user.id)
+        self.assertEqual(REGISTRY.get_sample_value('principal_cache_lookups_total', {'source': 'local'}) - before, 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MessageWriteBufferTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        self.session = Session.objects.create(user=user, session_name='s')
+        self.buffer = MessageWriteBuffer(max_batch=10, flush_interval=0, retries=2, retry_delay=0)
+
+    def test_failed_batch_is_retried(self):
+        bulk_create = Message.objects.bulk_create
+        calls = []
+
+        def flaky(batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise OperationalError('server has gone away')
+            return bulk_create(batch)
+
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=flaky):
+            self.buffer._write([Message(session=self.session, role='user', content=text) for text in 'ab'])
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(sorted(Message.objects.values_list('content', flat=True)), ['a', 'b'])
+
+    def test_bad_row_does_not_drop_the_batch(self):
+        batch = [Message(session=self.session, role='user', content=text) for text in ('a', None, 'b')]
+        with self.assertLogs('user.message_buffer', 'ERROR'):
+            self.buffer._write(batch)
+        self.assertEqual(sorted(Message.objects.values_list('content', flat=True)), ['a', 'b'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class KeysetPageTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('nick', 'nick@example.com', 'secret')
+        self.session = Session.objects.create(user=self.user, session_name='s')
+
+    def _pages(self, queryset, limit):
+        pages, cursor = [], None
+        while True:
+            items, cursor = keyset_page(queryset, cursor, limit)
+            pages.append([item.id for item in items])
+            if cursor is None:
+                return pages
+
+    def test_equal_timestamps_are_paged_by_id(self):
+        ids = [Message.objects.create(session=self.session, role='user', content=str(i)).id for i in range(5)]
+        Message.objects.update(created_at=timezone.now())
+
+        pages = self._pages(Message.objects.filter(session=self.session), 2)
+
+        self.assertEqual(pages, [ids[4:2:-1], ids[2:0:-1], ids[:1]])
+
+    def test_last_page_has_no_next(self):
+        sessions = [Session.objects.create(user=self.user, session_name=str(i)) for i in range(3)]
+        queryset = Session.objects.filter(user=self.user)
+
+        self.assertEqual(len(self._pages(queryset, 2)), 2)
+        items, cursor = keyset_page(queryset, None, 4)
+        self.assertEqual((len(items), cursor), (len(sessions) + 1, None))
+
+    def test_invalid_cursor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            keyset_page(Session.objects.all(), 'bm90LWEtY3Vyc29y', 2)
+
+        request = APIRequestFactory().get('/session/', {'cursor': 'not-a-cursor'})
+        force_authenticate(request, user=self.user)
+        response = SessionView.as_view({'get': 'list'})(request)
+        self.assertEqual(response.status_code, 400)
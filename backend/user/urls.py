@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import EmailView, RegisterView, LoginView, SessionView, MessageView, UserView, KnowledgeView
+from .views import EmailView, RegisterView, LoginView, SessionView, MessageView, UserView, KnowledgeView, KnowledgeJobView
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
@@ -9,7 +9,9 @@ urlpatterns = [
     path('session/<int:session_id>/', SessionView.as_view({'delete': 'destroy', 'put': 'update'}), name='delete-session'),
     path('message/<int:session_id>/', MessageView.as_view({'get': 'list'}, name='all-message')),
     path('message/', MessageView.as_view({'post': 'create'}), name='new-message'),
-    path('info/', UserView.as_view({'get': 'retrieve'}), name='user-info'),
+    path('info/', UserView.as_view({'get': 'retrieve', 'put': 'update'}), name='user-info'),
     path('knowledge/', KnowledgeView.as_view({'get': 'list', 'post': 'create'}), name='upload-knowledge'),
+    path('knowledge/job/<str:job_id>/', KnowledgeJobView.as_view({'get': 'retrieve', 'delete': 'destroy'}), name='knowledge-job'),
+    path('knowledge/job/<str:job_id>/retry/', KnowledgeJobView.as_view({'post': 'retry'}), name='retry-knowledge-job'),
     path('knowledge/<str:knowledge_name>/', KnowledgeView.as_view({'delete': 'destroy'}), name='delete-knowledge'),
 ]
@@ -19,10 +19,15 @@ from rest_framework.viewsets import GenericViewSet
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from backend.authentications import principal_cache
 from .models import User, Session, Message
+from .pagination import keyset_page, parse_limit
 from .serializers import MessageSerializer, UserSerializer
+from chatai.chat_models.knowledge_version import bump_version
+from chatai.chat_models.vector_db import VectoreDatabase, get_vector_db
 from chatai.file_parser.parser_factory import ParserFactory
-from chatai.chat_models.vector_db import VectoreDatabase, ElasticSearchVDB
+from chatai.ingestion import ChunkManifest, IngestJob
+from chatai.metrics import stage
 
 LOGGER = logging.getLogger(__name__)
 # 连接 Redis
@@ -153,10 +158,16 @@ class SessionView(CreateModelMixin,
     
     def list(self, request, *args, **kwargs):
         """
-        List all visible sessions for user.
+        List visible sessions for user, newest first, `limit` per page.
+        Pass the returned `next` as `cursor` to get the following page.
         """
         user = request.user
-        sessions = Session.objects.filter(user=user, is_visible=True).order_by('-created_at')
+        sessions = Session.objects.filter(user=user, is_visible=True)
+        try:
+            sessions, next_cursor = keyset_page(sessions, request.query_params.get('cursor'),
+                                                parse_limit(request.query_params.get('limit')))
+        except ValueError:
+            return Response({'message': '参数错误'}, status=status.HTTP_400_BAD_REQUEST)
 
         session_data = [
             {
@@ -168,7 +179,7 @@ class SessionView(CreateModelMixin,
             for session in sessions
         ]
 
-        return Response(session_data, status=status.HTTP_200_OK)
+        return Response({'results': session_data, 'next': next_cursor}, status=status.HTTP_200_OK)
 
     def destroy(self, request, *args, **kwargs):
         """
@@ -209,7 +220,8 @@ class MessageView(CreateModelMixin, ListModelMixin, GenericViewSet):
 
     def list(self, request, *args, **kwargs):
         """
-        Show all messages in a session asc by create_time
+        Show the newest `limit` messages in a session asc by create_time.
+        Pass the returned `next` as `cursor` to load older messages.
         """
         user = request.user
         session_id = kwargs.get('session_id', None)
@@ -218,13 +230,18 @@ class MessageView(CreateModelMixin, ListModelMixin, GenericViewSet):
             return Response({'message': '参数错误'}, status=status.HTTP_400_BAD_REQUEST)
 
         messages = Message.objects.filter(session_id=session_id, session__user=user)
-        messages = messages.order_by('created_at')
+        try:
+            messages, next_cursor = keyset_page(messages, request.query_params.get('cursor'),
+                                                parse_limit(request.query_params.get('limit')))
+        except ValueError:
+            return Response({'message': '参数错误'}, status=status.HTTP_400_BAD_REQUEST)
+        messages.reverse()
 
         serializer = self.get_serializer(messages, many=True)
         
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response({'results': serializer.data, 'next': next_cursor}, status=status.HTTP_200_OK)
 
-class UserView(RetrieveModelMixin, GenericViewSet):
+class UserView(RetrieveModelMixin, UpdateModelMixin, GenericViewSet):
     serializer_class = UserSerializer
 
     def retrieve(self, request, *args, **kwargs):
@@ -232,18 +249,35 @@ class UserView(RetrieveModelMixin, GenericViewSet):
         serializer = self.get_serializer(user)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    def update(self, request, *args, **kwargs):
+        # 目前只有答案缓存开关可以修改; request.user 来自登录身份缓存, 可能过期, 修改前从库里重新读取
+        user = User.objects.get(pk=request.user.pk)
+        serializer = self.get_serializer(user, data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        for name, value in serializer.validated_data.items():
+            setattr(user, name, value)
+        user.save(update_fields=list(serializer.validated_data))
+        principal_cache.invalidate(user.pk)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 class KnowledgeView(CreateModelMixin, DestroyModelMixin, ListModelMixin, GenericViewSet):
     parser_classes = (MultiPartParser, FormParser)  # 允许解析multipart/form-data
 
-    def _vectorize_doc(self, file_path, vector_path):
-        parser = ParserFactory.get_parser(file_path)()
-        docs = parser.parse(file_path)
-        ElasticSearchVDB.store(docs, str(vector_path))
+    @staticmethod
+    def _cancel_job(file_path):
+        job = IngestJob.active_for(str(file_path))
+        if job is not None and job.cancel():
+            LOGGER.info(f'Cancelled ingest job {job.id} of {file_path}')
 
     def create(self, request, *args, **kwargs):
         file = request.FILES.get('file')
         if not file:
             return Response({'message': '未收到文件'}, status=400)
+        try:
+            with stage('parser_lookup'):
+                ParserFactory.get_parser(file.name, file.content_type)
+        except ValueError as e:
+            return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         # store file to /xxx/email/xxx path
         dir = VectoreDatabase.get_db_dir(request.user)
@@ -252,19 +286,27 @@ class KnowledgeView(CreateModelMixin, DestroyModelMixin, ListModelMixin, Generic
             os.makedirs(dir / 'file')
             os.makedirs(dir / 'vector')
         file_path = dir / 'file' / file.name
-        vector_path = dir / 'vector' / file.name.split('.')[0]
+        # 同名文件还在排队或处理中时先取消, 免得两个任务同时改写同一份清单
+        self._cancel_job(file_path)
+        # 以完整文件名区分, a.pdf 和 a.md 各有自己的向量目录和文档块清单
+        vector_path = dir / 'vector' / file.name
         if os.path.exists(file_path):
             os.remove(file_path)
-        if os.path.exists(vector_path):
+        # 增量模式下保留旧向量, 由 worker 对比文档块清单后只更新变化部分
+        if os.path.exists(vector_path) and not settings.INGEST_INCREMENTAL:
             shutil.rmtree(vector_path)
         
-        with open(file_path, 'wb+') as destination:
+        with stage('upload_save'), open(file_path, 'wb+') as destination:
             for chunk in file.chunks():
                 destination.write(chunk)
 
-        self._vectorize_doc(file_path, vector_path)
+        # 向量化交给 ingest_worker 后台处理, 进度通过 job 接口查询
+        with stage('job_submit'):
+            # 记下 MIME 类型, worker 才能找到按 MIME 类型接受的文件的解析器
+            job = IngestJob.submit(request.user, file_path, vector_path, file.content_type)
+            bump_version(request.user.email)
 
-        return Response({'message': '文件上传成功'}, status=status.HTTP_200_OK)
+        return Response({'message': '文件上传成功', 'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
     
     def destroy(self, request, *args, **kwargs):
         knowledge_name = kwargs.get('knowledge_name')
@@ -274,8 +316,23 @@ class KnowledgeView(CreateModelMixin, DestroyModelMixin, ListModelMixin, Generic
         rm_dir = file_dir / 'remove'
         if not os.path.exists(rm_dir):
             os.makedirs(rm_dir)
+        # 先取消还在处理这个文件的任务, worker 看到取消后撤回已写入的文档块, 也不再写清单
+        self._cancel_job(file_dir / knowledge_name)
         shutil.move(file_dir / knowledge_name, rm_dir / knowledge_name)
-        shutil.rmtree(vector_dir / knowledge_name.split('.')[0])
+        vector_paths = [vector_dir / knowledge_name]
+        # 早期按去掉扩展名的文件名建目录, 没有同名的其他文件时一并清理
+        stem = knowledge_name.split('.')[0]
+        if not any(name.split('.')[0] == stem for name in os.listdir(file_dir) if os.path.isfile(file_dir / name)):
+            vector_paths.append(vector_dir / stem)
+        for vector_path in dict.fromkeys(vector_paths):
+            manifest = ChunkManifest(vector_path)
+            indexed_ids = manifest.load()
+            if indexed_ids:
+                get_vector_db().delete(list(indexed_ids), str(vector_path))
+            manifest.delete()
+            if os.path.exists(vector_path):
+                shutil.rmtree(vector_path)
+        bump_version(request.user.email)
         return Response({'message': '知识库删除成功'}, status=status.HTTP_200_OK)
     
     def list(self, request, *args, **kwargs):
@@ -285,3 +342,38 @@ class KnowledgeView(CreateModelMixin, DestroyModelMixin, ListModelMixin, Generic
         else:
             file_names = []
         return Response(file_names, status=status.HTTP_200_OK)
+
+class KnowledgeJobView(RetrieveModelMixin, DestroyModelMixin, GenericViewSet):
+    def _get_job(self, request, kwargs):
+        return IngestJob.get(kwargs.get('job_id'), request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Show progress of a knowledge ingestion job
+        """
+        job = self._get_job(request, kwargs)
+        if job is None:
+            return Response({'message': '任务不存在'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job.info(), status=status.HTTP_200_OK)
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        Cancel a queued or running job
+        """
+        job = self._get_job(request, kwargs)
+        if job is None:
+            return Response({'message': '任务不存在'}, status=status.HTTP_404_NOT_FOUND)
+        if not job.cancel():
+            return Response({'message': '任务已结束'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'message': '任务已取消'}, status=status.HTTP_200_OK)
+
+    def retry(self, request, *args, **kwargs):
+        """
+        Requeue a failed or cancelled job
+        """
+        job = self._get_job(request, kwargs)
+        if job is None:
+            return Response({'message': '任务不存在'}, status=status.HTTP_404_NOT_FOUND)
+        if not job.retry():
+            return Response({'message': '任务未失败或取消'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'message': '任务已重新排队'}, status=status.HTTP_200_OK)